@@ -0,0 +1,382 @@
+# pcolamakerfaire2023 - app.py
+# 2023 Cooper Dalrymple - me@dcdalrymple.com
+# GPL v3 License
+
+import pico_synth_sandbox.tasks
+from pico_synth_sandbox.board import get_board
+from pico_synth_sandbox.audio import get_audio_driver
+from pico_synth_sandbox.synth import Synth
+from pico_synth_sandbox.keyboard import get_keyboard_driver
+from pico_synth_sandbox.midi import Midi
+from pico_synth_sandbox.display import Display
+from menu import Menu, MenuItem, MenuGroup, NumberMenuItem
+from launcher import ready
+
+class PatchMenuItem(NumberMenuItem):
+    def __init__(self, maximum:int=16, update:function=None):
+        NumberMenuItem.__init__(self, "Patch", step=1, initial=0, minimum=0, maximum=maximum, loop=True, update=update)
+    def set(self, value:float, force:bool=False):
+        if force:
+            NumberMenuItem.set(self, value)
+    def enable(self, display:Display):
+        self._group = ""
+        NumberMenuItem.enable(self, display)
+
+class App:
+    def __init__(self, name:str, voices:tuple, polyphonic:bool=True, root:int=None, patches:bool=True, arpeggiator:bool=False, sequencer:bool=False, looper:bool=False, randomizer:bool=False, history:bool=False, remote:bool=False, meter:bool=False, auto_gain:bool=False, profile:bool=False, scheduler:bool=False, memory:bool=False):
+        self.name = name
+        self._polyphonic = polyphonic
+
+        self.memory = None
+        if memory:
+            from memory import MemoryTracker
+            self.memory = MemoryTracker(dump_interval=10.0)
+            self.memory.snapshot("imports")
+
+        # Initialize Synth and other objects first for reference in menu items
+        self.board = get_board()
+        self.audio = get_audio_driver(self.board)
+        self.audio.mute()
+        self.synth = Synth(self.audio)
+        self.synth.add_voices(voices)
+        self._voices = tuple(self.synth.voices) # Fixed for iteration within note callbacks
+        max_voices = len(self.synth.voices) if polyphonic else 1
+        if root is None:
+            self.keyboard = get_keyboard_driver(self.board, max_voices=max_voices)
+        else:
+            self.keyboard = get_keyboard_driver(self.board, root=root, max_voices=max_voices)
+        self.midi = Midi(self.board)
+        if self.memory:
+            self.memory.snapshot("synth")
+
+        # Optional modules are only imported when enabled to reduce boot time and heap use
+        self.profiler = None
+        if profile:
+            from profiler import Profiler
+            self.profiler = Profiler(dump_interval=10.0)
+        self.scheduler = None
+        if scheduler:
+            from scheduler import Scheduler
+            self.scheduler = Scheduler()
+        self.arpeggiator = None
+        if arpeggiator:
+            from arpeggiator import Arpeggiator
+            self.arpeggiator = Arpeggiator(self.synth_press, self.synth_release)
+        self.sequencer = None
+        if sequencer:
+            from step_sequencer import StepSequencer
+            self.sequencer = StepSequencer(self.synth_press, self.synth_release)
+        self.looper = None
+        if looper:
+            from looper import Looper
+            self.looper = Looper(self.synth_press, self.synth_release, self.apply_control)
+        self.randomizer = None
+        if randomizer:
+            from randomizer import Randomizer
+            self.randomizer = Randomizer()
+        self.history = None
+        if history:
+            from history import History
+            self.history = History()
+        self.remote = None
+        if remote:
+            from remote import Remote, get_serial
+            self.remote = Remote(get_serial())
+        self.meter = None
+        if meter or auto_gain:
+            from meter import LevelMeter
+            self.meter = LevelMeter(self.audio, self._voices, auto_gain=auto_gain, dump_interval=1.0 if meter else 0.0)
+        if self.arpeggiator or self.sequencer or self.looper:
+            self._voice_notes = bytearray([255] * len(self.synth.voices))
+            self._voice_next = 0
+
+        self.wavetables = [] # Created on request by oscillator menu groups
+
+        self.menu = None
+        self.patch_item = PatchMenuItem(update=self.read_patch) if patches else None
+        self._default_patch = None
+
+        # Keyboard Setup
+        self.keyboard.set_voice_press(self.voice_press)
+        self.keyboard.set_voice_release(self.voice_release)
+        self.keyboard.set_key_press(self.key_press)
+        self.keyboard.set_key_release(self.key_release)
+
+        # Midi Implementation
+        self.midi.set_control_change(self.control_change)
+        self.midi.set_pitch_bend(self.pitch_bend)
+        self.midi.set_note_on(self.note_on)
+        self.midi.set_note_off(self.note_off)
+        self.midi.set_program_change(self.program_change)
+        if self.arpeggiator and hasattr(self.midi, "set_clock"):
+            # MIDI clock synchronization of the arpeggiator when supported by the MIDI driver
+            self.midi.set_clock(self.arpeggiator.clock)
+            self.midi.set_start(self.arpeggiator.start)
+            self.midi.set_stop(self.arpeggiator.stop)
+
+    # Menu and Patch System
+    def get_midi_menu_group(self, channels:int=16) -> MenuGroup:
+        # The sampler keeps its range of 0 to 15, leaving channel 16 to the launcher's program selection
+        return MenuGroup((
+            NumberMenuItem(
+                title="Channel",
+                step=1,
+                maximum=channels,
+                update=lambda value : self.midi.set_channel(int(value))
+            ),
+            NumberMenuItem(
+                title="Thru",
+                step=1,
+                maximum=1,
+                update=lambda value : self.midi.set_thru(value == 1)
+            ),
+        ), "MIDI")
+    def get_arpeggiator_menu_group(self) -> MenuGroup:
+        from arpeggiator import ArpeggiatorMenuGroup
+        return ArpeggiatorMenuGroup(self.arpeggiator)
+    def get_sequencer_menu_group(self) -> MenuGroup:
+        from step_sequencer import StepSequencerMenuGroup
+        return StepSequencerMenuGroup(self.sequencer)
+    def get_looper_menu_group(self) -> MenuGroup:
+        from looper import LooperMenuGroup
+        return LooperMenuGroup(self.looper)
+    def get_randomizer_menu_group(self) -> MenuGroup:
+        from randomizer import RandomizerMenuGroup
+        return RandomizerMenuGroup(self.randomizer)
+    def get_history_menu_item(self) -> MenuItem:
+        from history import HistoryMenuItem
+        return HistoryMenuItem(self.history)
+    def get_wavetable(self, path:str="/wavetables/default.wt"):
+        # Each oscillator group gets its own wavetable so that table positions are independent
+        from wavetable import Wavetable
+        wavetable = Wavetable(path)
+        self.wavetables.append(wavetable)
+        return wavetable
+
+    def set_menu(self, items:tuple):
+        if self.profiler:
+            from profiler import ProfilerMenuItem
+            items = items + (ProfilerMenuItem(self.profiler),)
+        if self.memory:
+            from memory import MemoryMenuItem
+            items = items + (MemoryMenuItem(self.memory),)
+        if self.meter:
+            from meter import MeterMenuItem
+            items = items + (MeterMenuItem(self.meter),)
+        if self.memory:
+            index = self.memory.begin("menu")
+        self.menu = Menu(self.board, items, self.name)
+        self._default_patch = self.menu.get()
+        if self.history:
+            self.menu.set_history(self.history)
+        if self.randomizer:
+            self.randomizer.set_menu(self.menu)
+        if self.remote:
+            self.remote.set_menu(self.menu)
+        if self.meter:
+            self.meter.set_menu(self.menu)
+        if self.patch_item:
+            self.menu.set_write(self.write_patch)
+        if self.memory:
+            self.memory.end(index)
+            self.memory.snapshot("menu")
+
+    def read_patch(self, value=None):
+        if value is None:
+            value = self.patch_item.get()
+        name = "{}-{:d}".format(self.name, int(value))
+        if self.sequencer and not self.sequencer.read(name):
+            self.sequencer.clear()
+        if self.looper and not self.looper.read(name):
+            self.looper.clear()
+        if self.scheduler:
+            self.scheduler.spawn(self.menu.read_steps(name, default=self._default_patch))
+            return
+        index = self.memory.begin("patch") if self.memory else -1
+        if not self.menu.read(name):
+            self.menu.set(self._default_patch)
+        if self.memory:
+            self.memory.end(index)
+    def write_patch(self) -> bool:
+        # Snapshots are queued on the menu's writer and written to flash in the background without muting audio
+        index = self.memory.begin("patch") if self.memory else -1
+        name = "{}-{:d}".format(self.name, int(self.patch_item.get()))
+        writer = self.menu.get_writer()
+        queued = self.menu.write(name)
+        if self.sequencer:
+            self.sequencer.write(name, writer=writer)
+        if self.looper:
+            self.looper.write(name, writer=writer)
+        if self.memory:
+            self.memory.end(index)
+        return queued
+
+    def set_level(self, value:float):
+        # Output level, which auto-gain is applied on top of when enabled
+        if self.meter:
+            self.meter.set_level(value)
+        else:
+            self.audio.set_level(value)
+
+    def _press_wavetables(self, voice, notenum):
+        # Selects the band-limited table of the note's octave before the voice is pressed
+        for wavetable in self.wavetables:
+            wavetable.press(voice, notenum)
+
+    # Voice allocation of notes which bypass the keyboard driver
+    def synth_press(self, notenum, velocity):
+        if not self._polyphonic:
+            for i in range(len(self._voices)):
+                self._press_wavetables(self._voices[i], notenum)
+                self.synth.press(self._voices[i], notenum, velocity)
+                if self.meter: self.meter.press(i, velocity)
+            return
+        self._press_wavetables(self._voices[self._voice_next], notenum)
+        self.synth.press(self._voice_next, notenum, velocity)
+        if self.meter: self.meter.press(self._voice_next, velocity)
+        self._voice_notes[self._voice_next] = notenum
+        self._voice_next = (self._voice_next + 1) % len(self._voice_notes)
+    def synth_release(self, notenum):
+        if not self._polyphonic:
+            self.synth.release()
+            if self.meter: self.meter.release()
+            return
+        for i in range(len(self._voice_notes)):
+            if self._voice_notes[i] == notenum:
+                self.synth.release(i)
+                self._voice_notes[i] = 255
+                if self.meter: self.meter.release(i)
+
+    # Keyboard Callbacks
+    def voice_press(self, index, notenum, velocity, keynum=None):
+        if self.arpeggiator and self.arpeggiator.is_active():
+            return
+        if self._polyphonic:
+            self._press_wavetables(self._voices[index], notenum)
+            self.synth.press(index, notenum, velocity)
+            if self.meter: self.meter.press(index, velocity)
+        else:
+            for i in range(len(self._voices)):
+                self._press_wavetables(self._voices[i], notenum)
+                self.synth.press(self._voices[i], notenum, velocity)
+                if self.meter: self.meter.press(i, velocity)
+    def voice_release(self, index, notenum, keynum=None):
+        if self._polyphonic:
+            self.synth.release(index)
+            if self.meter: self.meter.release(index)
+        else:
+            self.synth.release()
+            if self.meter: self.meter.release()
+    def key_press(self, keynum, notenum, velocity):
+        self.midi.send_note_on(notenum, velocity)
+        if self.sequencer:
+            self.sequencer.record(notenum, velocity)
+        if self.looper:
+            self.looper.note_on(notenum, velocity)
+        if self.arpeggiator:
+            self.arpeggiator.press(notenum, velocity)
+    def key_release(self, keynum, notenum):
+        self.midi.send_note_off(notenum)
+        if self.looper:
+            self.looper.note_off(notenum)
+        if self.arpeggiator:
+            self.arpeggiator.release(notenum)
+
+    # Midi Callbacks
+    def control_change(self, control, value):
+        if self.looper:
+            self.looper.control_change(control, value)
+        self.apply_control(control, value)
+    def apply_control(self, control, value):
+        if control == 64: # Sustain
+            self.keyboard.set_sustain(value)
+        elif control == 1: # Modulation wheel sweeps the wavetable position
+            for wavetable in self.wavetables:
+                wavetable.set_modulation(value / 127)
+    def pitch_bend(self, value):
+        for voice in self._voices:
+            voice.set_pitch_bend(value)
+    def note_on(self, notenum, velocity):
+        if self.sequencer:
+            self.sequencer.record(notenum, velocity)
+        if self.looper:
+            self.looper.note_on(notenum, velocity)
+        if self.arpeggiator:
+            self.arpeggiator.press(notenum, velocity)
+            if self.arpeggiator.is_active():
+                return
+        # Add to keyboard for processing
+        self.keyboard.append(notenum, velocity)
+    def note_off(self, notenum):
+        if self.looper:
+            self.looper.note_off(notenum)
+        if self.arpeggiator:
+            self.arpeggiator.release(notenum)
+        self.keyboard.remove(notenum)
+    def program_change(self, patch):
+        if self.patch_item:
+            self.patch_item.set(patch, True)
+
+    def run(self):
+        # Load Patch 0
+        if self.patch_item:
+            self.read_patch()
+
+        self.menu.ready()
+        self.audio.unmute()
+        ready(self.name)
+
+        if self.memory:
+            self.memory.snapshot("ready")
+            # Note and encoder events are expected not to allocate
+            self.memory.watch_tasks((
+                ("midi", self.midi),
+                ("keyboard", self.keyboard),
+                ("synth", self.synth),
+                ("display", self.menu.get_display()),
+            ) + tuple(("encoder", encoder) for encoder in self.menu.get_encoders()), ("midi", "keyboard", "encoder"))
+
+        if self.profiler:
+            self.profiler.watch_tasks((
+                ("midi", self.midi),
+                ("keyboard", self.keyboard),
+                ("synth", self.synth),
+                ("display", self.menu.get_display()),
+            ) + tuple(("encoder", encoder) for encoder in self.menu.get_encoders()))
+
+        if self.scheduler:
+            from scheduler import PRIORITY_MIDI, PRIORITY_SEQUENCER, PRIORITY_KEYBOARD, PRIORITY_SYNTH, PRIORITY_ENCODER, PRIORITY_DISPLAY, PRIORITY_BACKGROUND
+            self.scheduler.watch("midi", self.midi, PRIORITY_MIDI, deadline=2)
+            if self.arpeggiator:
+                self.scheduler.watch("arpeggiator", self.arpeggiator, PRIORITY_SEQUENCER, deadline=1)
+            if self.sequencer:
+                self.scheduler.watch("sequencer", self.sequencer, PRIORITY_SEQUENCER, deadline=1)
+            if self.looper:
+                self.scheduler.watch("looper", self.looper, PRIORITY_SEQUENCER, deadline=1)
+            self.scheduler.watch("keyboard", self.keyboard, PRIORITY_KEYBOARD, deadline=5)
+            self.scheduler.watch("synth", self.synth, PRIORITY_SYNTH)
+            for encoder in self.menu.get_encoders():
+                self.scheduler.watch("encoder", encoder, PRIORITY_ENCODER, interval=2)
+            if self.remote:
+                self.scheduler.watch("remote", self.remote, PRIORITY_ENCODER, interval=2)
+            if self.meter:
+                self.scheduler.watch("meter", self.meter, PRIORITY_BACKGROUND, interval=33)
+            for wavetable in self.wavetables:
+                self.scheduler.watch("wavetable", wavetable, PRIORITY_BACKGROUND, interval=33)
+            self.scheduler.watch("display", self.menu.get_display(), PRIORITY_DISPLAY, interval=33)
+            self.scheduler.run()
+        else:
+            from scheduler import chain
+            if self.arpeggiator:
+                chain(self.keyboard, self.arpeggiator.update)
+            if self.sequencer:
+                chain(self.keyboard, self.sequencer.update)
+            if self.looper:
+                chain(self.keyboard, self.looper.update)
+            if self.remote:
+                chain(self.keyboard, self.remote.update)
+            if self.meter:
+                chain(self.keyboard, self.meter.update)
+            for wavetable in self.wavetables:
+                chain(self.menu.get_display(), wavetable.update)
+            pico_synth_sandbox.tasks.run()
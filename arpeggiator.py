@@ -0,0 +1,245 @@
+# pcolamakerfaire2023 - arpeggiator.py
+# 2023 Cooper Dalrymple - me@dcdalrymple.com
+# GPL v3 License
+
+import random
+from array import array
+from menu import MenuGroup, NumberMenuItem, BarMenuItem, ListMenuItem
+from scheduler import StepClock, ticks_ms, ticks_diff, ticks_add
+
+ARP_OFF = 0
+ARP_UP = 1
+ARP_DOWN = 2
+ARP_RANDOM = 3
+ARP_PLAYED = 4
+
+MAX_NOTES = 16
+MAX_OCTAVES = 4
+CLOCKS_PER_BEAT = 24 # MIDI clock resolution
+
+class Arpeggiator:
+    def __init__(self, press:function=None, release:function=None):
+        self._press = press
+        self._release = release
+
+        self._mode = ARP_OFF
+        self._octaves = 1
+        self._gate = 0.5
+        self._steps_per_beat = 4
+        self._sync = False
+        self._chord_enabled = False
+
+        # Preallocated note buffers
+        self._held = bytearray(MAX_NOTES) # In order of being pressed
+        self._velocities = array("f", [0.0] * MAX_NOTES)
+        self._held_count = 0
+        self._chord = bytearray(MAX_NOTES) # Intervals from the lowest note of the memorized chord
+        self._chord_count = 0
+        self._pattern = bytearray(MAX_NOTES * MAX_OCTAVES)
+        self._pattern_velocities = array("f", [0.0] * (MAX_NOTES * MAX_OCTAVES))
+        self._pattern_length = 0
+        self._position = 0
+
+        # Timing
+        self._timer = StepClock(120, self._steps_per_beat)
+        self._gate_due = ticks_ms()
+        self._clocks = 0
+        self._clock_step = self._gate_due
+        self._note = -1
+
+    def set_press(self, callback:function):
+        self._press = callback
+    def set_release(self, callback:function):
+        self._release = callback
+
+    def is_enabled(self) -> bool:
+        return self._mode != ARP_OFF
+    def is_active(self) -> bool:
+        # Whether notes should be routed through the arpeggiator rather than directly to the synth
+        return self._mode != ARP_OFF or self._has_chord()
+    def set_mode(self, value:int):
+        value = int(value)
+        if value == self._mode:
+            return
+        self._release_note()
+        if self._mode == ARP_OFF:
+            self._release_held()
+        self._mode = value
+        self._position = 0
+        self._rebuild()
+        self._timer.restart()
+    def set_octaves(self, value:int):
+        self._octaves = min(max(int(value), 1), MAX_OCTAVES)
+        self._rebuild()
+    def set_gate(self, value:float):
+        self._gate = min(max(value, 0.05), 1.0)
+    def set_bpm(self, value:float):
+        self._timer.set_bpm(value)
+    def set_sync(self, value:bool):
+        self._sync = bool(value)
+        self._clocks = 0
+
+    # Chord memory
+    def set_chord(self, value:bool):
+        value = bool(value)
+        if value != self._chord_enabled and self._mode == ARP_OFF:
+            self._release_held() # With the chord they were pressed with
+        if value and not self._chord_enabled:
+            self.memorize()
+        self._chord_enabled = value
+        self._rebuild()
+    def memorize(self):
+        self._chord_count = 0
+        if not self._held_count:
+            return
+        root = min(self._held[i] for i in range(self._held_count))
+        for i in range(self._held_count):
+            self._chord[self._chord_count] = self._held[i] - root
+            self._chord_count += 1
+    def _has_chord(self) -> bool:
+        return self._chord_enabled and self._chord_count > 1
+
+    # Input
+    def press(self, notenum:int, velocity:float=1.0):
+        if self._held_count >= MAX_NOTES:
+            return
+        for i in range(self._held_count):
+            if self._held[i] == notenum:
+                return
+        self._held[self._held_count] = notenum
+        self._velocities[self._held_count] = velocity
+        self._held_count += 1
+        if self._mode == ARP_OFF:
+            self._press_direct(notenum, velocity)
+        else:
+            if self._held_count == 1:
+                self._position = 0
+                self._timer.restart()
+            self._rebuild()
+    def release(self, notenum:int):
+        for i in range(self._held_count):
+            if self._held[i] == notenum:
+                for j in range(i, self._held_count - 1):
+                    self._held[j] = self._held[j+1]
+                    self._velocities[j] = self._velocities[j+1]
+                self._held_count -= 1
+                break
+        else:
+            return
+        if self._mode == ARP_OFF:
+            self._release_direct(notenum)
+        else:
+            self._rebuild()
+            if not self._held_count:
+                self._release_note()
+    def release_all(self):
+        while self._held_count:
+            self.release(self._held[self._held_count-1])
+
+    # Without a chord, notes are only tracked while inactive and the keyboard driver handles voices directly
+    def _press_direct(self, notenum:int, velocity:float):
+        if not self._press or not self._has_chord():
+            return
+        for i in range(self._chord_count):
+            if notenum + self._chord[i] < 128:
+                self._press(notenum + self._chord[i], velocity)
+    def _release_held(self):
+        # Release notes which were passed through directly
+        for i in range(self._held_count):
+            self._release_direct(self._held[i])
+    def _release_direct(self, notenum:int):
+        if not self._release or not self._has_chord():
+            return
+        for i in range(self._chord_count):
+            if notenum + self._chord[i] < 128:
+                self._release(notenum + self._chord[i])
+
+    def _insert(self, notenum:int, velocity:float, sort:bool):
+        # Insertion into the preallocated pattern, optionally keeping ascending order without duplicates
+        length = self._pattern_length
+        if length >= len(self._pattern) or notenum > 127:
+            return
+        index = length
+        if sort:
+            for i in range(length):
+                if self._pattern[i] == notenum:
+                    return
+                if self._pattern[i] > notenum:
+                    index = i
+                    break
+            for i in range(length, index, -1):
+                self._pattern[i] = self._pattern[i-1]
+                self._pattern_velocities[i] = self._pattern_velocities[i-1]
+        self._pattern[index] = notenum
+        self._pattern_velocities[index] = velocity
+        self._pattern_length += 1
+    def _rebuild(self):
+        self._pattern_length = 0
+        sort = self._mode != ARP_PLAYED
+        for octave in range(self._octaves):
+            for i in range(self._held_count):
+                if self._has_chord():
+                    for j in range(self._chord_count):
+                        self._insert(self._held[i] + self._chord[j] + octave * 12, self._velocities[i], sort)
+                else:
+                    self._insert(self._held[i] + octave * 12, self._velocities[i], sort)
+
+    # Output
+    def _release_note(self):
+        if self._note >= 0:
+            if self._release: self._release(self._note)
+            self._note = -1
+    def _step(self, now:int, interval_ms:int):
+        self._release_note()
+        if not self._pattern_length:
+            return
+        if self._mode == ARP_RANDOM:
+            index = random.randrange(self._pattern_length)
+        elif self._mode == ARP_DOWN:
+            index = self._pattern_length - 1 - (self._position % self._pattern_length)
+        else:
+            index = self._position % self._pattern_length
+        self._position = (self._position + 1) % self._pattern_length
+        self._note = self._pattern[index]
+        self._gate_due = ticks_add(now, max(int(interval_ms * self._gate), 1))
+        if self._press: self._press(self._note, self._pattern_velocities[index])
+
+    def update(self):
+        if self._mode == ARP_OFF:
+            return
+        now = ticks_ms()
+        if self._note >= 0 and ticks_diff(now, self._gate_due) >= 0:
+            self._release_note()
+        if self._sync or not self._held_count:
+            return
+        interval_ms = self._timer.tick(now)
+        if interval_ms:
+            self._step(now, interval_ms)
+
+    # MIDI clock synchronization
+    def clock(self):
+        if not self._sync or self._mode == ARP_OFF:
+            return
+        if not self._clocks % (CLOCKS_PER_BEAT // self._steps_per_beat):
+            now = ticks_ms()
+            if self._held_count:
+                self._step(now, ticks_diff(now, self._clock_step))
+            self._clock_step = now
+        self._clocks = (self._clocks + 1) % CLOCKS_PER_BEAT
+    def start(self):
+        self._clocks = 0
+        self._position = 0
+    def stop(self):
+        self._release_note()
+        self._clocks = 0
+
+class ArpeggiatorMenuGroup(MenuGroup):
+    def __init__(self, arpeggiator:Arpeggiator, group:str="Arp"):
+        MenuGroup.__init__(self, (
+            ListMenuItem(("Off", "Up", "Down", "Random", "Played"), "Mode", update=arpeggiator.set_mode),
+            NumberMenuItem("Octaves", step=1, initial=1, minimum=1, maximum=MAX_OCTAVES, update=arpeggiator.set_octaves),
+            BarMenuItem("Gate", initial=0.5, update=arpeggiator.set_gate),
+            NumberMenuItem("BPM", step=1, initial=120, minimum=40, maximum=240, update=arpeggiator.set_bpm),
+            ListMenuItem(("Internal", "MIDI"), "Sync", loop=False, update=lambda value : arpeggiator.set_sync(value == 1)),
+            ListMenuItem(("Off", "Memorize"), "Chord", loop=False, update=lambda value : arpeggiator.set_chord(value == 1)),
+        ), group)
@@ -2,7 +2,9 @@
 # 2023 Cooper Dalrymple - me@dcdalrymple.com
 # GPL v3 License
 
+import os, json
 import pico_synth_sandbox.tasks
+from launcher import ready
 from pico_synth_sandbox.board import get_board
 from pico_synth_sandbox.display import Display
 from pico_synth_sandbox.encoder import Encoder
@@ -11,8 +13,34 @@ from pico_synth_sandbox.sequencer import Sequencer
 from pico_synth_sandbox.audio import get_audio_driver
 from pico_synth_sandbox.synth import Synth
 from pico_synth_sandbox.voice.drum import Kick, Snare, ClosedHat, OpenHat
+from pico_synth_sandbox.voice.sample import Sample
 from pico_synth_sandbox.midi import Midi
 
+# Set to True to report task execution times over serial
+PROFILE = False
+# Set to True to run tasks by priority and deadline rather than the cooperative task loop
+SCHEDULER = False
+# Set to True to report heap use by boot phase and subsystem, collections and allocating callbacks
+MEMORY = False
+# Number of tracks (4-16), which repeat the kick, snare, closed hat and open hat voices, and steps per pattern (16, 32
+# or 64), which are shown and edited one page of 16 steps at a time
+TRACKS = 4
+LENGTH = 16
+
+# Patterns are stored and paged in whole pages, other lengths round up to the next supported one and at most 64
+if LENGTH > 32:
+    LENGTH = 64
+elif LENGTH > 16:
+    LENGTH = 32
+else:
+    LENGTH = 16
+
+memory = None
+if MEMORY:
+    from memory import MemoryTracker
+    memory = MemoryTracker(dump_interval=10.0)
+    memory.snapshot("imports")
+
 board = get_board()
 
 display = Display(board)
@@ -25,42 +53,167 @@ voice=0
 bpm=120
 alt_enc=False
 alt_key=False
+page=0
+follow=True # Whether the page follows playback
+
+# Kits are JSON lists with a file from /samples, or null for the synthesized voice, for each track. Kits may also be
+# objects with such a list as "samples" along with a list of choke groups as "choke". The first kit is always the
+# synthesized voices.
+KIT_DIR = "/kits"
+SAMPLE_NOTE = 69 # Plays samples at their recorded pitch
+try:
+    kits = ("Synth",) + tuple(sorted(name[:-5] for name in os.listdir(KIT_DIR) if name[-5:] == ".json"))
+except:
+    kits = ("Synth",)
+kit = 0
 
 audio = get_audio_driver(board)
 synth = Synth(audio)
-synth.add_voices([
-    Kick(),
-    Snare(),
-    ClosedHat(),
-    OpenHat()
-])
+DRUM_VOICES = (Kick, Snare, ClosedHat, OpenHat)
+drums = tuple(DRUM_VOICES[i % len(DRUM_VOICES)]() for i in range(min(max(TRACKS, 4), 16)))
+tracks = len(drums)
+synth.add_voices(drums)
+pool = None
+if len(kits) > 1:
+    # Each track has a sample voice which replaces its drum voice when the kit has a sample for it
+    from sample_pool import SamplePool
+    synth.add_voices([Sample(loop=False) for i in range(tracks)])
+    pool = SamplePool()
 midi = Midi(board)
+if memory:
+    memory.snapshot("synth")
+    memory_index = memory.begin("sequencer")
 
 sequencer = Sequencer(
-    tracks=len(synth.voices),
+    length=LENGTH,
+    tracks=tracks,
     bpm=120
 )
+if memory:
+    memory.end(memory_index)
+# Preallocated display state to avoid allocating within note events
+def get_drum_name(track:int) -> str:
+    name = type(drums[track]).__name__
+    return name if track < len(DRUM_VOICES) else "{}{:d}".format(name, track // len(DRUM_VOICES) + 1)
+voice_names = [get_drum_name(i) for i in range(tracks)]
+track_voices = bytearray(range(tracks)) # Index of each track's voice within the synth
+track_notes = bytearray([1] * tracks)
+PAGE_SIZE = 16
+pages = max(sequencer.get_length() // PAGE_SIZE, 1)
+step_positions = tuple((i, 1) for i in range(PAGE_SIZE))
+STEP_ON = "*"
+STEP_OFF = "_"
+PAGE_NAMES = tuple(str(i + 1) for i in range(pages))
+PAGE_POSITION = (10,0)
+ALT_KEY_POSITION = (12,0)
+NAME_LENGTH = 10 if pages > 1 else 11
+
+# Tracks in the same choke group cut each other off, like a closed hat stopping an open hat. Each track links to the
+# next track of its group, or to itself when it isn't in a group, so that choking only visits the group's members.
+DEFAULT_CHOKE = tuple(i // len(DRUM_VOICES) + 1 if type(drums[i]) in (ClosedHat, OpenHat) else 0 for i in range(tracks))
+choke_next = bytearray(range(tracks))
+def set_choke_groups(groups:tuple):
+    for track in range(tracks):
+        choke_next[track] = track
+        if not groups[track]:
+            continue
+        for i in range(1, tracks):
+            other = (track + i) % tracks
+            if groups[other] == groups[track]:
+                choke_next[track] = other
+                break
+set_choke_groups(DEFAULT_CHOKE)
+
 def seq_step(position):
-    display.show_cursor(position, 1)
+    global page
+    if position // PAGE_SIZE != page:
+        if not follow:
+            display.hide_cursor()
+            return
+        page = position // PAGE_SIZE
+        draw_page()
+    display.show_cursor(position % PAGE_SIZE, 1)
 def seq_press(notenum, velocity):
-    synth.press((notenum - 1) % len(synth.voices))
+    track = (notenum - 1) % tracks
+    other = choke_next[track]
+    while other != track:
+        synth.release(track_voices[other], True)
+        other = choke_next[other]
+    synth.press(track_voices[track], track_notes[track])
 def seq_release(notenum):
-    if (notenum - 1) % len(synth.voices) == 2: # Closed Hat
-        synth.release(3, True) # Force release Open Hat
-    synth.release((notenum - 1) % len(synth.voices))
+    synth.release(track_voices[(notenum - 1) % tracks])
 sequencer.set_step(seq_step)
 sequencer.set_press(seq_press)
 sequencer.set_release(seq_release)
 
+def draw_page():
+    # Only the steps of the visible page are drawn, one character at a time from preallocated strings
+    offset = page * PAGE_SIZE
+    for i in range(PAGE_SIZE):
+        display.write(STEP_ON if sequencer.has_note(offset + i, voice) else STEP_OFF, step_positions[i], 1)
+    if pages > 1:
+        display.write(PAGE_NAMES[page], PAGE_POSITION, 1)
 def update_display():
-    display.write(synth.voices[voice].__qualname__, (0, 0), 11)
+    display.write(voice_names[voice], (0, 0), NAME_LENGTH)
     display.write(">" if alt_enc else "<", (11,0), 1)
-    display.write(("^" if alt_key else "-") if len(keyboard.keys) < 16 else " ", (12,0), 1)
+    display.write(("^" if alt_key else "-") if len(keyboard.keys) < 16 else " ", ALT_KEY_POSITION, 1)
     display.write(str(bpm), (13,0), 3, True)
-    line = ""
-    for i in range(sequencer.get_length()):
-        line += "*" if sequencer.has_note(i, voice) else "_"
-    display.write(line, (0,1))
+    draw_page()
+def next_page():
+    # Selecting a page stops it from following playback until the sequencer is started again
+    global page, follow
+    page = (page + 1) % pages
+    follow = False
+    draw_page()
+
+# Sample kits load in the background while the sequencer keeps playing the previous kit
+kit_files = (None,) * tracks
+kit_choke = DEFAULT_CHOKE
+def read_kit(name:str) -> tuple:
+    # Returns the (files, choke groups) of each track
+    path = "{}/{}.json".format(KIT_DIR, name)
+    try:
+        with open(path, "r") as file:
+            data = json.load(file)
+    except:
+        print("Failed to read kit file: {}".format(path))
+        data = ()
+    files = data.get("samples", ()) if type(data) is dict else data
+    choke = data.get("choke", DEFAULT_CHOKE) if type(data) is dict else DEFAULT_CHOKE
+    return (
+        tuple(files[i] if i < len(files) else None for i in range(tracks)),
+        tuple(int(choke[i] or 0) if i < len(choke) else 0 for i in range(tracks))
+    )
+def select_kit(index):
+    global kit, kit_files, kit_choke
+    if not pool:
+        return
+    kit = int(index) % len(kits)
+    if kit:
+        kit_files, kit_choke = read_kit(kits[kit])
+    else:
+        kit_files, kit_choke = (None,) * tracks, DEFAULT_CHOKE
+    display.write(kits[kit], (0,0), NAME_LENGTH)
+    pool.load(kit_files, loaded=kit_loaded)
+def next_kit():
+    select_kit(kit + 1)
+def kit_loaded(samples):
+    for track in range(tracks):
+        synth.release(track_voices[track], True)
+        voice = synth.voices[tracks + track]
+        if samples[track]:
+            data, sample_rate = samples[track]
+            voice.load(data, sample_rate)
+            track_voices[track] = tracks + track
+            track_notes[track] = SAMPLE_NOTE
+            voice_names[track] = kit_files[track].rsplit(".", 1)[0]
+        else:
+            voice.unload()
+            track_voices[track] = track
+            track_notes[track] = 1
+            voice_names[track] = get_drum_name(track)
+    set_choke_groups(kit_choke)
+    update_display()
 
 keyboard = get_keyboard_driver(board, max_voices=0)
 def key_press(keynum, notenum, velocity):
@@ -70,14 +223,19 @@ def key_press(keynum, notenum, velocity):
         global alt_key
         if keynum == 11:
             alt_key = not alt_key
-            display.write("^" if alt_key else "-", (12,0), 1)
+            display.write("^" if alt_key else "-", ALT_KEY_POSITION, 1)
+            return
+        elif keynum == 8 and pages > 1:
+            next_page()
             return
         elif keynum < 8:
             position = keynum + (8 if alt_key else 0)
+        else:
+            return
     else:
         position = keynum
 
-    position = position % sequencer.get_length()
+    position = page * PAGE_SIZE + position % PAGE_SIZE
     if not sequencer.has_note(
         position=position,
         track=voice
@@ -88,13 +246,13 @@ def key_press(keynum, notenum, velocity):
             velocity=1.0,
             track=voice
         )
-        display.write("*", (position,1), 1)
+        display.write(STEP_ON, step_positions[position % PAGE_SIZE], 1)
     else:
         sequencer.remove_note(
             position=position,
             track=voice
         )
-        display.write("_", (position,1), 1)
+        display.write(STEP_OFF, step_positions[position % PAGE_SIZE], 1)
 keyboard.set_key_press(key_press)
 
 def update_bpm():
@@ -148,7 +306,9 @@ def encoder_toggle():
     alt_enc = not alt_enc
     update_selected()
 def toggle_sequencer():
+    global follow
     sequencer.toggle()
+    follow = True
 def clear_track():
     for i in range(sequencer.get_length()):
         sequencer.remove_note(position=i, track=voice)
@@ -156,20 +316,68 @@ def clear_track():
 
 update_display()
 
+encoders = ()
 if board.num_encoders() == 1:
     encoder = Encoder(board)
+    encoders = (encoder,)
     encoder.set_increment(encoder_increment)
     encoder.set_decrement(encoder_decrement)
     encoder.set_click(encoder_toggle)
     encoder.set_double_click(toggle_sequencer)
+    encoder.set_long_press(next_kit)
 elif board.num_encoders() > 1:
     encoders = (Encoder(board, 0), Encoder(board, 1))
     encoders[0].set_increment(increment_voice)
     encoders[0].set_decrement(decrement_voice)
     encoders[0].set_long_press(clear_track)
+    encoders[0].set_click(next_kit)
+    encoders[0].set_double_click(next_page)
     encoders[1].set_increment(increment_bpm)
     encoders[1].set_decrement(decrement_bpm)
     encoders[1].set_click(toggle_sequencer)
     # TODO: encoders[1].set_long_press(save_sequence)
 
-pico_synth_sandbox.tasks.run()
+# Program changes select kits
+midi.set_program_change(select_kit)
+
+ready("drum_machine")
+
+if memory:
+    memory.snapshot("ready")
+    memory.watch_tasks((
+        ("midi", midi),
+        ("keyboard", keyboard),
+        ("sequencer", sequencer),
+        ("synth", synth),
+        ("display", display),
+    ) + tuple(("encoder", encoder) for encoder in encoders), ("midi", "keyboard", "encoder"))
+
+if PROFILE:
+    from profiler import Profiler
+    profiler = Profiler(dump_interval=10.0)
+    profiler.watch_tasks((
+        ("midi", midi),
+        ("keyboard", keyboard),
+        ("sequencer", sequencer),
+        ("synth", synth),
+        ("display", display),
+    ) + tuple(("encoder", encoder) for encoder in encoders))
+
+if SCHEDULER:
+    from scheduler import Scheduler, PRIORITY_MIDI, PRIORITY_SEQUENCER, PRIORITY_KEYBOARD, PRIORITY_SYNTH, PRIORITY_ENCODER, PRIORITY_DISPLAY, PRIORITY_BACKGROUND
+    scheduler = Scheduler()
+    scheduler.watch("midi", midi, PRIORITY_MIDI, deadline=2)
+    scheduler.watch("sequencer", sequencer, PRIORITY_SEQUENCER, deadline=1)
+    scheduler.watch("keyboard", keyboard, PRIORITY_KEYBOARD, deadline=5)
+    scheduler.watch("synth", synth, PRIORITY_SYNTH)
+    for encoder in encoders:
+        scheduler.watch("encoder", encoder, PRIORITY_ENCODER, interval=2)
+    scheduler.watch("display", display, PRIORITY_DISPLAY, interval=33)
+    if pool:
+        scheduler.watch("samples", pool, PRIORITY_BACKGROUND)
+    scheduler.run()
+else:
+    if pool:
+        from scheduler import chain
+        chain(keyboard, pool.update)
+    pico_synth_sandbox.tasks.run()
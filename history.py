@@ -0,0 +1,150 @@
+# pcolamakerfaire2023 - history.py
+# 2023 Cooper Dalrymple - me@dcdalrymple.com
+# GPL v3 License
+
+from array import array
+from menu import Menu, MenuItem
+from pico_synth_sandbox.display import Display
+
+HISTORY_SIZE = 128 # Entries of 7 bytes each
+
+class History:
+    # Undo and redo of parameter edits. Every change of a parameter in the menu's store is recorded as its index and
+    # previous value in a fixed ring buffer, and entries are grouped into actions: one encoder adjustment, reset or
+    # batched commit. Consecutive adjustments of the same item are coalesced into one action. Undoing an action swaps
+    # each recorded value with the current one so that the same entries redo it, and applies them in a single commit.
+    # When the buffer is full, the oldest action is discarded.
+    def __init__(self, size:int=HISTORY_SIZE):
+        self._indexes = array("H", [0] * size)
+        self._values = array("f", [0.0] * size)
+        self._starts = bytearray(size) # First entry of each action
+        self._head = 0 # Position of the next entry
+        self._count = 0 # Entries before the head which can be undone
+        self._redo = 0 # Entries from the head which can be redone
+        self._begin = False
+        self._coalesce = False
+        self._coalescable = False # Whether the last action was a single adjustment which may be extended
+        self._dropping = False
+        self._paused = False
+        self._menu = None
+
+    def set_menu(self, menu:Menu):
+        self._menu = menu
+        self.clear()
+
+    def clear(self):
+        self._count = 0
+        self._redo = 0
+        self._begin = False
+        self._coalescable = False
+        self._dropping = False
+
+    def begin(self, coalesce:bool=False):
+        # Starts a new action, which a single change of the same parameter as the last action may be merged into
+        if self._paused:
+            return
+        self._begin = True
+        self._coalesce = coalesce
+        self._dropping = False
+
+    def record(self, index:int, value:float):
+        # Called by the parameter store with the previous value of a changed parameter
+        if self._paused or self._dropping:
+            return
+        size = len(self._indexes)
+        start = self._begin
+        if start:
+            self._begin = False
+            if self._coalesce and self._coalescable and not self._redo and self._indexes[(self._head - 1) % size] == index:
+                return # The recorded value from before the first adjustment is kept
+            self._coalescable = self._coalesce
+        else:
+            self._coalescable = False
+        self._redo = 0
+        self._indexes[self._head] = index
+        self._values[self._head] = value
+        self._starts[self._head] = 1 if start or not self._count else 0
+        self._head = (self._head + 1) % size
+        if self._count < size:
+            self._count += 1
+            return
+        # The oldest entry was overwritten, the rest of its action is discarded
+        while self._count and not self._starts[(self._head - self._count) % size]:
+            self._count -= 1
+        if not self._count:
+            self._dropping = True # The current action doesn't fit at all
+
+    def can_undo(self) -> bool:
+        return self._count > 0
+    def can_redo(self) -> bool:
+        return self._redo > 0
+    def get_counts(self) -> tuple:
+        # Number of actions which can be undone and redone
+        size = len(self._starts)
+        undo, redo = 0, 0
+        for i in range(self._count):
+            undo += self._starts[(self._head - 1 - i) % size]
+        for i in range(self._redo):
+            redo += self._starts[(self._head + i) % size]
+        return (undo, redo)
+
+    def _swap(self, position:int):
+        index = self._indexes[position]
+        value = self._values[position]
+        self._values[position] = self._menu.get_value(index)
+        self._menu.stage_value(index, value)
+    def _commit(self) -> int:
+        self._paused = True
+        changed = self._menu.commit()
+        self._paused = False
+        self._begin = False
+        self._coalescable = False
+        if changed:
+            self._menu.redraw()
+        return changed
+
+    def undo(self) -> int:
+        # Reverts the last action, returning the number of changed parameters
+        if not self._menu or not self._count:
+            return 0
+        size = len(self._indexes)
+        while self._count:
+            self._head = (self._head - 1) % size
+            self._count -= 1
+            self._redo += 1
+            self._swap(self._head)
+            if self._starts[self._head]:
+                break
+        return self._commit()
+    def redo(self) -> int:
+        # Applies the last undone action again, returning the number of changed parameters
+        if not self._menu or not self._redo:
+            return 0
+        size = len(self._indexes)
+        first = True
+        while self._redo and (first or not self._starts[self._head]):
+            first = False
+            self._swap(self._head)
+            self._head = (self._head + 1) % size
+            self._count += 1
+            self._redo -= 1
+        return self._commit()
+
+class HistoryMenuItem(MenuItem):
+    # Turning the value left undoes the last edit and turning it right redoes it
+    def __init__(self, history:History, title:str="Undo"):
+        MenuItem.__init__(self, title)
+        self._history = history
+    def adjust(self, steps:int, accelerated:int=None) -> bool:
+        if steps < 0:
+            self._history.undo()
+        elif steps > 0:
+            self._history.redo()
+        return bool(steps)
+    def increment(self) -> bool:
+        return self.adjust(1)
+    def decrement(self) -> bool:
+        return self.adjust(-1)
+    def draw(self, display:Display):
+        undo, redo = self._history.get_counts()
+        display.write("<{:d}  {:d}>".format(undo, redo), (0,1))
@@ -0,0 +1,160 @@
+# pcolamakerfaire2023 - launcher.py
+# 2023 Cooper Dalrymple - me@dcdalrymple.com
+# GPL v3 License
+
+import gc, struct, time
+
+try:
+    from microcontroller import nvm
+except (ImportError, AttributeError):
+    nvm = None
+try:
+    import supervisor
+except ImportError:
+    supervisor = None
+
+PROGRAMS = ("monophonic", "polyphonic", "sampler", "drum_machine")
+TITLES = ("Monophonic", "Polyphonic", "Sampler", "Drum Machine")
+
+SELECT_CHANNEL = 16 # MIDI channel reserved for program selection
+SELECT_TIMEOUT = 5.0 # Seconds before the last program is started automatically
+
+# Launcher state is kept in non-volatile memory to survive soft resets
+STATE_MAGIC = b"PSL1"
+STATE_FORMAT = "<4sBB" + "I" * len(PROGRAMS) # Magic, pending program, last program, heap footprint of each program
+STATE_SIZE = struct.calcsize(STATE_FORMAT)
+NONE = 255
+
+_baseline = None
+_program = None
+
+def read_state() -> list:
+    if nvm is None or len(nvm) < STATE_SIZE:
+        return None
+    state = list(struct.unpack(STATE_FORMAT, nvm[0:STATE_SIZE]))
+    if state[0] != STATE_MAGIC:
+        return [STATE_MAGIC, NONE, 0] + [0] * len(PROGRAMS)
+    return state
+def write_state(state:list):
+    if nvm is None or len(nvm) < STATE_SIZE:
+        return
+    data = struct.pack(STATE_FORMAT, *state)
+    if nvm[0:STATE_SIZE] != data: # Avoid unnecessary flash wear
+        nvm[0:STATE_SIZE] = data
+
+def get_index(name:str) -> int:
+    for i in range(len(PROGRAMS)):
+        if PROGRAMS[i] == name:
+            return i
+    return NONE
+
+def start(index:int):
+    # Import the program module with as much free heap as possible, the import only returns if the program exits
+    global _baseline, _program
+    _program = index
+    gc.collect()
+    if hasattr(gc, "mem_free"):
+        _baseline = gc.mem_free()
+    __import__(PROGRAMS[index])
+
+def switch(index:int):
+    # Start another program with a clean heap by requesting it and performing a soft reset
+    if type(index) is str:
+        index = get_index(index)
+    if index >= len(PROGRAMS):
+        return
+    state = read_state()
+    if state is None or supervisor is None:
+        start(index)
+        return
+    state[1] = index
+    state[2] = index
+    write_state(state)
+    supervisor.reload()
+
+def ready(name:str=None):
+    # Called by programs once initialized to report and store their heap footprint
+    if not hasattr(gc, "mem_free"):
+        return
+    gc.collect()
+    free = gc.mem_free()
+    index = _program if name is None else get_index(name)
+    if _baseline is None or index == NONE:
+        print("{}: {:d} bytes free".format(name, free))
+        return
+    used = _baseline - free
+    print("{}: {:d} bytes used, {:d} bytes free".format(PROGRAMS[index], used, free))
+    state = read_state()
+    if state is not None:
+        state[3 + index] = used & ~0xff # Rounded to reduce writes of non-volatile memory
+        write_state(state)
+
+def select(state:list=None) -> int:
+    # Boot menu to choose a program with the encoder or a program change on the reserved MIDI channel
+    from pico_synth_sandbox.board import get_board
+    from pico_synth_sandbox.display import Display
+    from pico_synth_sandbox.encoder import Encoder
+    from pico_synth_sandbox.midi import Midi
+
+    board = get_board()
+    display = Display(board)
+    display.set_cursor_blink(False)
+    index = state[2] if state and state[2] < len(PROGRAMS) else 0
+    selected = None
+    deadline = time.monotonic() + SELECT_TIMEOUT
+
+    def draw():
+        display.write(TITLES[index], (0,0))
+        used = state[3 + index] if state else 0
+        display.write("{:d}KB heap".format(used // 1024) if used else "Click to start", (0,1))
+    def move(direction:int):
+        nonlocal index, deadline
+        index = (index + direction) % len(PROGRAMS)
+        deadline = None # Wait for the user once they have interacted
+        draw()
+    def choose(value:int=None):
+        nonlocal selected
+        selected = index if value is None else int(value)
+
+    encoder = None
+    if board.num_encoders() > 0:
+        encoder = Encoder(board, 0)
+        encoder.set_increment(lambda : move(1))
+        encoder.set_decrement(lambda : move(-1))
+        encoder.set_click(choose)
+    midi = Midi(board)
+    midi.set_channel(SELECT_CHANNEL)
+    midi.set_program_change(lambda value : choose(value) if value < len(PROGRAMS) else None)
+
+    draw()
+    while selected is None:
+        if encoder: encoder.update()
+        midi.update()
+        display.update()
+        if deadline is not None and time.monotonic() >= deadline:
+            choose()
+    display.clear()
+    display.write("Loading...", (0,0))
+    display.update()
+    return selected
+
+def main(program:str=None):
+    # Entry point for code.py, starts a program requested before a soft reset, the given program or the boot menu
+    state = read_state()
+    if state is not None and state[1] < len(PROGRAMS):
+        index = state[1]
+        state[1] = NONE
+        write_state(state)
+        start(index)
+        return
+    if program is not None:
+        index = get_index(program)
+    else:
+        index = select(state)
+        if state is not None:
+            switch(index) # Restart so the boot menu's objects don't occupy the heap
+            return
+    if state is not None and state[2] != index:
+        state[2] = index
+        write_state(state)
+    start(index)
@@ -0,0 +1,406 @@
+# pcolamakerfaire2023 - looper.py
+# 2023 Cooper Dalrymple - me@dcdalrymple.com
+# GPL v3 License
+
+import struct
+from array import array
+from pico_synth_sandbox import check_dir
+from menu import MenuGroup
+from scheduler import ticks_ms, ticks_diff, ticks_add
+from step_sequencer import PatternMenuItem
+from writer import FileWriter, write_file, find_file
+
+LOOP_STOP = 0
+LOOP_RECORD = 1
+LOOP_PLAY = 2
+LOOP_OVERDUB = 3
+
+MAX_EVENTS = 512
+MAX_DELTA = 0xffff # ms, longer gaps are padded with empty events
+
+# Event types are MIDI status bytes without the channel
+EVENT_NONE = 0x00
+EVENT_NOTE_OFF = 0x80
+EVENT_NOTE_ON = 0x90
+EVENT_CONTROL_CHANGE = 0xb0
+EVENT_SKIP = 0x01 # Overdubbed ahead of playback and already heard live, skipped once
+
+QUANTIZE_DIVISIONS = (0, 2, 4, 8) # Grid steps per beat: off, 1/8, 1/16, 1/32
+
+# Standard MIDI files are written with 1 ms ticks: 500 ticks per quarter note at 500000 us per quarter note
+SMF_DIVISION = 500
+SMF_TEMPO = 500000
+
+def append_vlq(data:bytearray, value:int):
+    # MIDI variable-length quantity
+    shift = 21
+    while shift and not value >> shift:
+        shift -= 7
+    while shift:
+        data.append(0x80 | ((value >> shift) & 0x7f))
+        shift -= 7
+    data.append(value & 0x7f)
+
+def read_vlq(data:bytes, offset:int) -> tuple:
+    # Returns (value, offset after the quantity)
+    value = 0
+    while offset < len(data):
+        value = (value << 7) | (data[offset] & 0x7f)
+        offset += 1
+        if not data[offset-1] & 0x80:
+            break
+    return (value, offset)
+
+class Looper:
+    def __init__(self, press:function=None, release:function=None, control:function=None, size:int=MAX_EVENTS):
+        self._press = press
+        self._release = release
+        self._control = control
+
+        # Preallocated, delta-time encoded event storage
+        self._types = bytearray(size)
+        self._data1 = bytearray(size)
+        self._data2 = bytearray(size)
+        self._deltas = array("H", [0] * size) # ms since the previous event
+        self._count = 0
+        self._duration = 0 # ms from the start of the loop to the last event
+        self._length = 0 # ms of the loop
+        self._dropped = 0
+
+        self._mode = LOOP_STOP
+        self._bpm = 120
+        self._quantize = 0
+        self._start = ticks_ms()
+        self._index = 0 # Next event to play
+        self._next = 0 # ms from the start of the loop to the next event
+        self._sounding = bytearray(16) # Bit per note played back and not yet released
+        self._shifts = array("h", [0] * 128) # ms each held note's note on was moved by quantization
+
+    def set_press(self, callback:function):
+        self._press = callback
+    def set_release(self, callback:function):
+        self._release = callback
+    def set_control(self, callback:function):
+        self._control = callback
+
+    def get_count(self) -> int:
+        return self._count
+    def get_size(self) -> int:
+        return len(self._types)
+    def get_dropped(self) -> int:
+        return self._dropped
+    def get_length(self) -> int:
+        return self._length
+    def get_bpm(self) -> int:
+        return self._bpm
+    def set_bpm(self, value:int):
+        self._bpm = max(int(value), 1)
+    def get_quantize(self) -> int:
+        return self._quantize
+    def set_quantize(self, value:int):
+        self._quantize = min(max(int(value), 0), len(QUANTIZE_DIVISIONS) - 1)
+    def _get_grid(self) -> int:
+        # ms per quantization step, or 0 if disabled
+        if not self._quantize:
+            return 0
+        return 60000 // (self._bpm * QUANTIZE_DIVISIONS[self._quantize])
+
+    def clear(self):
+        self.release_all()
+        self._count = 0
+        self._duration = 0
+        self._length = 0
+        self._dropped = 0
+        self._index = 0
+        self._next = 0
+        for i in range(len(self._shifts)):
+            self._shifts[i] = 0
+        if self._mode == LOOP_PLAY or self._mode == LOOP_OVERDUB:
+            self._mode = LOOP_STOP # Nothing left to play or overdub onto
+
+    def get_mode(self) -> int:
+        return self._mode
+    def set_mode(self, value:int):
+        # Overdub starts a new recording when the loop is empty
+        value = int(value)
+        if value == self._mode:
+            return
+        now = ticks_ms()
+        if self._mode == LOOP_RECORD:
+            self._close(now)
+        if value == LOOP_RECORD or (value == LOOP_OVERDUB and not self._length):
+            self.clear()
+            self._start = now
+            value = LOOP_RECORD
+        elif value == LOOP_STOP or not self._length:
+            self.release_all()
+            value = LOOP_STOP
+        elif self._mode == LOOP_STOP or self._mode == LOOP_RECORD:
+            self._restart(now)
+        self._mode = value
+    def _close(self, now:int):
+        # Set the loop length at the end of a recording, rounded to the quantization grid
+        length = max(ticks_diff(now, self._start), self._duration, 1)
+        grid = self._get_grid()
+        if grid:
+            length = max((length + grid // 2) // grid, 1) * grid
+            if length < self._duration:
+                length += grid
+        self._length = length if self._count else 0
+    def _restart(self, now:int):
+        self._start = now
+        self._index = 0
+        self._next = self._deltas[0] if self._count else 0
+
+    # Storage
+    def _insert(self, time:int, type:int, data1:int, data2:int) -> int:
+        # Insert an event in time order and return its index, or -1 if the buffer is full
+        size = len(self._types)
+        if time >= self._duration:
+            # Append, padding gaps which can't be represented by a single delta
+            delta = time - self._duration
+            while delta > MAX_DELTA and self._count < size - 1:
+                self._set(self._count, EVENT_NONE, 0, 0, MAX_DELTA)
+                self._count += 1
+                self._duration += MAX_DELTA
+                delta -= MAX_DELTA
+            if self._count >= size or delta > MAX_DELTA:
+                self._dropped += 1
+                return -1
+            index = self._count
+            self._set(index, type, data1, data2, delta)
+            self._count += 1
+            self._duration = time
+            return index
+        if self._count >= size:
+            self._dropped += 1
+            return -1
+        # Search from the playback position when possible, overdubbed events are usually close to it
+        index, previous = 0, 0
+        if self._mode == LOOP_OVERDUB and self._index < self._count and time >= self._next - self._deltas[self._index]:
+            index, previous = self._index, self._next - self._deltas[self._index]
+        while index < self._count and previous + self._deltas[index] <= time:
+            previous += self._deltas[index]
+            index += 1
+        for i in range(self._count, index, -1):
+            self._types[i] = self._types[i-1]
+            self._data1[i] = self._data1[i-1]
+            self._data2[i] = self._data2[i-1]
+            self._deltas[i] = self._deltas[i-1]
+        self._set(index, type, data1, data2, time - previous)
+        self._deltas[index+1] -= time - previous
+        self._count += 1
+        return index
+    def _set(self, index:int, type:int, data1:int, data2:int, delta:int):
+        self._types[index] = type
+        self._data1[index] = data1
+        self._data2[index] = data2
+        self._deltas[index] = delta
+
+    # Input
+    def _input(self, type:int, data1:int, data2:int):
+        if self._mode == LOOP_RECORD:
+            time = ticks_diff(ticks_ms(), self._start)
+        elif self._mode == LOOP_OVERDUB:
+            time = ticks_diff(ticks_ms(), self._start) % self._length
+        else:
+            return
+        grid = self._get_grid()
+        if type == EVENT_NOTE_ON:
+            shift = (time + grid // 2) // grid * grid - time if grid else 0
+            self._shifts[data1] = shift
+            time += shift
+        elif type == EVENT_NOTE_OFF:
+            # Moved along with its note on, so a note shorter than half a step can't end before it starts
+            time += self._shifts[data1]
+            self._shifts[data1] = 0
+        if self._mode == LOOP_OVERDUB:
+            time %= self._length
+        index = self._insert(time, type, data1, data2)
+        if index < 0 or self._mode != LOOP_OVERDUB:
+            return
+        if index < self._index:
+            self._index += 1
+        else:
+            # Still ahead of the playback position within this pass
+            self._types[index] |= EVENT_SKIP
+            if index == self._index:
+                self._next = time
+    def note_on(self, notenum:int, velocity:float=1.0):
+        self._input(EVENT_NOTE_ON, notenum, min(max(int(velocity * 127), 1), 127))
+    def note_off(self, notenum:int):
+        self._input(EVENT_NOTE_OFF, notenum, 0)
+    def control_change(self, control:int, value:int):
+        # Values are stored as 7-bit MIDI data
+        self._input(EVENT_CONTROL_CHANGE, control, int(value * 127) if type(value) is float else min(max(int(value), 0), 127))
+
+    # Playback
+    def _dispatch(self, index:int):
+        type = self._types[index]
+        notenum = self._data1[index]
+        if type & EVENT_SKIP:
+            self._types[index] = type & ~EVENT_SKIP
+        elif type == EVENT_NOTE_ON:
+            self._sounding[notenum >> 3] |= 1 << (notenum & 7)
+            if self._press: self._press(notenum, self._data2[index] / 127)
+        elif type == EVENT_NOTE_OFF:
+            if self._sounding[notenum >> 3] & (1 << (notenum & 7)):
+                self._sounding[notenum >> 3] &= ~(1 << (notenum & 7))
+                if self._release: self._release(notenum)
+        elif type == EVENT_CONTROL_CHANGE:
+            if self._control: self._control(notenum, self._data2[index])
+    def release_all(self):
+        for i in range(len(self._sounding)):
+            if self._sounding[i]:
+                for j in range(8):
+                    if self._sounding[i] & (1 << j):
+                        if self._release: self._release((i << 3) | j)
+                self._sounding[i] = 0
+    def advance(self, elapsed:int):
+        # Play events up to the given ms since the start of the loop and wrap around at its end
+        while self._index < self._count and self._next <= elapsed:
+            self._dispatch(self._index)
+            self._index += 1
+            if self._index < self._count:
+                self._next += self._deltas[self._index]
+        if elapsed >= self._length:
+            self.release_all() # Notes held over the end of the recording
+            if elapsed >= self._length * 2:
+                self._start = ticks_ms() # Fell too far behind, restart timing
+            else:
+                self._start = ticks_add(self._start, self._length)
+            self._index = 0
+            self._next = self._deltas[0] if self._count else 0
+    def update(self):
+        if self._mode != LOOP_PLAY and self._mode != LOOP_OVERDUB:
+            return
+        self.advance(ticks_diff(ticks_ms(), self._start))
+
+    # Standard MIDI files
+    def write(self, name:str, dir:str="/phrases", writer:FileWriter=None) -> bool:
+        # Queues the phrase on writer if given, otherwise writes it before returning
+        if not self._length:
+            return False
+        path = "{}/{}.mid".format(dir, name)
+        track = bytearray(b"\x00\xff\x51\x03") + struct.pack(">L", SMF_TEMPO)[1:]
+        sounding = bytearray(16)
+        delta = 0
+        for i in range(self._count):
+            delta += self._deltas[i]
+            type = self._types[i] & ~EVENT_SKIP
+            if type == EVENT_NONE:
+                continue
+            notenum = self._data1[i]
+            if type == EVENT_NOTE_ON:
+                sounding[notenum >> 3] |= 1 << (notenum & 7)
+            elif type == EVENT_NOTE_OFF:
+                sounding[notenum >> 3] &= ~(1 << (notenum & 7))
+            append_vlq(track, delta)
+            track.append(type)
+            track.append(notenum)
+            track.append(self._data2[i])
+            delta = 0
+        # Release notes held over the end of the loop
+        delta += self._length - self._duration
+        for notenum in range(128):
+            if sounding[notenum >> 3] & (1 << (notenum & 7)):
+                append_vlq(track, delta)
+                track.extend(bytes((EVENT_NOTE_OFF, notenum, 0)))
+                delta = 0
+        append_vlq(track, delta)
+        track.extend(b"\xff\x2f\x00")
+        try:
+            check_dir(dir)
+        except:
+            print("Failed to write phrase file: {}".format(path))
+            return False
+        data = b"MThd" + struct.pack(">LHHH", 6, 0, 1, SMF_DIVISION) + b"MTrk" + struct.pack(">L", len(track)) + track
+        return write_file(path, data, "phrase", writer)
+    def _parse(self, data:bytes, offset:int, division:int, insert:bool=True) -> int:
+        # Parses the track chunks from offset and returns the end time of the phrase. Raises IndexError, ValueError or
+        # struct.error if the data is truncated or malformed, events are only inserted when insert is set.
+        end = 0
+        initial_tempo = None
+        while offset + 8 <= len(data):
+            chunk_length = struct.unpack_from(">L", data, offset + 4)[0]
+            start, offset = offset + 8, min(offset + 8 + chunk_length, len(data))
+            if data[start-8:start-4] != b"MTrk":
+                continue
+            tempo = initial_tempo or SMF_TEMPO
+            ticks, base_ticks, base_time, status = 0, 0, 0, 0
+            position = start
+            while position < offset:
+                delta, position = read_vlq(data, position)
+                ticks += delta
+                time = base_time + (ticks - base_ticks) * tempo // (division * 1000)
+                if data[position] & 0x80:
+                    status = data[position]
+                    position += 1
+                if not status:
+                    break # Data without a running status
+                if status == 0xff:
+                    meta = data[position]
+                    size, position = read_vlq(data, position + 1)
+                    if meta == 0x51 and size == 3:
+                        base_ticks, base_time = ticks, time
+                        tempo = (data[position] << 16) | (data[position+1] << 8) | data[position+2]
+                        if initial_tempo is None:
+                            initial_tempo = tempo
+                    elif meta == 0x2f:
+                        end = max(end, time)
+                    position += size
+                    status = 0
+                elif status == 0xf0 or status == 0xf7:
+                    size, position = read_vlq(data, position)
+                    position += size
+                    status = 0
+                elif status & 0xe0 == 0xc0: # Program change and channel pressure
+                    position += 1
+                else:
+                    type = status & 0xf0
+                    data1, data2 = data[position], data[position+1]
+                    if type == EVENT_NOTE_ON and not data2:
+                        type = EVENT_NOTE_OFF
+                    if insert and (type == EVENT_NOTE_ON or type == EVENT_NOTE_OFF or type == EVENT_CONTROL_CHANGE):
+                        self._insert(time, type, data1, data2)
+                    position += 2
+        return end
+    def read(self, name:str, dir:str="/phrases") -> bool:
+        # Reads note and control change events of every track in format 0 or 1 files. Tempo changes are followed
+        # within the track they appear in, later tracks start at the tempo of the first.
+        path = "{}/{}.mid".format(dir, name)
+        try:
+            with open(find_file(path) or path, "rb") as file:
+                data = file.read()
+        except:
+            return False
+        if len(data) < 14 or data[0:4] != b"MThd":
+            print("Failed to read phrase file: {}".format(path))
+            return False
+        length, format, tracks, division = struct.unpack_from(">LHHH", data, 4)
+        if format > 1 or not division or division & 0x8000: # SMPTE time isn't supported
+            print("Failed to read phrase file: {}".format(path))
+            return False
+        # Validate the whole file first so that a truncated or malformed one leaves the current loop and mode as they are
+        try:
+            self._parse(data, 8 + length, division, False)
+        except (IndexError, ValueError, struct.error):
+            print("Failed to read phrase file, truncated or malformed: {}".format(path))
+            return False
+        mode = self._mode
+        self.set_mode(LOOP_STOP)
+        self.clear()
+        end = self._parse(data, 8 + length, division)
+        self._length = max(end, self._duration) if self._count else 0
+        print("Successfully read phrase file: {}".format(path))
+        if mode == LOOP_PLAY or mode == LOOP_OVERDUB:
+            self.set_mode(mode)
+        return True
+
+class LooperMenuGroup(MenuGroup):
+    def __init__(self, looper:Looper, group:str="Loop"):
+        MenuGroup.__init__(self, (
+            PatternMenuItem("Mode", looper.get_mode, looper.set_mode, maximum=3, labels=("Stop", "Record", "Play", "Overdub")),
+            PatternMenuItem("Quantize", looper.get_quantize, looper.set_quantize, maximum=len(QUANTIZE_DIVISIONS)-1, labels=("Off", "1/8", "1/16", "1/32")),
+            PatternMenuItem("BPM", looper.get_bpm, looper.set_bpm, minimum=40, maximum=240),
+        ), group)
@@ -0,0 +1,230 @@
+# pcolamakerfaire2023 - memory.py
+# 2023 Cooper Dalrymple - me@dcdalrymple.com
+# GPL v3 License
+
+import gc, time
+from array import array
+from menu import MenuItem
+from pico_synth_sandbox.display import Display
+
+# Heap statistics are only available on the device
+if hasattr(gc, "mem_alloc"):
+    mem_alloc = gc.mem_alloc
+    mem_free = gc.mem_free
+else:
+    mem_alloc = lambda : 0
+    mem_free = lambda : 0
+
+class MemoryTracker:
+    def __init__(self, size:int=8, phases:int=12, dump_interval:float=0.0):
+        self._heap = mem_alloc() + mem_free()
+
+        # Heap use at each boot phase
+        self._phase_names = []
+        self._phase_allocated = array("L", [0] * phases)
+
+        # Allocation attributed to each subsystem between begin and end
+        self._subsystem_names = []
+        self._subsystem_bytes = array("l", [0] * size)
+        self._subsystem_start = array("L", [0] * size)
+
+        # Allocation within each watched task
+        self._names = []
+        self._counts = array("L", [0] * size)
+        self._allocating = array("L", [0] * size)
+        self._totals = array("Q", [0] * size)
+        self._maximums = array("L", [0] * size)
+        self._flags = bytearray(size)
+
+        # Collections are detected by a decrease of allocated heap between watched calls
+        self._gc_count = 0
+        self._last = mem_alloc()
+        self._low = self._heap - self._last
+
+        self._dump_interval = int(dump_interval * 1000000000)
+        self._dump_last = time.monotonic_ns()
+
+    def get_heap_size(self) -> int:
+        return self._heap
+    def get_free(self) -> int:
+        return mem_free()
+    def get_low_water(self) -> int:
+        # Least free heap observed by watched tasks
+        return self._low
+    def get_gc_count(self) -> int:
+        return self._gc_count
+
+    # Boot phases
+    def snapshot(self, phase:str):
+        if len(self._phase_names) >= len(self._phase_allocated):
+            return
+        allocated = mem_alloc()
+        self._phase_allocated[len(self._phase_names)] = allocated
+        self._phase_names.append(phase)
+        self._last = allocated
+    def get_phase_count(self) -> int:
+        return len(self._phase_names)
+    def get_phase(self, index:int) -> tuple:
+        # Returns (name, allocated, free, increase from the previous phase)
+        allocated = self._phase_allocated[index]
+        previous = self._phase_allocated[index-1] if index else allocated
+        return (self._phase_names[index], allocated, self._heap - allocated, allocated - previous)
+
+    # Subsystems
+    def begin(self, name:str) -> int:
+        index = -1
+        for i in range(len(self._subsystem_names)):
+            if self._subsystem_names[i] == name:
+                index = i
+                break
+        else:
+            if len(self._subsystem_names) >= len(self._subsystem_bytes):
+                return -1
+            self._subsystem_names.append(name)
+            index = len(self._subsystem_names) - 1
+        self._subsystem_start[index] = mem_alloc()
+        return index
+    def end(self, index:int, accumulate:bool=True) -> int:
+        # Adds the change of allocated heap since begin to the subsystem (negative if a collection freed more), or
+        # replaces it for buffers which are reloaded
+        if index < 0:
+            return 0
+        allocated = mem_alloc()
+        change = allocated - self._subsystem_start[index]
+        if accumulate:
+            self._subsystem_bytes[index] += change
+        else:
+            self._subsystem_bytes[index] = change
+        self._last = allocated
+        return change
+    def measure(self, name:str, callback:function, *args):
+        index = self.begin(name)
+        result = callback(*args)
+        self.end(index)
+        return result
+    def get_subsystem_count(self) -> int:
+        return len(self._subsystem_names)
+    def get_subsystem(self, index:int) -> tuple:
+        return (self._subsystem_names[index], self._subsystem_bytes[index])
+
+    # Tasks
+    def _register(self, name:str, flag:bool) -> int:
+        if len(self._names) >= len(self._counts):
+            return -1
+        self._names.append(name)
+        self._flags[len(self._names) - 1] = 1 if flag else 0
+        return len(self._names) - 1
+
+    def watch(self, name:str, obj, method:str="update", flag:bool=False) -> bool:
+        # Flagged tasks are expected not to allocate and report each new maximum allocation over serial
+        if not hasattr(obj, method):
+            return False
+        index = self._register(name, flag)
+        if index < 0:
+            return False
+        setattr(obj, method, self._wrap(index, getattr(obj, method)))
+        return True
+    def watch_tasks(self, tasks:tuple[tuple], flag:tuple=()):
+        for task in tasks:
+            self.watch(task[0], task[1], flag=task[0] in flag)
+    def wrap(self, name:str, callback:function, flag:bool=True) -> function:
+        index = self._register(name, flag)
+        if index < 0:
+            return callback
+        return self._wrap(index, callback)
+    def _wrap(self, index:int, callback:function) -> function:
+        def wrapper(*args):
+            start = mem_alloc()
+            result = callback(*args)
+            self._record(index, start, mem_alloc())
+            return result
+        return wrapper
+
+    def _record(self, index:int, start:int, end:int):
+        if start < self._last:
+            self._gc_count += 1
+        self._counts[index] += 1
+        if end > start:
+            size = end - start
+            self._allocating[index] += 1
+            self._totals[index] += size
+            if size > self._maximums[index]:
+                self._maximums[index] = size
+                if self._flags[index]:
+                    print("memory: {} allocated {:d} bytes".format(self._names[index], size))
+        elif end < start:
+            self._gc_count += 1 # Collected during the call
+        self._last = end
+        if self._heap - end < self._low:
+            self._low = self._heap - end
+
+        if index == 0 and self._dump_interval:
+            now = time.monotonic_ns()
+            if now - self._dump_last >= self._dump_interval:
+                self._dump_last = now
+                self.dump()
+
+    def reset(self):
+        for i in range(len(self._counts)):
+            self._counts[i] = 0
+            self._allocating[i] = 0
+            self._totals[i] = 0
+            self._maximums[i] = 0
+        self._gc_count = 0
+        self._last = mem_alloc()
+        self._low = self._heap - self._last
+
+    def get_count(self) -> int:
+        return len(self._names)
+    def get_name(self, index:int) -> str:
+        return self._names[index]
+    def get_stats(self, index:int) -> tuple:
+        # Returns (calls, allocating calls, mean bytes per allocating call, maximum bytes)
+        count = self._allocating[index]
+        return (self._counts[index], count, self._totals[index] // count if count else 0, self._maximums[index])
+
+    def dump(self):
+        print("{:<10} {:>8} {:>8} {:>8}".format("phase", "alloc", "free", "change"))
+        for i in range(len(self._phase_names)):
+            print("{:<10} {:>8d} {:>8d} {:>+8d}".format(*self.get_phase(i)))
+        print("{:<10} {:>8}".format("subsystem", "bytes"))
+        for i in range(len(self._subsystem_names)):
+            print("{:<10} {:>8d}".format(*self.get_subsystem(i)))
+        print("{:<10} {:>8} {:>8} {:>8} {:>8}".format("task", "calls", "alloc", "mean b", "max b"))
+        for i in range(len(self._names)):
+            print("{:<10} {:>8d} {:>8d} {:>8d} {:>8d}{}".format(self._names[i], *self.get_stats(i), " !" if self._flags[i] and self._maximums[i] else ""))
+        print("free {:d}, low {:d}, gc {:d}".format(mem_free(), self._low, self._gc_count))
+
+class MemoryMenuItem(MenuItem):
+    def __init__(self, tracker:MemoryTracker, title:str="Memory"):
+        MenuItem.__init__(self, title)
+        self._tracker = tracker
+        self._index = 0 # Pages of free heap, then subsystems, then tasks
+    def _get_page_count(self) -> int:
+        return 1 + self._tracker.get_subsystem_count() + self._tracker.get_count()
+    def adjust(self, steps:int, accelerated:int=None) -> bool:
+        self._index = (self._index + steps) % self._get_page_count()
+        return True
+    def increment(self) -> bool:
+        return self.adjust(1)
+    def decrement(self) -> bool:
+        return self.adjust(-1)
+    def reset(self) -> bool:
+        self._tracker.reset()
+        return True
+    def draw(self, display:Display):
+        index = self._index
+        if not index:
+            display.write("free", (8,0), 8, True)
+            display.write("{:d}K gc{:d}".format(self._tracker.get_free() // 1024, self._tracker.get_gc_count()), (0,1))
+            return
+        index -= 1
+        if index < self._tracker.get_subsystem_count():
+            name, size = self._tracker.get_subsystem(index)
+            display.write(name, (8,0), 8, True)
+            display.write("{:d}b".format(size), (0,1))
+            return
+        index -= self._tracker.get_subsystem_count()
+        stats = self._tracker.get_stats(index)
+        display.write(self._tracker.get_name(index), (8,0), 8, True)
+        display.write("{:d}x {:d}b".format(stats[1], stats[3]), (0,1))
@@ -2,7 +2,8 @@
 # 2023 Cooper Dalrymple - me@dcdalrymple.com
 # GPL v3 License
 
-import time, os, json, math
+import time, os, json, math, struct
+from array import array
 import ulab.numpy as numpy
 from pico_synth_sandbox import clamp, map_value, unmap_value, check_dir, get_filter_frequency_range
 from pico_synth_sandbox.display import Display
@@ -10,6 +11,7 @@ from pico_synth_sandbox.encoder import Encoder
 from pico_synth_sandbox.voice import Voice, AREnvelope
 from pico_synth_sandbox.voice.oscillator import Oscillator
 import pico_synth_sandbox.waveform as waveform
+from writer import FileWriter, TEMP_SUFFIX, is_writable, write_file, find_file
 
 def apply_value(items:tuple, method:function|str, offset:float=0.0) -> function:
     if type(method) is str:
@@ -19,6 +21,148 @@ def apply_value(items:tuple, method:function|str, offset:float=0.0) -> function:
     else:
         return lambda value : [method(items[i], value) for i in range(len(items))]
 
+_quantize_buffer = array("f", [0.0])
+def quantize_value(value:float) -> float:
+    _quantize_buffer[0] = value
+    return _quantize_buffer[0]
+
+class ParameterStore:
+    def __init__(self, size:int=1):
+        self._values = array("f", [0.0] * size)
+        self._staged = array("f", [0.0] * size)
+        self._dirty = bytearray(size)
+        self._history = None
+    def __len__(self) -> int:
+        return len(self._values)
+    def get(self, index:int) -> float:
+        return self._values[index]
+    def set(self, index:int, value:float) -> bool:
+        previous = self._values[index]
+        self._values[index] = value
+        if self._values[index] == previous:
+            return False
+        if self._history:
+            self._history.record(index, previous)
+        return True # Indicate whether value changed
+    def stage(self, index:int, value:float) -> bool:
+        self._staged[index] = value
+        self._dirty[index] = 1 if self._staged[index] != self._values[index] else 0
+        return self._dirty[index] == 1
+    def get_staged(self, index:int) -> float:
+        return self._staged[index]
+    def is_dirty(self, index:int) -> bool:
+        return self._dirty[index] == 1
+    def clear(self, index:int=None):
+        if index is None:
+            for i in range(len(self._dirty)):
+                self._dirty[i] = 0
+        else:
+            self._dirty[index] = 0
+    def dump(self) -> array:
+        return array("f", self._values)
+    def set_history(self, history):
+        self._history = history
+
+# Encoder acceleration as (maximum detent interval in seconds, step multiplier)
+ENCODER_ACCELERATION = ((0.015, 8), (0.04, 4), (0.08, 2))
+ENCODER_ACCELERATION_THRESHOLD = 32 # Minimum number of steps within an item's range to apply acceleration
+FRAME_INTERVAL = 1/30
+MESSAGE_DURATION = 0.5 # Seconds a save result is shown before the menu returns
+
+# Binary patch format: header followed by little-endian float32 parameter values
+PATCH_MAGIC = b"PSP1"
+PATCH_HEADER = "<4sIHH" # magic, schema fingerprint, parameter count, reserved
+PATCH_HEADER_SIZE = struct.calcsize(PATCH_HEADER)
+
+def encode_patch(values:array, fingerprint:int) -> bytes:
+    return struct.pack(PATCH_HEADER, PATCH_MAGIC, fingerprint, len(values), 0) + bytes(values)
+
+def decode_patch(data:bytes) -> tuple:
+    if len(data) < PATCH_HEADER_SIZE:
+        return (None, None)
+    magic, fingerprint, count, reserved = struct.unpack_from(PATCH_HEADER, data)
+    if magic != PATCH_MAGIC or len(data) < PATCH_HEADER_SIZE + count * 4:
+        return (None, None)
+    values = array("f", data[PATCH_HEADER_SIZE:PATCH_HEADER_SIZE + count * 4])
+    return (values, fingerprint)
+
+def pack_patch(values:array, fingerprint:int) -> dict:
+    return {"schema": fingerprint, "values": list(values)}
+
+def unpack_patch(data:dict|list|tuple) -> tuple:
+    # Returns flat values and the schema fingerprint, if any, from decoded JSON patch data
+    if type(data) is dict:
+        return (data.get("values"), data.get("schema"))
+    if type(data) is tuple or type(data) is list:
+        return (flatten_values(data), None) # Supports nested patch data from previous versions
+    return (None, None)
+
+def get_fingerprint(schema:tuple) -> int:
+    # 32-bit FNV-1a hash of parameter layout
+    result = 0x811c9dc5
+    for parameter in schema:
+        for c in "{}|{}|{:.4f}|{:.4f}|{:.4f};".format(parameter[0], parameter[1], parameter[2], parameter[3], parameter[4]).encode():
+            result = ((result ^ c) * 0x01000193) & 0xffffffff
+    return result
+
+def flatten_values(data:tuple|list, values:list=None) -> list:
+    if values is None:
+        values = []
+    for value in data:
+        if type(value) is tuple or type(value) is list:
+            flatten_values(value, values)
+        elif not value is None:
+            values.append(value)
+    return values
+
+def _before_wavetable(schema:tuple) -> tuple:
+    # Oscillator groups gained the TABLE waveform and its Position parameter after the waveform
+    result = []
+    table = False
+    for parameter in schema:
+        if table and parameter[0].endswith("/Position"):
+            table = False
+            continue
+        table = parameter[1] == "WaveformMenuItem" and parameter[3] == 6
+        if table:
+            parameter = parameter[:3] + (5,) + parameter[4:]
+        result.append(parameter)
+    return tuple(result)
+
+def _before_sampler_channel(schema:tuple) -> tuple:
+    # The sampler's MIDI channel range briefly went up to 16 like the other programs
+    return tuple(parameter[:3] + (16,) + parameter[4:] if parameter[0] == "MIDI/Channel" and parameter[3] == 15 else parameter for parameter in schema)
+
+def _before_arpeggiator(schema:tuple) -> tuple:
+    # The synth programs gained the Arp group after the oscillators, this is the layout of the original programs
+    return tuple(parameter for parameter in schema if not parameter[0].startswith("Arp/"))
+
+# Revisions of the parameter layout, newest first. Each returns the schema before the revision from the schema after
+# it, so that patches written for an earlier layout can be moved to the current one by parameter path.
+LAYOUT_REVISIONS = (_before_sampler_channel, _before_wavetable, _before_arpeggiator)
+
+def remap_patch(schema:tuple, data:array|list, fingerprint:int=None) -> array:
+    # Returns the values of a patch written for an earlier layout in the order of schema, or None if its layout isn't
+    # known. Patches without a fingerprint are matched by their number of values.
+    previous = schema
+    for revision in LAYOUT_REVISIONS:
+        previous = revision(previous)
+        if len(previous) != len(data) or previous == schema:
+            continue
+        if fingerprint is None or fingerprint == get_fingerprint(previous):
+            break
+    else:
+        return None
+    indexes = {}
+    for i in range(len(previous)):
+        indexes[previous[i][0]] = i
+    values = array("f", [parameter[5] for parameter in schema]) # Parameters added since keep their initial value
+    for i in range(len(schema)):
+        index = indexes.get(schema[i][0])
+        if not index is None:
+            values[i] = data[index]
+    return values
+
 class MenuItem:
     def __init__(self, title:str="", group:str=""):
         self._title = title
@@ -38,6 +182,8 @@ class MenuItem:
         return False # Indicate whether to redraw
     def decrement(self) -> bool:
         return False # Indicate whether to redraw
+    def adjust(self, steps:int, accelerated:int=None) -> bool:
+        return False # Indicate whether to redraw
     def reset(self) -> bool:
         return False # Indicate whether to redraw
     def is_enabled(self) -> bool:
@@ -58,57 +204,81 @@ class MenuItem:
         pass
     def get_cursor_position(self) -> tuple:
         return (0,1)
+    def get_parameters(self, parameters:list, paths:list=None, prefix:str="") -> list:
+        return parameters
 
 class NumberMenuItem(MenuItem):
     def __init__(self, title:str="", group:str="", step:float=0.1, initial:float=0.0, minimum:float=0.0, maximum:float=1.0, loop:bool=False, update:function=None):
         MenuItem.__init__(self, title, group)
         self._step = step
-        self._initial = initial
-        self._value = initial
-        self._minimum = minimum
-        self._maximum = maximum
+        self._initial = quantize_value(initial)
+        self._minimum = quantize_value(minimum)
+        self._maximum = quantize_value(maximum)
         self._loop = loop
         self._update = update
+        self._changed = None
+        self._store = ParameterStore(1)
+        self._index = 0
+        self._store.set(self._index, initial)
+    def bind(self, store:ParameterStore, index:int):
+        store.set(index, self._get_value())
+        self._store = store
+        self._index = index
+    def get_parameters(self, parameters:list, paths:list=None, prefix:str="") -> list:
+        parameters.append(self)
+        if not paths is None:
+            paths.append(prefix + self._title)
+        return parameters
+    def get_schema(self) -> tuple:
+        return (type(self).__name__, self._minimum, self._maximum, self._step, self._initial)
     def get(self) -> float:
-        return self._value
+        return self._get_value()
     def get_relative(self) -> float:
-        return unmap_value(self._value, self._minimum, self._maximum)
+        return unmap_value(self._get_value(), self._minimum, self._maximum)
+    def get_step_index(self) -> int:
+        return round((self._get_value() - self._minimum) / self._step)
+    def get_step_value(self, index:int) -> float:
+        # Value returned by get at the given step of the item's grid
+        return min(self._minimum + index * self._step, self._maximum)
     def set(self, value:float):
         if not type(value) is float and not type(value) is int:
             return
-        value = clamp(value, self._minimum, self._maximum)
-        if self._value != value:
-            self._value = value
-            self._do_update()
+        if value != value: # NaN
+            return
+        self._set_value(clamp(value, self._minimum, self._maximum))
     def increment(self) -> bool:
-        if self._value == self._maximum:
-            if self._loop:
-                self._value = self._minimum
-            else:
-                return False
-        else:
-            self._value = min(self._value + self._step, self._maximum)
-        self._do_update()
-        return True
+        return self.adjust(1)
     def decrement(self) -> bool:
-        if self._value == self._minimum:
-            if self._loop:
-                self._value = self._maximum
-            else:
-                return False
+        return self.adjust(-1)
+    def adjust(self, steps:int, accelerated:int=None) -> bool:
+        if not accelerated is None and (self._maximum - self._minimum) / self._step >= ENCODER_ACCELERATION_THRESHOLD:
+            steps = accelerated
+        if not steps:
+            return False
+        value = self._get_value()
+        if self._loop:
+            span = self._maximum - self._minimum + self._step
+            value = self._minimum + (value - self._minimum + steps * self._step) % span
+            value = min(value, self._maximum)
         else:
-            self._value = max(self._value - self._step, self._minimum)
-        self._do_update()
-        return True
+            value = clamp(value + steps * self._step, self._minimum, self._maximum)
+        return self._set_value(value)
     def reset(self) -> bool:
-        if self._value == self._initial:
-            return False
-        self._value = self._initial
-        return True
+        return self._set_value(self._initial)
     def draw(self, display:Display):
-        display.write(self._value, (0,1))
+        display.write(self._get_value(), (0,1))
     def set_update(self, callback:function):
         self._update = callback
+    def set_changed(self, callback:function):
+        self._changed = callback
+    def _get_value(self) -> float:
+        return self._store.get(self._index)
+    def _set_value(self, value:float) -> bool:
+        if not self._store.set(self._index, value):
+            return False
+        self._do_update()
+        if self._changed: self._changed()
+        return True
     def _do_update(self):
         if self._update: self._update(self.get())
 
@@ -119,9 +289,11 @@ class RampNumberMenuItem(NumberMenuItem):
         self._ramp_maximum = maximum
         self._ramp_smoothing = smoothing
     def get(self) -> float:
-        return map_value(math.pow(self._value, self._ramp_smoothing), self._ramp_minimum, self._ramp_maximum)
+        return map_value(math.pow(self._get_value(), self._ramp_smoothing), self._ramp_minimum, self._ramp_maximum)
     def get_relative(self) -> float:
-        return self._value
+        return self._get_value()
+    def get_step_value(self, index:int) -> float:
+        return map_value(math.pow(NumberMenuItem.get_step_value(self, index), self._ramp_smoothing), self._ramp_minimum, self._ramp_maximum)
 
 class BarMenuItem(NumberMenuItem):
     def __init__(self, title:str="", group:str="", step:float=1/16, initial:float=0.0, minimum:float=0.0, maximum:float=1.0, update:function=None):
@@ -132,7 +304,7 @@ class BarMenuItem(NumberMenuItem):
     def draw(self, display:Display):
         self.draw_bar(display)
     def draw_bar(self, display:Display, position=(0,1), length=16, centered=False):
-        display.write_horizontal_graph(self._value, self._minimum, self._maximum, position, length, centered)
+        display.write_horizontal_graph(self._get_value(), self._minimum, self._maximum, position, length, centered)
     def get_bar_position(self, x=0, length=16) -> int:
         return x+min(int(length*self.get_relative()),length-1)
 
@@ -141,22 +313,25 @@ class ListMenuItem(NumberMenuItem):
         NumberMenuItem.__init__(self, title, group, 1, 0, 0, len(items)-1, loop, update)
         self._items = items
     def get_item(self) -> str:
-        return self._items[int(self._value) % len(self._items)]
+        return self._items[int(self._get_value()) % len(self._items)]
     def draw(self, display:Display):
         display.write(self.get_item(), (0,1))
 
 class WaveformMenuItem(ListMenuItem):
-    def __init__(self, group:str="", update:function=None):
+    def __init__(self, group:str="", update:function=None, wavetable=None):
+        self._wavetable = wavetable
         ListMenuItem.__init__(
             self,
-            items=("SQUR", "SAWT", "TRNGL", "SINE", "NOISE", "SINN"),
+            items=("SQUR", "SAWT", "TRNGL", "SINE", "NOISE", "SINN") + (("TABLE",) if wavetable else ()),
             title="Waveform",
             group=group,
             update=update
         )
     def get_waveform(self):
-        value = int(self._value)
-        if value == 1:
+        value = int(self._get_value())
+        if value == 6:
+            return self._wavetable.get_waveform()
+        elif value == 1:
             return waveform.get_saw()
         elif value == 2:
             return waveform.get_triangle()
@@ -210,6 +385,12 @@ class MenuGroup(MenuItem):
     
     def get_current_item(self) -> MenuItem:
         return self._items[self._index]
+    def get_parameters(self, parameters:list, paths:list=None, prefix:str="") -> list:
+        if self._group:
+            prefix += self._group + "/"
+        for item in self._items:
+            item.get_parameters(parameters, paths, prefix)
+        return parameters
     
     def get(self) -> tuple:
         return tuple([item.get() for item in self._items])
@@ -242,6 +423,8 @@ class MenuGroup(MenuItem):
         return self.get_current_item().increment()
     def decrement(self) -> bool:
         return self.get_current_item().decrement()
+    def adjust(self, steps:int, accelerated:int=None) -> bool:
+        return self.get_current_item().adjust(steps, accelerated)
     def reset(self) -> bool:
         return self.get_current_item().reset()
     
@@ -262,7 +445,53 @@ class MenuGroup(MenuItem):
     def get_cursor_position(self) -> tuple:
         return self.get_current_item().get_cursor_position()
 
-class AREnvelopeMenuGroup(MenuGroup):
+# Vertical graph glyph lookup table, indexed by quantized level
+VERTICAL_GRAPH_LEVELS = 8
+VERTICAL_GRAPH_VALUES = tuple(i / (VERTICAL_GRAPH_LEVELS - 1) for i in range(VERTICAL_GRAPH_LEVELS))
+GRAPH_POSITIONS = tuple((i,1) for i in range(16))
+
+def get_vertical_graph_index(value:float) -> int:
+    return min(max(round(value * (VERTICAL_GRAPH_LEVELS - 1)), 0), VERTICAL_GRAPH_LEVELS - 1)
+
+class GraphMenuGroup(MenuGroup):
+    def __init__(self, items:tuple[NumberMenuItem], group:str=""):
+        MenuGroup.__init__(self, items, group)
+        self._levels = bytearray(16)
+        self._drawn = bytearray(16)
+        self._cursor = [(0,1)] * len(items)
+        self._valid = False
+        self._drawn_valid = False
+        for item in items:
+            item.set_changed(self._invalidate)
+    def _invalidate(self):
+        self._valid = False
+    def _calculate(self):
+        pass
+    def _refresh(self):
+        if not self._valid:
+            self._calculate()
+            self._valid = True
+    def _set_levels(self, start:int, count:int, a:float, b:float, reverse:bool=False):
+        # Fill columns with linear steps from a towards b, reaching b at the last column
+        for i in range(count):
+            value = a + (b - a) * ((i + 1) / count)
+            self._levels[start + (count - 1 - i if reverse else i)] = get_vertical_graph_index(value)
+    def enable(self, display:Display, last:bool = False):
+        MenuGroup.enable(self, display, last)
+        display.enable_vertical_graph()
+        self._drawn_valid = False
+    def draw(self, display:Display):
+        self._refresh()
+        for i in range(16):
+            if not self._drawn_valid or self._drawn[i] != self._levels[i]:
+                display.write_vertical_graph(VERTICAL_GRAPH_VALUES[self._levels[i]], position=GRAPH_POSITIONS[i])
+                self._drawn[i] = self._levels[i]
+        self._drawn_valid = True
+    def get_cursor_position(self) -> tuple:
+        self._refresh()
+        return self._cursor[self._index]
+
+class AREnvelopeMenuGroup(GraphMenuGroup):
     def __init__(self, envelopes:AREnvelope|tuple[AREnvelope], group:str=""):
         envelopes = tuple(envelopes)
         self._attack = NumberMenuItem(
@@ -283,39 +512,20 @@ class AREnvelopeMenuGroup(MenuGroup):
             step=0.05,
             update=apply_value(envelopes, AREnvelope.set_amount)
         )
-        MenuGroup.__init__(self, (self._attack, self._release, self._amount), group)
-    def enable(self, display:Display, last:bool = False):
-        MenuGroup.enable(self, display, last)
-        display.enable_vertical_graph()
-    def _get_attack_bars(self) -> int:
-        return round(map_value(self._attack.get_relative(), 1, 8))
-    def _get_release_bars(self) -> int:
-        return round(map_value(self._release.get_relative(), 1, 8))
-    def _get_amount_bars(self) -> int:
-        return 16 - (self._get_attack_bars() + self._get_release_bars())
-    def draw(self, display:Display):
-        attack_bars = self._get_attack_bars()
-        release_bars = self._get_release_bars()
+        GraphMenuGroup.__init__(self, (self._attack, self._release, self._amount), group)
+    def _calculate(self):
+        attack_bars = round(map_value(self._attack.get_relative(), 1, 8))
+        release_bars = round(map_value(self._release.get_relative(), 1, 8))
         amount_bars = 16 - (attack_bars + release_bars)
         amount = self._amount.get_relative()
-        for i in range(attack_bars):
-            display.write_vertical_graph(amount * ((i + 1) / attack_bars), position=(i,1))
-        if amount_bars:
-            for i in range(amount_bars):
-                display.write_vertical_graph(amount, position=(attack_bars+i,1))
-        for i in range(release_bars):
-            display.write_vertical_graph(amount * ((i + 1) / release_bars), position=(15-i,1))
-    def get_cursor_position(self) -> tuple:
-        x = 0
-        if self._attack.is_enabled():
-            x = self._get_attack_bars()/2
-        elif self._amount.is_enabled():
-            x = self._get_attack_bars() + self._get_amount_bars()/2
-        elif self._release.is_enabled():
-            x = 16 - self._get_release_bars()/2
-        return (round(x),1)
-
-class ADSREnvelopeMenuGroup(MenuGroup):
+        self._set_levels(0, attack_bars, 0.0, amount)
+        self._set_levels(attack_bars, amount_bars, amount, amount)
+        self._set_levels(16 - release_bars, release_bars, 0.0, amount, True)
+        self._cursor[0] = (round(attack_bars/2),1)
+        self._cursor[1] = (round(16 - release_bars/2),1)
+        self._cursor[2] = (round(attack_bars + amount_bars/2),1)
+
+class ADSREnvelopeMenuGroup(GraphMenuGroup):
     def __init__(self, voices:Oscillator|tuple[Oscillator], group:str=""):
         voices = tuple(voices)
         self._attack_time = NumberMenuItem(
@@ -348,61 +558,57 @@ class ADSREnvelopeMenuGroup(MenuGroup):
             maximum=2.0,
             update=apply_value(voices, Oscillator.set_envelope_release_time)
         )
-        MenuGroup.__init__(self, (
+        GraphMenuGroup.__init__(self, (
             self._attack_time,
             self._attack_level,
             self._decay_time,
             self._sustain_level,
             self._release_time
         ), group)
-    def enable(self, display:Display, last:bool = False):
-        MenuGroup.enable(self, display, last)
-        display.enable_vertical_graph()
-    def _get_attack_bars(self) -> int:
-        return round(map_value(self._attack_time.get_relative(), 1, 5))
-    def _get_decay_bars(self) -> int:
-        return round(map_value(self._decay_time.get_relative(), 1, 5))
-    def _get_release_bars(self) -> int:
-        return round(map_value(self._release_time.get_relative(), 1, 5))
-    def _get_sustain_bars(self) -> int:
-        return 16 - (self._get_attack_bars() + self._get_decay_bars() + self._get_release_bars())
-    def draw(self, display:Display):
-        attack_bars = self._get_attack_bars()
-        decay_bars = self._get_decay_bars()
-        release_bars = self._get_release_bars()
+    def _calculate(self):
+        attack_bars = round(map_value(self._attack_time.get_relative(), 1, 5))
+        decay_bars = round(map_value(self._decay_time.get_relative(), 1, 5))
+        release_bars = round(map_value(self._release_time.get_relative(), 1, 5))
         sustain_bars = 16 - (attack_bars + decay_bars + release_bars)
         attack_level = self._attack_level.get_relative()
         sustain_level = self._sustain_level.get_relative()
-        for i in range(attack_bars):
-            display.write_vertical_graph(
-                value = attack_level * ((i + 1) / attack_bars),
-                position = (i,1)
-            )
-        for i in range(decay_bars):
-            display.write_vertical_graph(
-                value = (attack_level - sustain_level) * ((i + 1) / decay_bars) + sustain_level,
-                position = (attack_bars+(decay_bars-1-i),1)
-            )
-        for i in range(attack_bars+decay_bars, attack_bars+decay_bars+sustain_bars):
-            display.write_vertical_graph(sustain_level, position=(i,1))
-        for i in range(release_bars):
-            display.write_vertical_graph(
-                value = sustain_level * ((i + 1) / release_bars),
-                position = (15-i,1)
-            )
-    def get_cursor_position(self) -> tuple:
-        x = 0
-        if self._attack_time.is_enabled():
-            x = self._get_attack_bars()/2
-        elif self._attack_level.is_enabled():
-            x = self._get_attack_bars()
-        elif self._decay_time.is_enabled():
-            x = self._get_attack_bars()+self._get_decay_bars()/2
-        elif self._sustain_level.is_enabled():
-            x = self._get_attack_bars()+self._get_decay_bars()+self._get_sustain_bars()/2
-        elif self._release_time.is_enabled():
-            x = 16 - self._get_release_bars()/2
-        return (round(x),1)
+        self._set_levels(0, attack_bars, 0.0, attack_level)
+        self._set_levels(attack_bars, decay_bars, sustain_level, attack_level, True)
+        self._set_levels(attack_bars+decay_bars, sustain_bars, sustain_level, sustain_level)
+        self._set_levels(16 - release_bars, release_bars, 0.0, sustain_level, True)
+        self._cursor[0] = (round(attack_bars/2),1)
+        self._cursor[1] = (attack_bars,1)
+        self._cursor[2] = (round(attack_bars+decay_bars/2),1)
+        self._cursor[3] = (round(attack_bars+decay_bars+sustain_bars/2),1)
+        self._cursor[4] = (round(16 - release_bars/2),1)
+
+class LabelCache:
+    # Bounded cache of formatted labels for a number item, keyed by the index of its value on the step grid. Slots are
+    # direct-mapped so that redraws of a previously rendered value reuse its string rather than formatting a new one.
+    def __init__(self, item:NumberMenuItem, format:function, size:int=32):
+        self._item = item
+        self._format = format
+        self._keys = array("l", [-1] * size)
+        self._labels = [""] * size
+    def get(self) -> str:
+        index = self._item.get_step_index()
+        slot = index % len(self._keys)
+        if self._keys[slot] != index:
+            self._labels[slot] = self._format(self._item.get_step_value(index))
+            self._keys[slot] = index
+        return self._labels[slot]
+
+def format_rate(value:float) -> str:
+    return "{:.1f}hz".format(value)
+def format_frequency(value:float) -> str:
+    range = get_filter_frequency_range()
+    return "{:d}hz".format(int(map_value(value, range[0], range[1])))
+def format_level(value:float) -> str:
+    return "-infdb" if value <= 0.0 else "{:.1f}db".format(math.log(value)*10.0)
+def format_semitones(value:float) -> str:
+    return "{:+d}".format(round(value*12)).replace("+0", "0")
+def format_seconds(value:float) -> str:
+    return "{:.1f}s".format(value).replace("0.", ".")
 
 class LFOMenuGroup(MenuGroup):
     def __init__(self, update_depth:function=None, update_rate:function=None, group:str=""):
@@ -422,17 +628,23 @@ class LFOMenuGroup(MenuGroup):
             self._depth,
             self._rate
         ), group)
+        self._depth_cursor = None
+        self._depth.set_changed(self._invalidate)
+        self._rate_label = LabelCache(self._rate, format_rate)
+    def _invalidate(self):
+        self._depth_cursor = None
     def enable(self, display:Display, last:bool = False):
         MenuGroup.enable(self, display, last)
         display.enable_horizontal_graph()
     def draw(self, display:Display):
         self._depth.draw_bar(display, (0,1), 10)
-        display.write("{:.1f}hz".format(self._rate.get()), position=(10,1), length=6, right_aligned=True)
+        display.write(self._rate_label.get(), position=(10,1), length=6, right_aligned=True)
     def get_cursor_position(self) -> tuple:
         if self._rate.is_enabled():
             return (10,1)
-        else:
-            return (self._depth.get_bar_position(10,6),1)
+        if self._depth_cursor is None:
+            self._depth_cursor = (self._depth.get_bar_position(10,6),1)
+        return self._depth_cursor
 
 class FilterMenuGroup(MenuGroup):
     def __init__(self, voices:Voice|tuple[Voice], group:str=""):
@@ -458,6 +670,7 @@ class FilterMenuGroup(MenuGroup):
             self._frequency,
             self._resonance
         ), group)
+        self._frequency_label = LabelCache(self._frequency, format_frequency)
     def enable(self, display:Display, last:bool = False):
         MenuGroup.enable(self, display, last)
         display.enable_horizontal_graph()
@@ -467,9 +680,8 @@ class FilterMenuGroup(MenuGroup):
             position=(0,1),
             length=2
         )
-        range = get_filter_frequency_range()
         display.write(
-            "{:d}hz".format(int(map_value(self._frequency.get(), range[0], range[1]))),
+            self._frequency_label.get(),
             position=(2,1),
             length=8,
             right_aligned=True
@@ -501,6 +713,7 @@ class MixMenuGroup(MenuGroup):
             self._level,
             self._pan
         ), group)
+        self._level_label = LabelCache(self._level, format_level, 33)
     def enable(self, display:Display, last:bool = False):
         MenuGroup.enable(self, display, last)
         display.enable_horizontal_graph()
@@ -508,7 +721,7 @@ class MixMenuGroup(MenuGroup):
         display.write('R', (15,1), 1)
     def draw(self, display:Display):
         display.write(
-            value="-infdb" if self._level.get() == 0.0 else "{:.1f}db".format(math.log(self._level.get())*10.0),
+            value=self._level_label.get(),
             position=(0,1),
             length=7,
             right_aligned=True
@@ -553,6 +766,8 @@ class TuneMenuGroup(MenuGroup):
             self._glide,
             self._bend
         ), group)
+        self._coarse_label = LabelCache(self._coarse, format_semitones, 49)
+        self._glide_label = LabelCache(self._glide, format_seconds, 11)
     def enable(self, display:Display, last:bool = False):
         MenuGroup.enable(self, display, last)
         display.enable_horizontal_graph()
@@ -562,14 +777,14 @@ class TuneMenuGroup(MenuGroup):
         display.write('+', (15,1), 1)
     def draw(self, display:Display):
         display.write(
-            value="{:+d}".format(int(self._coarse.get()*12)).replace("+0", "0"),
+            value=self._coarse_label.get(),
             position=(0,1),
             length=3,
             right_aligned=True
         )
         self._fine.draw_bar(display, (5,1), 2, True)
         display.write(
-            value="{:.1f}s".format(self._glide.get()).replace("0.", "."),
+            value=self._glide_label.get(),
             position=(8,1),
             length=4,
             right_aligned=True
@@ -603,8 +818,26 @@ class VoiceMenuGroup(MenuGroup):
         ), group)
 
 class OscillatorMenuGroup(MenuGroup):
-    def __init__(self, voices:Oscillator|tuple[Oscillator], group:str=""):
+    def __init__(self, voices:Oscillator|tuple[Oscillator], group:str="", wavetable=None):
         voices = tuple(voices)
+        if wavetable:
+            # The table position follows the waveform page
+            waveform_items = (
+                WaveformMenuItem(
+                    update=apply_value(voices, wavetable.set_waveform),
+                    wavetable=wavetable
+                ),
+                BarMenuItem(
+                    "Position",
+                    update=wavetable.set_position
+                ),
+            )
+        else:
+            waveform_items = (
+                WaveformMenuItem(
+                    update=apply_value(voices, Oscillator.set_waveform)
+                ),
+            )
         MenuGroup.__init__(self, (
             MixMenuGroup(
                 update_level=apply_value(voices, Oscillator.set_level),
@@ -618,9 +851,7 @@ class OscillatorMenuGroup(MenuGroup):
                 update_bend=apply_value(voices, Oscillator.set_pitch_bend_amount),
                 group="Tune"
             ),
-            WaveformMenuItem(
-                update=apply_value(voices, Oscillator.set_waveform)
-            ),
+        ) + waveform_items + (
             FilterMenuGroup(voices, "Filter"),
             ADSREnvelopeMenuGroup(
                 voices,
@@ -652,16 +883,47 @@ class OscillatorMenuGroup(MenuGroup):
             )
         ), group)
 
+class MenuDisplay(Display):
+    def __init__(self, board, update:function=None):
+        Display.__init__(self, board)
+        self._frame_update = update
+    def set_frame_update(self, callback:function):
+        self._frame_update = callback
+    def update(self):
+        if self._frame_update: self._frame_update()
+        Display.update(self)
+
 class Menu(MenuGroup):
     def __init__(self, board, items:tuple, group:str = "", write:function=None):
         MenuGroup.__init__(self, items, loop=True)
         self._group = group # avoids assigning group name
 
         self._write = write
+        self._history = None
+        self._writer = FileWriter()
+        self._writer.set_completed(self._write_completed)
+        self._saving = False
+        self._message_end = 0.0
+
+        # Bind all parameters to a single flat value store
+        parameters, paths = [], []
+        for item in self._items:
+            item.get_parameters(parameters, paths)
+        self._parameters = tuple(parameters)
+        self._paths = tuple(paths)
+        self._fingerprint = None
+        self._store = ParameterStore(len(self._parameters))
+        for i in range(len(self._parameters)):
+            self._parameters[i].bind(self._store, i)
 
-        self._display = Display(board)
+        self._display = MenuDisplay(board, self.update)
 
         self._selected = False
+        self._pending_steps = 0
+        self._pending_accelerated = 0
+        self._last_detent = 0.0
+        self._redraw = False
+        self._last_draw = 0.0
         if board.num_encoders() == 1:
             self._encoders = (Encoder(board),)
         elif board.num_encoders() > 1:
@@ -680,12 +942,19 @@ class Menu(MenuGroup):
         self.draw()
         self.enable()
 
+    def get_display(self) -> Display:
+        return self._display
+    def get_encoders(self) -> tuple[Encoder]:
+        return self._encoders
+
     def encoder_toggle(self):
         self._selected = not self._selected
         self.update_cursor_position()
     def encoder_reset(self):
         if not self._selected:
             self._selected = True
+        if self._history:
+            self._history.begin()
         if self.reset():
             self.draw()
     def encoder_next_group(self):
@@ -697,28 +966,63 @@ class Menu(MenuGroup):
             self.encoder_reset()
         else:
             self.encoder_next_group()
+    def encoder_undo(self):
+        self._apply_steps()
+        if self._history:
+            self._history.undo()
+    def encoder_redo(self):
+        self._apply_steps()
+        if self._history:
+            self._history.redo()
     def encoder_save(self):
+        # The patch is snapshotted immediately and written in chunks on following frames while other tasks keep running
+        self._apply_steps()
+        if self._saving or self._message_end:
+            return
         self.disable()
         self._display.clear()
+        if not is_writable():
+            self._show_message("Read-only!")
+            return
         self._display.write("Saving...")
-        self._display.update()
+        self._saving = True
         if self._write:
-            self._write()
+            queued = self._write()
         else:
-            self.write()
-        self._display.write("Complete!")
-        self._display.update()
-        time.sleep(0.5)
-        if self._selected:
-            self._selected = False
-        self.enable()
-        self.draw()
+            queued = self.write()
+        if not queued:
+            self._write_completed(1) # Nothing was queued, such as when the directory couldn't be created
+        elif not self._writer.is_busy():
+            self._write_completed(0)
+    def _write_completed(self, failures:int):
+        if not self._saving:
+            return
+        self._saving = False
+        self._show_message("Failed!" if failures else "Complete!")
+    def _show_message(self, text:str):
+        self._display.write(text)
+        self._message_end = time.monotonic() + MESSAGE_DURATION
+    def _queue_steps(self, direction:int):
+        now = time.monotonic()
+        if (direction > 0) != (self._pending_steps > 0):
+            # Direction changed, drop any pending steps in the opposite direction
+            self._pending_steps = 0
+            self._pending_accelerated = 0
+        multiplier = 1
+        interval = now - self._last_detent
+        for acceleration in ENCODER_ACCELERATION:
+            if interval < acceleration[0]:
+                multiplier = acceleration[1]
+                break
+        self._last_detent = now
+        self._pending_steps += direction
+        self._pending_accelerated += direction * multiplier
     def encoder_increment_value(self):
         if not self._selected:
             self._selected = True
-        if self.increment():
-            self.draw()
+        self._queue_steps(1)
     def encoder_increment_item(self):
+        self._apply_steps()
         if self._selected:
             self._selected = False
         self.next()
@@ -730,9 +1034,9 @@ class Menu(MenuGroup):
     def encoder_decrement_value(self):
         if not self._selected:
             self._selected = True
-        if self.decrement():
-            self.draw()
+        self._queue_steps(-1)
     def encoder_decrement_item(self):
+        self._apply_steps()
         if self._selected:
             self._selected = False
         self.previous()
@@ -746,7 +1050,7 @@ class Menu(MenuGroup):
         if len(self._encoders) == 1:
             self._encoders[0].set_click(self.encoder_toggle)
             self._encoders[0].set_double_click(self.encoder_double_click)
-            self._encoders[0].set_long_press(self.encoder_long_press)
+            self._encoders[0].set_long_press(self.encoder_save)
             self._encoders[0].set_increment(self.encoder_increment)
             self._encoders[0].set_decrement(self.encoder_decrement)
         else:
@@ -755,6 +1059,9 @@ class Menu(MenuGroup):
             self._encoders[0].set_increment(self.encoder_increment_item)
             self._encoders[0].set_decrement(self.encoder_decrement_item)
             self._encoders[1].set_long_press(self.encoder_reset)
+            if self._history:
+                self._encoders[1].set_click(self.encoder_undo)
+                self._encoders[1].set_double_click(self.encoder_redo)
             self._encoders[1].set_increment(self.encoder_increment_value)
             self._encoders[1].set_decrement(self.encoder_decrement_value)
         MenuGroup.enable(self, self._display)
@@ -780,6 +1087,82 @@ class Menu(MenuGroup):
         if not display: display=self._display
         MenuGroup.draw(self, display)
         self.update_cursor_position()
+        self._redraw = False
+        self._last_draw = time.monotonic()
+
+    def get_schema(self) -> tuple:
+        # (path, type, minimum, maximum, step, initial) of each parameter in patch order
+        return tuple((self._paths[i],) + self._parameters[i].get_schema() for i in range(len(self._parameters)))
+    def get_fingerprint(self) -> int:
+        if self._fingerprint is None:
+            self._fingerprint = get_fingerprint(self.get_schema())
+        return self._fingerprint
+    def get_paths(self) -> tuple[str]:
+        return self._paths
+    def get_parameter(self, index:int) -> NumberMenuItem:
+        return self._parameters[index]
+
+    def set_history(self, history):
+        # Records edits of parameters for undo and redo, see history.py
+        self._history = history
+        self._store.set_history(history)
+        if history:
+            history.set_menu(self)
+    def undo(self) -> int:
+        return self._history.undo() if self._history else 0
+    def redo(self) -> int:
+        return self._history.redo() if self._history else 0
+
+    def get(self) -> array:
+        return self._store.dump()
+    def get_value(self, index:int) -> float:
+        # Stored value of a parameter as in patches, which may differ from the value the item applies
+        return self._store.get(index)
+    def stage_value(self, index:int, value:float) -> bool:
+        return self._store.stage(index, value)
+    def stage(self, data:array|tuple|list):
+        if type(data) is tuple or type(data) is list:
+            data = flatten_values(data) # Supports nested patch data from previous versions
+        elif type(data) is dict:
+            data = unpack_patch(data)[0]
+            if data is None: return
+        for i in range(min(len(data), len(self._store))):
+            if type(data[i]) is float or type(data[i]) is int:
+                self._store.stage(i, data[i])
+    def set(self, data:array|tuple|list):
+        self.stage(data)
+        self.commit()
+        if self._history:
+            self._history.clear() # Edits of the previous patch no longer apply
+    def commit(self) -> int:
+        # Applies staged parameters, returning the number which changed
+        if self._history:
+            self._history.begin()
+        changed = 0
+        for i in range(len(self._store)):
+            if self._store.is_dirty(i):
+                self._store.clear(i)
+                self._parameters[i].set(self._store.get_staged(i))
+                changed += 1
+        return changed
+    def commit_steps(self, count:int=4):
+        # Generator which commits staged parameters in slices of count updates
+        if self._history:
+            self._history.begin()
+        applied = 0
+        for i in range(len(self._store)):
+            if self._store.is_dirty(i):
+                self._store.clear(i)
+                self._parameters[i].set(self._store.get_staged(i))
+                applied += 1
+                if not applied % count:
+                    yield
+    def set_steps(self, data:array|tuple|list, count:int=4):
+        self.stage(data)
+        yield
+        yield from self.commit_steps(count)
+        if self._history:
+            self._history.clear()
 
     def update_cursor_position(self):
         if not self._selected:
@@ -787,52 +1170,116 @@ class Menu(MenuGroup):
         else:
             self._display.set_cursor_position(self.get_cursor_position())
 
+    def _apply_steps(self):
+        # Apply all encoder steps received since the last frame as a single adjustment
+        if not self._pending_steps:
+            return
+        steps = self._pending_steps
+        accelerated = self._pending_accelerated
+        self._pending_steps = 0
+        self._pending_accelerated = 0
+        if self._history:
+            self._history.begin(True)
+        if self.adjust(steps, accelerated):
+            self._redraw = True
+    def redraw(self):
+        # Redraws the current item on the next frame, such as after parameters were changed other than by the encoders
+        self._redraw = True
     def update(self):
-        self._encoder.update()
+        self._writer.update()
+        if self._message_end:
+            if time.monotonic() < self._message_end:
+                return
+            self._message_end = 0.0
+            if self._selected:
+                self._selected = False
+            self.enable()
+            self.draw()
+        if self._saving:
+            return
+        self._apply_steps()
+        if self._redraw and time.monotonic() - self._last_draw >= FRAME_INTERVAL:
+            self.draw()
 
-    def write(self, name:str="", dir:str="/presets") -> bool:
+    def encode(self, binary:bool=False) -> bytes:
+        # Snapshot of the current patch in the binary or JSON preset format
+        data = self.get()
+        if binary:
+            return encode_patch(data, self.get_fingerprint())
+        return json.dumps(pack_patch(data, self.get_fingerprint())).encode()
+    def write(self, name:str="", dir:str="/presets", binary:bool=False, wait:bool=False) -> bool:
+        # Queues the patch on the menu's writer, or writes it before returning when waiting
         if not name: name = self._group
         if not name: return False
+        if not len(self._store): return False
 
-        data = self.get()
-        if not data: return False
-
-        path = "{}/{}.json".format(dir, name)
-
-        result = False
+        path = "{}/{}.{}".format(dir, name, "bin" if binary else "json")
         try:
             check_dir(dir)
-            with open(path, "w") as file:
-                json.dump(data, file)
-            print("Successfully written JSON file: {}".format(path))
-            result = True
         except:
-            print("Failed to write JSON file: {}".format(path))
-        return result
+            print("Failed to write patch file: {}".format(path))
+            return False
+        return write_file(path, self.encode(binary), "patch", None if wait else self._writer)
     def set_write(self, callback:function):
+        # Replaces write when saving, returns whether the patch was written or queued
         self._write=callback
+    def get_writer(self) -> FileWriter:
+        return self._writer
     
-    def read(self, name:str="", dir:str="/presets") -> bool:
+    def _load(self, name:str="", dir:str="/presets"):
         if not name: name = self._group
-        if not name: return False
+        if not name: return None
 
-        path = "{}/{}.json".format(dir, name)
-        try:
-            os.stat(path)
-        except:
-            print("Failed to read JSON file, doesn't exist: {}".format(path))
-            return False
+        # Binary patches are preferred over JSON when both are available
+        for binary in (True, False):
+            path = find_file("{}/{}.{}".format(dir, name, "bin" if binary else "json"))
+            if not path:
+                continue
 
-        data = None
-        try:
-            with open(path, "r") as file:
-                data = json.load(file)
-            print("Successfully read JSON file: {}".format(path))
-        except:
-            print("Failed to read JSON file: {}".format(path))
+            data, fingerprint = None, None
+            try:
+                if binary:
+                    with open(path, "rb") as file:
+                        data, fingerprint = decode_patch(file.read())
+                else:
+                    with open(path, "r") as file:
+                        data, fingerprint = unpack_patch(json.load(file))
+            except:
+                pass
+            if data is None:
+                print("Failed to read patch file: {}".format(path))
+                if path.endswith(TEMP_SUFFIX):
+                    continue # Interrupted before it was complete
+                return None
+
+            # Values are stored by position, so a patch for another layout would be applied to the wrong parameters
+            if (fingerprint is None and len(data) != len(self._parameters)) or (not fingerprint is None and fingerprint != self.get_fingerprint()):
+                values = remap_patch(self.get_schema(), data, fingerprint)
+                if not values is None:
+                    print("Successfully read patch file from an earlier layout: {}".format(path))
+                    return values
+                print("Failed to read patch file, written for a different parameter layout: {}".format(path))
+                return None
+
+            print("Successfully read patch file: {}".format(path))
+            return data
 
+        print("Failed to read patch file, doesn't exist: {}/{}".format(dir, name))
+        return None
+
+    def read(self, name:str="", dir:str="/presets") -> bool:
+        data = self._load(name, dir)
         if not data:
             return False
         
         self.set(data)
         return True
+    def read_steps(self, name:str="", dir:str="/presets", default:array=None, count:int=4):
+        # Generator version of read which loads the patch file and applies it in slices
+        data = self._load(name, dir)
+        if not data:
+            data = default
+        if not data:
+            return
+        yield
+        yield from self.set_steps(data, count)
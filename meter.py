@@ -0,0 +1,184 @@
+# pcolamakerfaire2023 - meter.py
+# 2023 Cooper Dalrymple - me@dcdalrymple.com
+# GPL v3 License
+
+import time, math
+import ulab.numpy as numpy
+from menu import Menu, MenuItem
+from pico_synth_sandbox.display import Display
+import pico_synth_sandbox.waveform as waveform
+
+METER_INTERVAL = 1/30 # Seconds between meter updates
+METER_DECIMATION = 8 # Every nth sample of a waveform is measured
+METER_FLOOR = -48.0 # dB shown at the bottom of the bar
+RELEASE_DECAY = 0.7 # Gain of a released voice per update, about -3dB
+PEAK_DECAY = 0.9 # Fall of the held peak per update
+AUTO_GAIN_HEADROOM = 0.9 # Peak the output is scaled to when auto-gain is enabled
+AUTO_GAIN_RECOVERY = 0.05 # Fraction of the way back up to the target gain per update
+AUTO_GAIN_THRESHOLD = 1/256 # Smallest change of gain applied to the audio driver
+
+def to_decibels(value:float) -> float:
+    return 20 * math.log(value, 10) if value > 0.0 else -math.inf
+
+def get_waveform_stats(data) -> tuple:
+    # (peak, rms) relative to full scale of a decimated block of the waveform
+    amplitude = waveform.get_amplitude()
+    block = numpy.array(data[::METER_DECIMATION], dtype=numpy.float) / amplitude
+    return (numpy.max(numpy.abs(block)), math.sqrt(numpy.mean(block * block)))
+
+class LevelMeter:
+    # The synthesizer's output isn't readable by programs, so the output level is modelled from what is known of each
+    # voice instead: the peak and RMS of a decimated block of its waveform, measured when the waveform changes, its
+    # level and the velocity of the note it plays. Released voices decay over a few updates. The peak assumes that
+    # voices are in phase, the worst case when oscillators are stacked, and the RMS that they are uncorrelated. All
+    # voices are computed together with vector operations at the display frame rate, and notes only set flags.
+    def __init__(self, audio, voices:tuple, auto_gain:bool=False, dump_interval:float=0.0):
+        self._audio = audio
+        self._voices = voices
+        count = len(voices)
+        self._waveforms = [None] * count
+        self._peaks = numpy.ones(count) # Of each voice's waveform
+        self._rms = numpy.ones(count)
+        self._velocities = numpy.zeros(count) # Of held notes, 0 when released
+        self._gains = numpy.zeros(count)
+        self._level = 1.0
+        self._auto_gain = auto_gain
+        self._gain = 1.0 # Applied by auto-gain
+        self._peak = 0.0
+        self._rms_level = 0.0
+        self._held_peak = 0.0
+        self._clipping = False
+        self._clips = 0
+        self._active = 0
+        self._last_update = 0.0
+        self._menu = None
+        self._item = None
+        self._dump_interval = dump_interval
+        self._dump_last = time.monotonic()
+
+    def set_menu(self, menu:Menu):
+        self._menu = menu
+    def set_item(self, item:MenuItem):
+        # Redrawn on every update while it is shown
+        self._item = item
+
+    # Note state, called on every press and release so these don't allocate
+    def press(self, index:int, velocity:float=1.0):
+        self._velocities[index] = velocity
+    def release(self, index:int=None):
+        if index is None:
+            for i in range(len(self._voices)):
+                self._velocities[i] = 0.0
+        else:
+            self._velocities[index] = 0.0
+
+    def get_level(self) -> float:
+        return self._level
+    def set_level(self, value:float):
+        # Output level chosen by the user, which auto-gain is applied on top of
+        self._level = value
+        self._audio.set_level(value * self._gain)
+    def get_gain(self) -> float:
+        return self._gain
+    def set_auto_gain(self, value:bool):
+        self._auto_gain = value
+        if not value:
+            self._gain = 1.0
+            self._audio.set_level(self._level)
+
+    def get_peak(self) -> float:
+        return self._peak
+    def get_held_peak(self) -> float:
+        return self._held_peak
+    def get_rms(self) -> float:
+        return self._rms_level
+    def get_clips(self) -> int:
+        return self._clips
+    def is_clipping(self) -> bool:
+        return self._clipping
+    def get_active(self) -> int:
+        return self._active
+    def reset(self):
+        self._clips = 0
+        self._held_peak = 0.0
+
+    def _measure_waveforms(self):
+        for i in range(len(self._voices)):
+            voice = self._voices[i]
+            if not hasattr(voice, "get_waveform"):
+                continue
+            data = voice.get_waveform()
+            if data is self._waveforms[i] or data is None:
+                continue
+            self._waveforms[i] = data
+            self._peaks[i], self._rms[i] = get_waveform_stats(data)
+
+    def update(self):
+        now = time.monotonic()
+        if now - self._last_update < METER_INTERVAL:
+            return
+        self._last_update = now
+        self._measure_waveforms()
+
+        levels = numpy.array([voice.get_level() if hasattr(voice, "get_level") else 1.0 for voice in self._voices])
+        targets = levels * self._velocities
+        self._gains = numpy.maximum(targets, self._gains * RELEASE_DECAY)
+        self._active = 0
+        for velocity in self._velocities:
+            if velocity > 0.0:
+                self._active += 1
+
+        # Level of the mix before the output level is applied
+        demand = numpy.sum(targets * self._peaks)
+        peak = numpy.sum(self._gains * self._peaks)
+        rms = math.sqrt(numpy.sum((self._gains * self._rms) ** 2))
+
+        if self._auto_gain:
+            target = min(1.0, AUTO_GAIN_HEADROOM / demand) if demand > 0.0 else 1.0
+            gain = target if target < self._gain else self._gain + (target - self._gain) * AUTO_GAIN_RECOVERY
+            if abs(gain - self._gain) >= AUTO_GAIN_THRESHOLD or (gain == 1.0 and self._gain != 1.0):
+                self._gain = gain
+                self._audio.set_level(self._level * gain)
+
+        output = self._level * self._gain
+        self._peak = peak * output
+        self._rms_level = rms * output
+        self._held_peak = max(self._peak, self._held_peak * PEAK_DECAY)
+        clipping = self._peak > 1.0
+        if clipping and not self._clipping:
+            self._clips += 1
+        self._clipping = clipping
+
+        if self._item and self._menu and self._item.is_enabled():
+            self._menu.redraw()
+        if self._dump_interval and now - self._dump_last >= self._dump_interval:
+            self._dump_last = now
+            self.dump()
+
+    def dump(self):
+        print("meter peak {:.1f}dB rms {:.1f}dB gain {:.2f} voices {:d} clips {:d}".format(
+            to_decibels(self._held_peak), to_decibels(self._rms_level), self._gain, self._active, self._clips
+        ))
+
+class MeterMenuItem(MenuItem):
+    # Held peak as a bar in dB with its value, or CLIP while the modelled output is above full scale. Resetting the
+    # item clears the clip count.
+    def __init__(self, meter:LevelMeter, title:str="Meter"):
+        MenuItem.__init__(self, title)
+        self._meter = meter
+        meter.set_item(self)
+    def enable(self, display:Display):
+        MenuItem.enable(self, display)
+        display.enable_horizontal_graph()
+    def reset(self) -> bool:
+        self._meter.reset()
+        return True
+    def draw(self, display:Display):
+        peak = to_decibels(self._meter.get_held_peak())
+        if self._meter.is_clipping():
+            display.write("CLIP", (10,0), 6, True)
+        elif peak < METER_FLOOR:
+            display.write("-inf", (10,0), 6, True)
+        else:
+            display.write("{:.1f}dB".format(peak), (10,0), 6, True)
+        display.write_horizontal_graph(max(peak, METER_FLOOR), METER_FLOOR, 0.0, (0,1), 16)
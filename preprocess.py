@@ -0,0 +1,81 @@
+# pcolamakerfaire2023 - preprocess.py
+# 2023 Cooper Dalrymple - me@dcdalrymple.com
+# GPL v3 License
+
+import ulab.numpy as numpy
+
+TRIM_THRESHOLD = 1/64 # Of the peak level, about -36dB
+BLOCK_SIZE = 256 # Output samples interpolated at a time, limiting temporary float arrays while resampling
+
+def trim(data:numpy.ndarray, threshold:float=TRIM_THRESHOLD) -> numpy.ndarray:
+    # Removes leading and trailing samples below the threshold, returning a view of the remaining samples
+    if not len(data):
+        return data
+    level = numpy.abs(data)
+    peak = numpy.max(level)
+    if not peak:
+        return data
+    loud = level > peak * threshold
+    start = numpy.argmax(loud)
+    end = len(data) - numpy.argmax(loud[::-1])
+    return data[start:end]
+
+def normalize(data:numpy.ndarray, amplitude:int) -> numpy.ndarray:
+    # Scales the peak of the sample to the given amplitude
+    if not len(data):
+        return data
+    peak = numpy.max(numpy.abs(data))
+    if not peak or peak == amplitude:
+        return data
+    return numpy.array(data * (amplitude / peak), dtype=numpy.int16)
+
+def find_loop(data:numpy.ndarray) -> tuple:
+    # Returns the first and last rising zero crossings as (start, end), so that data[start:end] loops without a click
+    if len(data) < 2:
+        return (0, len(data))
+    rising = numpy.diff(numpy.array(data >= 0, dtype=numpy.int8)) > 0
+    start = numpy.argmax(rising)
+    if not rising[start]:
+        return (0, len(data))
+    end = len(rising) - numpy.argmax(rising[::-1])
+    if end <= start + 1:
+        return (0, len(data))
+    return (start + 1, end)
+
+def resample(data:numpy.ndarray, sample_rate:int, target_rate:int, max_samples:int=None) -> numpy.ndarray:
+    # Linear interpolation to the target rate, one block of output samples at a time
+    length = int(len(data) * target_rate / sample_rate)
+    if max_samples is not None:
+        length = min(length, max_samples)
+    if sample_rate == target_rate or length < 2:
+        return data[:length]
+    step = sample_rate / target_rate
+    result = numpy.zeros(length, dtype=numpy.int16)
+    last = len(data) - 1
+    for i in range(0, length, BLOCK_SIZE):
+        count = min(BLOCK_SIZE, length - i)
+        positions = numpy.arange(i, i + count, dtype=numpy.float) * step
+        start = int(positions[0])
+        end = min(int(positions[-1]) + 2, last + 1)
+        window = numpy.array(data[start:end], dtype=numpy.float)
+        indices = numpy.arange(start, end, dtype=numpy.float)
+        result[i:i + count] = numpy.array(numpy.interp(positions, indices, window), dtype=numpy.int16)
+    return result
+
+def prepare_steps(data:numpy.ndarray, sample_rate:int, target_rate:int, amplitude:int, max_samples:int, loop:bool=False):
+    # Generator of the full preprocessing chain which yields between stages so that it can be run in slices. The last
+    # value yielded is the (data, sample_rate) tuple of the prepared sample. One-shot samples keep their attack and
+    # only end on a zero crossing.
+    data = trim(data)
+    yield
+    data = resample(data, sample_rate, target_rate, max_samples)
+    yield
+    data = normalize(data, amplitude)
+    yield
+    start, end = find_loop(data)
+    yield (data[start if loop else 0:end], target_rate)
+
+def prepare(data:numpy.ndarray, sample_rate:int, target_rate:int, amplitude:int, max_samples:int, loop:bool=False) -> tuple:
+    for result in prepare_steps(data, sample_rate, target_rate, amplitude, max_samples, loop):
+        pass
+    return result
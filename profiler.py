@@ -0,0 +1,146 @@
+# pcolamakerfaire2023 - profiler.py
+# 2023 Cooper Dalrymple - me@dcdalrymple.com
+# GPL v3 License
+
+import time
+from array import array
+from menu import MenuItem
+from pico_synth_sandbox.display import Display
+
+class Profiler:
+    def __init__(self, size:int=8, dump_interval:float=0.0):
+        self._names = []
+        self._counts = array("L", [0] * size)
+        self._totals = array("Q", [0] * size)
+        self._minimums = array("L", [0] * size)
+        self._maximums = array("L", [0] * size)
+
+        # Loop period is measured between consecutive runs of the first watched task
+        self._loop_count = 0
+        self._loop_total = 0
+        self._loop_minimum = 0
+        self._loop_maximum = 0
+        self._loop_last = 0
+
+        self._dump_interval = int(dump_interval * 1000000000)
+        self._dump_last = time.monotonic_ns()
+
+    def _register(self, name:str) -> int:
+        if len(self._names) >= len(self._counts):
+            return -1
+        self._names.append(name)
+        return len(self._names) - 1
+
+    def watch(self, name:str, obj, method:str="update") -> bool:
+        if not hasattr(obj, method):
+            return False
+        index = self._register(name)
+        if index < 0:
+            return False
+        callback = getattr(obj, method)
+        def update():
+            start = time.monotonic_ns()
+            result = callback()
+            self._record(index, start, time.monotonic_ns())
+            return result
+        setattr(obj, method, update)
+        return True
+    def watch_tasks(self, tasks:tuple[tuple]):
+        for task in tasks:
+            self.watch(task[0], task[1])
+    def wrap(self, name:str, callback:function) -> function:
+        index = self._register(name)
+        if index < 0:
+            return callback
+        def wrapper(*args):
+            start = time.monotonic_ns()
+            result = callback(*args)
+            self._record(index, start, time.monotonic_ns())
+            return result
+        return wrapper
+
+    def _record(self, index:int, start:int, end:int):
+        duration = (end - start) // 1000
+        if not self._counts[index] or duration < self._minimums[index]:
+            self._minimums[index] = duration
+        if duration > self._maximums[index]:
+            self._maximums[index] = duration
+        self._counts[index] += 1
+        self._totals[index] += duration
+
+        if index == 0:
+            if self._loop_last:
+                period = (start - self._loop_last) // 1000
+                if not self._loop_count or period < self._loop_minimum:
+                    self._loop_minimum = period
+                if period > self._loop_maximum:
+                    self._loop_maximum = period
+                self._loop_count += 1
+                self._loop_total += period
+            self._loop_last = start
+            if self._dump_interval and end - self._dump_last >= self._dump_interval:
+                self._dump_last = end
+                self.dump()
+
+    def reset(self):
+        for i in range(len(self._counts)):
+            self._counts[i] = 0
+            self._totals[i] = 0
+            self._minimums[i] = 0
+            self._maximums[i] = 0
+        self._loop_count = 0
+        self._loop_total = 0
+        self._loop_minimum = 0
+        self._loop_maximum = 0
+        self._loop_last = 0
+
+    def get_count(self) -> int:
+        return len(self._names)
+    def get_name(self, index:int) -> str:
+        return self._names[index]
+    def get_stats(self, index:int) -> tuple:
+        count = self._counts[index]
+        return (count, self._minimums[index], self._totals[index] // count if count else 0, self._maximums[index])
+    def get_loop_stats(self) -> tuple:
+        count = self._loop_count
+        return (count, self._loop_minimum, self._loop_total // count if count else 0, self._loop_maximum)
+
+    def dump(self):
+        print("{:<10} {:>8} {:>8} {:>8} {:>8} {:>6}".format("task", "runs", "min us", "mean us", "max us", "load"))
+        loop = self.get_loop_stats()
+        elapsed = loop[2] * loop[0]
+        for i in range(len(self._names)):
+            stats = self.get_stats(i)
+            print("{:<10} {:>8d} {:>8d} {:>8d} {:>8d} {:>5.1f}%".format(
+                self._names[i], stats[0], stats[1], stats[2], stats[3],
+                100.0 * self._totals[i] / elapsed if elapsed else 0.0
+            ))
+        print("{:<10} {:>8d} {:>8d} {:>8d} {:>8d}".format("loop", loop[0], loop[1], loop[2], loop[3]))
+
+class ProfilerMenuItem(MenuItem):
+    def __init__(self, profiler:Profiler, title:str="Profile"):
+        MenuItem.__init__(self, title)
+        self._profiler = profiler
+        self._index = 0 # Index of count displays loop period
+    def _get_name(self) -> str:
+        if self._index < self._profiler.get_count():
+            return self._profiler.get_name(self._index)
+        return "loop"
+    def _get_stats(self) -> tuple:
+        if self._index < self._profiler.get_count():
+            return self._profiler.get_stats(self._index)
+        return self._profiler.get_loop_stats()
+    def adjust(self, steps:int, accelerated:int=None) -> bool:
+        self._index = (self._index + steps) % (self._profiler.get_count() + 1)
+        return True
+    def increment(self) -> bool:
+        return self.adjust(1)
+    def decrement(self) -> bool:
+        return self.adjust(-1)
+    def reset(self) -> bool:
+        self._profiler.reset()
+        return True
+    def draw(self, display:Display):
+        stats = self._get_stats()
+        display.write(self._get_name(), (8,0), 8, True)
+        display.write("{:d}/{:d}us".format(stats[2], stats[3]), (0,1))
@@ -0,0 +1,201 @@
+# pcolamakerfaire2023 - randomizer.py
+# 2023 Cooper Dalrymple - me@dcdalrymple.com
+# GPL v3 License
+
+import random
+from array import array
+from menu import Menu, MenuItem, MenuGroup, ListMenuItem
+from step_sequencer import PatternMenuItem
+from pico_synth_sandbox.display import Display
+
+# Groups left alone by default: device settings, the patch number, output level and the arpeggiator
+DEFAULT_LOCKED = ("MIDI", "Patch", "Snd", "Arp")
+DEFAULT_AMOUNT = 0.25
+
+def is_in_group(path:str, group:str) -> bool:
+    return path == group or path.startswith(group + "/")
+
+def get_groups(paths:tuple[str]) -> tuple[str]:
+    # Every group of the menu in order of appearance, from the top level down, and parameters outside of any group
+    groups = []
+    for path in paths:
+        parts = path.split("/")
+        for i in range(1, max(len(parts), 2)):
+            group = "/".join(parts[:i])
+            if not group in groups:
+                groups.append(group)
+    return tuple(groups)
+
+class Randomizer:
+    # Generates new patches using the range and step grid of every menu parameter as its schema. An amount of 1.0 picks
+    # any value on the grid, while lower amounts move each value by up to that fraction of its range from its current
+    # value, or change the item of a list with that probability. Parameters within locked groups are kept. All values
+    # are staged and applied in a single commit, so each voice is updated once per parameter rather than per step.
+    def __init__(self, menu:Menu=None, locked:tuple=DEFAULT_LOCKED, amount:float=DEFAULT_AMOUNT, seed:int=None):
+        self._menu = None
+        self._locked_groups = list(locked)
+        self._amount = amount
+        self._has_previous = False
+        if not seed is None:
+            random.seed(seed)
+        self.set_menu(menu)
+
+    def set_menu(self, menu:Menu):
+        self._menu = menu
+        if not menu:
+            return
+        paths = menu.get_paths()
+        count = len(paths)
+        self._minimums = array("f", [0.0] * count)
+        self._maximums = array("f", [0.0] * count)
+        self._steps = array("f", [0.0] * count)
+        self._counts = array("H", [0] * count) # Number of steps within each range
+        self._lists = bytearray(count)
+        self._locked = bytearray(count)
+        self._previous = array("f", [0.0] * count) # Patch before the last change, for revert
+        self._has_previous = False
+        for i in range(count):
+            parameter = menu.get_parameter(i)
+            schema = parameter.get_schema()
+            self._minimums[i] = schema[1]
+            self._maximums[i] = schema[2]
+            self._steps[i] = schema[3]
+            self._counts[i] = int((schema[2] - schema[1]) / schema[3] + 0.5) if schema[3] else 0
+            self._lists[i] = 1 if isinstance(parameter, ListMenuItem) else 0
+        self._groups = get_groups(paths)
+        self._update_locked()
+
+    def get_amount(self) -> float:
+        return self._amount
+    def set_amount(self, value:float):
+        self._amount = min(max(value, 0.0), 1.0)
+
+    def get_groups(self) -> tuple[str]:
+        return self._groups if self._menu else ()
+    def is_locked(self, group:str) -> bool:
+        return group in self._locked_groups
+    def lock(self, group:str):
+        if not group in self._locked_groups:
+            self._locked_groups.append(group)
+            self._update_locked()
+    def unlock(self, group:str):
+        if group in self._locked_groups:
+            self._locked_groups.remove(group)
+            self._update_locked()
+    def _update_locked(self):
+        if not self._menu:
+            return
+        paths = self._menu.get_paths()
+        for i in range(len(paths)):
+            self._locked[i] = 0
+            for group in self._locked_groups:
+                if is_in_group(paths[i], group):
+                    self._locked[i] = 1
+                    break
+
+    def _get_value(self, index:int, amount:float) -> float:
+        value = self._menu.get_value(index)
+        count = self._counts[index]
+        if not count:
+            return value
+        if self._lists[index]:
+            if random.random() >= amount:
+                return value
+            step = random.randrange(count + 1)
+        elif amount >= 1.0:
+            step = random.randrange(count + 1)
+        else:
+            # Triangular distribution centred on the current step
+            step = round((value - self._minimums[index]) / self._steps[index] + (random.random() - random.random()) * amount * count)
+            step = min(max(step, 0), count)
+        return min(self._minimums[index] + step * self._steps[index], self._maximums[index])
+
+    def randomize(self, amount:float=None) -> int:
+        # Mutates the current patch by the given amount or the current amount, returning the number of changed parameters
+        if not self._menu:
+            return 0
+        if amount is None:
+            amount = self._amount
+        menu = self._menu
+        for i in range(len(self._previous)):
+            self._previous[i] = menu.get_value(i)
+            if not self._locked[i]:
+                menu.stage_value(i, self._get_value(i, amount))
+        self._has_previous = True
+        return self._commit()
+    def revert(self) -> int:
+        # Returns to the patch before the last change
+        if not self._menu or not self._has_previous:
+            return 0
+        for i in range(len(self._previous)):
+            self._menu.stage_value(i, self._previous[i])
+        self._has_previous = False
+        return self._commit()
+    def _commit(self) -> int:
+        changed = self._menu.commit()
+        if changed:
+            self._menu.redraw()
+        return changed
+
+class MutateMenuItem(MenuItem):
+    # Turning the value right applies a new mutation and turning it left returns to the patch before the last one
+    def __init__(self, randomizer:Randomizer, title:str="Mutate"):
+        MenuItem.__init__(self, title)
+        self._randomizer = randomizer
+        self._changed = -1
+    def adjust(self, steps:int, accelerated:int=None) -> bool:
+        if steps > 0:
+            self._changed = self._randomizer.randomize()
+        elif steps < 0:
+            self._randomizer.revert()
+            self._changed = -1
+        return bool(steps)
+    def increment(self) -> bool:
+        return self.adjust(1)
+    def decrement(self) -> bool:
+        return self.adjust(-1)
+    def draw(self, display:Display):
+        display.write("{:d} changed".format(self._changed) if self._changed >= 0 else "<Undo  Apply>", (0,1))
+
+class LockMenuItem(MenuItem):
+    # Browses the groups of the menu, resetting the item toggles whether the shown group is locked
+    def __init__(self, randomizer:Randomizer, title:str="Lock"):
+        MenuItem.__init__(self, title)
+        self._randomizer = randomizer
+        self._index = 0
+    def adjust(self, steps:int, accelerated:int=None) -> bool:
+        count = len(self._randomizer.get_groups())
+        if not count or not steps:
+            return False
+        self._index = (self._index + steps) % count
+        return True
+    def increment(self) -> bool:
+        return self.adjust(1)
+    def decrement(self) -> bool:
+        return self.adjust(-1)
+    def reset(self) -> bool:
+        groups = self._randomizer.get_groups()
+        if not groups:
+            return False
+        group = groups[self._index]
+        if self._randomizer.is_locked(group):
+            self._randomizer.unlock(group)
+        else:
+            self._randomizer.lock(group)
+        return True
+    def draw(self, display:Display):
+        groups = self._randomizer.get_groups()
+        if not groups:
+            return
+        group = groups[self._index]
+        display.write(("*" if self._randomizer.is_locked(group) else " ") + group, (0,1))
+    def get_cursor_position(self) -> tuple:
+        return (1,1)
+
+class RandomizerMenuGroup(MenuGroup):
+    def __init__(self, randomizer:Randomizer, group:str="Rand"):
+        MenuGroup.__init__(self, (
+            PatternMenuItem("Amount", lambda : int(randomizer.get_amount() * 100 + 0.5), lambda value : randomizer.set_amount(value / 100), step=5, maximum=100),
+            MutateMenuItem(randomizer),
+            LockMenuItem(randomizer),
+        ), group)
@@ -0,0 +1,172 @@
+# pcolamakerfaire2023 - remote.py
+# 2023 Cooper Dalrymple - me@dcdalrymple.com
+# GPL v3 License
+
+import struct
+from menu import Menu, encode_patch, decode_patch
+
+# Frames in both directions: header, payload and an 8-bit sum of the command, sequence, length and payload bytes.
+# Every request is answered with a frame of the same sequence number, either the reply to its command or an error.
+REMOTE_VERSION = 1
+REMOTE_SYNC = 0xA5
+REMOTE_HEADER = "<BBBH" # sync, command, sequence, payload length
+REMOTE_HEADER_SIZE = struct.calcsize(REMOTE_HEADER)
+REMOTE_MAX_PAYLOAD = 1024
+
+CMD_PING = 0x01 # Reply: version, schema fingerprint and parameter count as "<HIH"
+CMD_SCHEMA = 0x02 # Index as "<H". Reply: index, minimum, maximum, step and initial value as "<Hffff" followed by the path
+CMD_FIND = 0x03 # Path. Reply: index as "<H"
+CMD_GET = 0x04 # Index as "<H". Reply: index and value as "<Hf"
+CMD_SET = 0x05 # Any number of indexes and values as "<Hf", applied together. Reply: number of changed parameters as "<H"
+CMD_DUMP = 0x06 # Reply: the patch in the binary preset format
+CMD_LOAD = 0x07 # Patch in the binary preset format. Reply: number of changed parameters as "<H"
+REPLY = 0x80 # Added to the command of a reply
+CMD_ERROR = 0x7F # Reply: command and error code as "<BB"
+
+ERROR_CHECKSUM = 1
+ERROR_LENGTH = 2
+ERROR_COMMAND = 3
+ERROR_INDEX = 4
+ERROR_PATH = 5
+ERROR_SCHEMA = 6
+
+SET_ENTRY = "<Hf"
+SET_ENTRY_SIZE = struct.calcsize(SET_ENTRY)
+
+def get_checksum(data) -> int:
+    result = 0
+    for value in data:
+        result += value
+    return result & 0xFF
+
+def encode_frame(command:int, sequence:int, payload:bytes=b"") -> bytes:
+    header = struct.pack(REMOTE_HEADER, REMOTE_SYNC, command, sequence, len(payload))
+    return header + payload + bytes(((get_checksum(header[1:]) + get_checksum(payload)) & 0xFF,))
+
+def get_serial():
+    # USB serial data channel, which is enabled by boot.py, separately from the REPL console
+    try:
+        import usb_cdc
+        return usb_cdc.data
+    except ImportError:
+        return None
+
+class Remote:
+    def __init__(self, serial=None, menu:Menu=None):
+        self._serial = None
+        self._menu = menu
+        self._buffer = bytearray(REMOTE_HEADER_SIZE + REMOTE_MAX_PAYLOAD + 1)
+        self._view = memoryview(self._buffer)
+        self._length = 0
+        self.set_serial(serial)
+
+    def set_serial(self, serial):
+        self._serial = serial
+        if serial and hasattr(serial, "timeout"):
+            serial.timeout = 0
+    def set_menu(self, menu:Menu):
+        self._menu = menu
+
+    def update(self):
+        if not self._serial or not self._menu:
+            return
+        count = min(self._serial.in_waiting, len(self._buffer) - self._length)
+        if not count:
+            return
+        count = self._serial.readinto(self._view[self._length:self._length + count])
+        if not count:
+            return
+        self._length += count
+        while self._parse():
+            pass
+
+    def _parse(self) -> bool:
+        # Handles the frame at the start of the buffer, returning whether another may follow
+        buffer = self._buffer
+        start = 0
+        while start < self._length and buffer[start] != REMOTE_SYNC:
+            start += 1
+        if start:
+            self._discard(start)
+        if self._length < REMOTE_HEADER_SIZE:
+            return False
+        command, sequence = buffer[1], buffer[2]
+        length = buffer[3] | buffer[4] << 8
+        if length > REMOTE_MAX_PAYLOAD:
+            self._error(command, sequence, ERROR_LENGTH)
+            self._discard(1)
+            return True
+        end = REMOTE_HEADER_SIZE + length
+        if self._length < end + 1:
+            return False
+        if get_checksum(self._view[1:end]) != buffer[end]:
+            self._error(command, sequence, ERROR_CHECKSUM)
+            self._discard(1)
+            return True
+        self._handle(command, sequence, self._view[REMOTE_HEADER_SIZE:end])
+        self._discard(end + 1)
+        return True
+    def _discard(self, count:int):
+        self._buffer[0:self._length - count] = self._buffer[count:self._length]
+        self._length -= count
+
+    def _reply(self, command:int, sequence:int, payload:bytes=b""):
+        self._serial.write(encode_frame(command | REPLY, sequence, payload))
+    def _error(self, command:int, sequence:int, error:int):
+        self._serial.write(encode_frame(CMD_ERROR, sequence, bytes((command, error))))
+
+    def _handle(self, command:int, sequence:int, payload:memoryview):
+        menu = self._menu
+        count = len(menu.get_paths())
+        if command == CMD_PING:
+            self._reply(command, sequence, struct.pack("<HIH", REMOTE_VERSION, menu.get_fingerprint(), count))
+        elif command == CMD_SCHEMA or command == CMD_GET:
+            if len(payload) != 2:
+                self._error(command, sequence, ERROR_LENGTH)
+                return
+            index = payload[0] | payload[1] << 8
+            if index >= count:
+                self._error(command, sequence, ERROR_INDEX)
+            elif command == CMD_GET:
+                self._reply(command, sequence, struct.pack("<Hf", index, menu.get_value(index)))
+            else:
+                schema = menu.get_parameter(index).get_schema()
+                self._reply(command, sequence, struct.pack("<Hffff", index, schema[1], schema[2], schema[3], schema[4]) + menu.get_paths()[index].encode())
+        elif command == CMD_FIND:
+            path = str(bytes(payload), "utf-8")
+            if not path in menu.get_paths():
+                self._error(command, sequence, ERROR_PATH)
+                return
+            self._reply(command, sequence, struct.pack("<H", menu.get_paths().index(path)))
+        elif command == CMD_SET:
+            if len(payload) % SET_ENTRY_SIZE:
+                self._error(command, sequence, ERROR_LENGTH)
+                return
+            for offset in range(0, len(payload), SET_ENTRY_SIZE):
+                index, value = struct.unpack_from(SET_ENTRY, payload, offset)
+                if index >= count:
+                    self._error(command, sequence, ERROR_INDEX)
+                    return
+            # Every value of the batch is staged before any voice is updated
+            for offset in range(0, len(payload), SET_ENTRY_SIZE):
+                index, value = struct.unpack_from(SET_ENTRY, payload, offset)
+                menu.stage_value(index, value)
+            self._reply(command, sequence, struct.pack("<H", self._commit()))
+        elif command == CMD_DUMP:
+            self._reply(command, sequence, encode_patch(menu.get(), menu.get_fingerprint()))
+        elif command == CMD_LOAD:
+            values, fingerprint = decode_patch(bytes(payload))
+            if values is None:
+                self._error(command, sequence, ERROR_LENGTH)
+            elif fingerprint != menu.get_fingerprint() or len(values) != count:
+                self._error(command, sequence, ERROR_SCHEMA)
+            else:
+                menu.stage(values)
+                self._reply(command, sequence, struct.pack("<H", self._commit()))
+        else:
+            self._error(command, sequence, ERROR_COMMAND)
+    def _commit(self) -> int:
+        changed = self._menu.commit()
+        if changed:
+            self._menu.redraw()
+        return changed
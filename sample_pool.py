@@ -0,0 +1,152 @@
+# pcolamakerfaire2023 - sample_pool.py
+# 2023 Cooper Dalrymple - me@dcdalrymple.com
+# GPL v3 License
+
+import struct
+import ulab.numpy as numpy
+from preprocess import TRIM_THRESHOLD
+
+POOL_SIZE = 16384 # Samples shared by both banks
+POOL_BANKS = 2 # A kit is loaded into one bank while the other plays
+CHUNK_SIZE = 1024 # Bytes read from a file per update
+
+class SamplePool:
+    # One-shot samples are read directly into a single preallocated arena rather than into separately allocated
+    # buffers, so loading kits doesn't fragment the heap. Tracks using the same file share one buffer. Kits load in the
+    # background in small chunks into the bank which isn't playing, which becomes active once the whole kit is loaded.
+    def __init__(self, size:int=POOL_SIZE, banks:int=POOL_BANKS):
+        self._bank_size = size // banks
+        self._arena = bytearray(self._bank_size * banks * 2)
+        self._view = memoryview(self._arena)
+        self._banks = banks
+        self._bank = 0
+        self._job = None
+        self._loaded = None
+
+    def get_bank_size(self) -> int:
+        return self._bank_size
+    def is_loading(self) -> bool:
+        return not self._job is None
+
+    def load(self, names:tuple, dir:str="/samples", loaded:function=None):
+        # Starts loading a kit, given one file name or None per track. When done, loaded is called with a tuple of
+        # (data, sample_rate) or None per track. A kit which is still loading is abandoned.
+        if self._job:
+            self._job.close()
+        self._job = self._load_steps(names, dir)
+        self._loaded = loaded
+    def update(self):
+        if not self._job:
+            return
+        try:
+            result = next(self._job)
+        except StopIteration:
+            result = None
+        if result is None:
+            return
+        self._job = None
+        self._bank = (self._bank + 1) % self._banks
+        if self._loaded: self._loaded(result)
+
+    def _load_steps(self, names:tuple, dir:str):
+        bank = (self._bank + 1) % self._banks
+        start = bank * self._bank_size
+        end = start + self._bank_size
+        position = start
+        files = [] # Each file is only loaded once
+        loaded = []
+        samples = []
+        for name in names:
+            if not name:
+                samples.append(None)
+                continue
+            if name in files:
+                samples.append(loaded[files.index(name)])
+                continue
+            sample = None
+            for sample in self._read_steps("{}/{}".format(dir, name), position, end):
+                yield
+            if sample:
+                position = sample[2]
+                sample = sample[:2]
+            files.append(name)
+            loaded.append(sample)
+            samples.append(sample)
+            yield
+        yield tuple(samples)
+
+    def _read_steps(self, path:str, start:int, end:int):
+        # Reads 16-bit PCM audio into the arena from sample start, yielding between chunks. The last value yielded is
+        # (data, sample_rate, next free sample). Channels other than the first are discarded and files which don't fit
+        # the remaining space are truncated.
+        try:
+            file = open(path, "rb")
+        except:
+            print("Failed to read sample file: {}".format(path))
+            yield None
+            return
+        failed = False
+        try:
+            channels, sample_rate, size = read_wave_header(file)
+            length = min(size // 2, end - start) // channels * channels
+            offset = start * 2
+            remaining = length * 2
+            while remaining > 0:
+                count = file.readinto(self._view[offset:offset + min(CHUNK_SIZE, remaining)])
+                if not count:
+                    break
+                offset += count
+                remaining -= count
+                yield
+        except Exception: # Not GeneratorExit
+            failed = True
+        finally:
+            # Also closes the file when an abandoned kit is closed
+            file.close()
+        if failed:
+            print("Failed to read sample file: {}".format(path))
+            yield None
+            return
+        length = (offset // 2 - start) // channels
+        data = numpy.frombuffer(self._arena, dtype=numpy.int16, count=length * channels, offset=start * 2)
+        if channels > 1:
+            # Packed in place, each sample is written before or at the position it is read from
+            data[:length] = data[::channels]
+            data = data[:length]
+        yield
+        length = trim_start(data)
+        print("Successfully read sample file: {}".format(path))
+        yield (data[:length], sample_rate, start + length)
+
+def trim_start(data:numpy.ndarray, threshold:float=TRIM_THRESHOLD) -> int:
+    # Moves the sample back over leading silence in place, returning the remaining length
+    if not len(data):
+        return 0
+    level = numpy.abs(data)
+    peak = numpy.max(level)
+    if not peak:
+        return len(data)
+    skip = numpy.argmax(level > peak * threshold)
+    if skip:
+        data[:len(data) - skip] = data[skip:]
+    return len(data) - skip
+
+def read_wave_header(file) -> tuple:
+    # Returns (channels, sample_rate, size of the data in bytes) and leaves the file at the start of the data chunk
+    riff, size, format = struct.unpack("<4sI4s", file.read(12))
+    if riff != b"RIFF" or format != b"WAVE":
+        raise ValueError()
+    channels = 0
+    while True:
+        chunk, size = struct.unpack("<4sI", file.read(8))
+        if chunk == b"fmt ":
+            audio_format, channels, sample_rate, byte_rate, block_align, bits = struct.unpack("<HHIIHH", file.read(16))
+            if audio_format != 1 or bits != 16 or not channels:
+                raise ValueError()
+            file.seek(size - 16 + (size & 1), 1)
+        elif chunk == b"data":
+            if not channels:
+                raise ValueError()
+            return (channels, sample_rate, size)
+        else:
+            file.seek(size + (size & 1), 1)
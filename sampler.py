@@ -5,23 +5,29 @@
 import gc, os
 from pico_synth_sandbox import fftfreq
 
-from menu import Menu, MenuGroup, OscillatorMenuGroup, NumberMenuItem, BarMenuItem, ListMenuItem
+from app import App
+from menu import OscillatorMenuGroup, NumberMenuItem, BarMenuItem, ListMenuItem
 import pico_synth_sandbox.tasks
-from pico_synth_sandbox.board import get_board
-from pico_synth_sandbox.keyboard import get_keyboard_driver
-from pico_synth_sandbox.audio import Audio, get_audio_driver
-from pico_synth_sandbox.synth import Synth
 from pico_synth_sandbox.voice.sample import Sample
 import pico_synth_sandbox.waveform as waveform
-from pico_synth_sandbox.midi import Midi
+from preprocess import prepare_steps
+
+# Set to True to report task execution times over serial and on a debug menu page
+PROFILE = False
+# Set to True to run tasks by priority and deadline, loading samples in slices between time-critical tasks
+SCHEDULER = False
+# Set to True to report heap use by boot phase and subsystem, collections and allocating callbacks
+MEMORY = False
 
 # Initialize Objects
-board = get_board()
-audio = get_audio_driver(board)
-audio.mute()
-synth = Synth(audio)
-synth.add_voices(Sample(loop=False) for i in range(4))
-midi = Midi(board)
+app = App("sampler", [Sample(loop=False) for i in range(4)], root=60, patches=False, profile=PROFILE, scheduler=SCHEDULER, memory=MEMORY)
+audio = app.audio
+synth = app.synth
+
+# Samples are trimmed, resampled to the audio driver's rate and normalized when loaded, so more is read from the file
+# than fits in a voice
+MAX_SAMPLES = 4096
+LOAD_SAMPLES = 8192
 
 # Prepare Sample Files
 sample_data = None
@@ -33,45 +39,54 @@ if not sample_files:
     print("No samples available. Try running \"make samples --always-make\" in the library root directory.")
     exit()
 
-def load_sample(index=0):
+def load_sample_steps(index=0):
     global semitone, sample_data, sample_rate, sample_root
 
     audio.mute()
-    pico_synth_sandbox.tasks.pause()
 
     for voice in synth.voices:
         voice.unload()
-    del sample_data
+    sample_data = None
     gc.collect()
+    memory_index = app.memory.begin("sample") if app.memory else -1
+    yield
 
-    sample_data, sample_rate = waveform.load_from_file("/samples/" + sample_files[index], max_samples=4096)
+    sample_data, sample_rate = waveform.load_from_file("/samples/" + sample_files[int(index)], max_samples=LOAD_SAMPLES)
+    for result in prepare_steps(sample_data, sample_rate, audio.get_sample_rate(), waveform.get_amplitude(), MAX_SAMPLES):
+        yield
+    sample_data, sample_rate = result
+    gc.collect()
+    yield
     sample_root = fftfreq(
         data=sample_data,
         sample_rate=sample_rate
     )
     for voice in synth.voices:
+        yield
         voice.load(sample_data, sample_rate, sample_root)
 
     gc.collect()
-    pico_synth_sandbox.tasks.resume()
+    if app.memory:
+        app.memory.end(memory_index, False)
     audio.unmute()
 
+sample_job = None
+def load_sample(index=0):
+    global sample_job
+    if app.scheduler:
+        # Both loads would share the sample globals, so a load which is still running is replaced
+        app.scheduler.cancel(sample_job)
+        sample_job = load_sample_steps(index)
+        app.scheduler.spawn(sample_job)
+        return
+    pico_synth_sandbox.tasks.pause()
+    for step in load_sample_steps(index):
+        pass
+    pico_synth_sandbox.tasks.resume()
+
 # Menu System
-menu = Menu(board, (
-    MenuGroup((
-        NumberMenuItem(
-            title="Channel",
-            step=1,
-            maximum=15,
-            update=midi.set_channel
-        ),
-        NumberMenuItem(
-            title="Thru",
-            step=1,
-            maximum=1,
-            update=midi.set_thru
-        ),
-    ), "MIDI"),
+app.set_menu((
+    app.get_midi_menu_group(15),
     NumberMenuItem(
         title="Thru"
     ),
@@ -86,48 +101,15 @@ menu = Menu(board, (
         update=load_sample
     ),
     OscillatorMenuGroup(synth.voices, "Osc")
-), "sampler")
-
-# Keyboard Setup
-keyboard = get_keyboard_driver(board, root=60, max_voices=len(synth.voices))
-def press(voice, notenum, velocity, keynum=None):
-    synth.press(voice, notenum, velocity)
-    midi.send_note_on(notenum, velocity)
-keyboard.set_voice_press(press)
-
-def release(voice, notenum, keynum=None):
-    synth.release(voice)
-    midi.send_note_off(notenum)
-keyboard.set_voice_release(release)
-
-# Midi Implementation
-def control_change(control, value):
-    if control == 64: # Sustain
-        keyboard.set_sustain(value)
-midi.set_control_change(control_change)
-
-def pitch_bend(value):
-    for voice in synth.voices:
-        voice.set_pitch_bend(value)
-midi.set_pitch_bend(pitch_bend)
-
-def note_on(notenum, velocity):
-    keyboard.append(notenum, velocity)
-midi.set_note_on(note_on)
-
-def note_off(notenum):
-    keyboard.remove(notenum)
-midi.set_note_off(note_off)
+))
 
+# Program changes select samples rather than patches
 def program_change(patch):
     if patch < len(sample_files):
         load_sample(patch)
-midi.set_program_change(program_change)
+app.midi.set_program_change(program_change)
 
 # Load first sample
 load_sample()
 
-menu.ready()
-audio.unmute()
-
-pico_synth_sandbox.tasks.run()
+app.run()
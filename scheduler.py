@@ -0,0 +1,183 @@
+# pcolamakerfaire2023 - scheduler.py
+# 2023 Cooper Dalrymple - me@dcdalrymple.com
+# GPL v3 License
+
+import time
+try:
+    from supervisor import ticks_ms
+    _TICKS_PERIOD = 1 << 29
+except ImportError:
+    def ticks_ms() -> int:
+        return time.monotonic_ns() // 1000000
+    _TICKS_PERIOD = 1 << 62
+
+def ticks_diff(a:int, b:int) -> int:
+    diff = (a - b) & (_TICKS_PERIOD - 1)
+    return diff - _TICKS_PERIOD if diff >= _TICKS_PERIOD // 2 else diff
+
+def ticks_add(a:int, b:int) -> int:
+    return (a + b) % _TICKS_PERIOD
+
+def chain(obj, callback:function, method:str="update") -> bool:
+    # Run callback after each call to an existing task's update method within the cooperative task loop
+    if not hasattr(obj, method):
+        return False
+    update = getattr(obj, method)
+    def chained():
+        result = update()
+        callback()
+        return result
+    setattr(obj, method, chained)
+    return True
+
+class StepClock:
+    # Drift-free step timing for the arpeggiator and step sequencer. Each step is due one interval after the previous
+    # due time rather than after the time it actually ran, carrying the sub-millisecond remainder between steps.
+    def __init__(self, bpm:float=120, steps_per_beat:int=4):
+        self._steps_per_beat = steps_per_beat
+        self._interval_us = 0
+        self._phase_us = 0
+        self._due = ticks_ms()
+        self.set_bpm(bpm)
+    def set_bpm(self, value:float):
+        self._interval_us = int(60000000 / (max(value, 1.0) * self._steps_per_beat))
+    def restart(self, now:int=None):
+        self._due = ticks_ms() if now is None else now
+    def tick(self, now:int) -> int:
+        # Returns the length in ms of the step which is due, or 0 if no step is due yet
+        if ticks_diff(now, self._due) < 0:
+            return 0
+        self._phase_us += self._interval_us
+        interval_ms = self._phase_us // 1000
+        self._phase_us -= interval_ms * 1000
+        if ticks_diff(now, self._due) > interval_ms:
+            self._due = now # Fell too far behind, restart timing
+        self._due = ticks_add(self._due, interval_ms)
+        return interval_ms
+
+PRIORITY_MIDI = 0
+PRIORITY_SEQUENCER = 1
+PRIORITY_KEYBOARD = 2
+PRIORITY_SYNTH = 3
+PRIORITY_ENCODER = 4
+PRIORITY_DISPLAY = 5
+PRIORITY_BACKGROUND = 6
+
+class ScheduledTask:
+    def __init__(self, name:str, callback:function, priority:int, interval:int=0, deadline:int=0):
+        self.name = name
+        self.priority = priority
+        self._callback = callback
+        self._interval = interval # ms, 0 runs on every pass
+        self._deadline = deadline # ms of allowed lateness, 0 disables tracking
+        self._due = ticks_ms()
+        self.runs = 0
+        self.misses = 0
+        self.max_lateness = 0
+    def is_due(self, now:int) -> bool:
+        return ticks_diff(now, self._due) >= 0
+    def run(self, now:int):
+        lateness = ticks_diff(now, self._due)
+        if self._interval:
+            if lateness > self._interval:
+                self._due = ticks_add(now, self._interval) # Fell behind, don't attempt to catch up
+            else:
+                self._due = ticks_add(self._due, self._interval)
+        if self._deadline:
+            if lateness > self.max_lateness:
+                self.max_lateness = lateness
+            if lateness > self._deadline:
+                self.misses += 1
+        self.runs += 1
+        self._callback()
+
+class Scheduler:
+    def __init__(self):
+        self._tasks = []
+        self._jobs = []
+        self._job_index = 0
+        self._task_index = 0 # Lower priority task to check first on the next pass
+        self._job_turn = False # Whether a job slice runs before lower priority tasks on the next pass
+        self._paused = False
+        self._running = False
+
+    def add(self, name:str, callback:function, priority:int=PRIORITY_BACKGROUND, interval:int=0, deadline:int=0) -> ScheduledTask:
+        task = ScheduledTask(name, callback, priority, interval, deadline)
+        self._tasks.append(task)
+        self._tasks.sort(key=lambda task : task.priority)
+        return task
+    def watch(self, name:str, obj, priority:int=PRIORITY_BACKGROUND, interval:int=0, deadline:int=0, method:str="update") -> ScheduledTask:
+        if not hasattr(obj, method):
+            return None
+        return self.add(name, getattr(obj, method), priority, interval, deadline)
+    def get_tasks(self) -> list[ScheduledTask]:
+        return self._tasks
+
+    # Jobs are generators which perform one slice of long running work each time they are resumed
+    def spawn(self, job):
+        self._jobs.append(job)
+    def cancel(self, job):
+        # Stops a job before it completes, such as a load replaced by a newer request
+        if job in self._jobs:
+            self._jobs.remove(job)
+            job.close()
+    def has_jobs(self) -> bool:
+        return len(self._jobs) > 0
+
+    def pause(self):
+        self._paused = True
+    def resume(self):
+        self._paused = False
+
+    def step(self) -> bool:
+        # Run all due time-critical tasks in order of priority, then at most one lower priority task or job slice
+        # so that critical tasks are checked again before any further long running work. Lower priority tasks take
+        # turns with each other and with jobs, so a task which is always due can't starve the rest.
+        now = ticks_ms()
+        for task in self._tasks:
+            if task.priority <= PRIORITY_SYNTH and task.is_due(now):
+                task.run(now)
+        if self._paused:
+            return False
+        if self._job_turn and self._jobs:
+            self._job_turn = False
+            self._run_job()
+            return True
+        self._job_turn = True
+        if self._run_task(now):
+            return True
+        if not self._jobs:
+            return False
+        self._job_turn = False
+        self._run_job()
+        return True
+    def _run_task(self, now:int) -> bool:
+        # Runs the first due lower priority task after the one which ran last
+        count = len(self._tasks)
+        for i in range(count):
+            index = (self._task_index + i) % count
+            task = self._tasks[index]
+            if task.priority > PRIORITY_SYNTH and task.is_due(now):
+                self._task_index = index + 1
+                task.run(now)
+                return True
+        return False
+    def _run_job(self):
+        self._job_index %= len(self._jobs)
+        try:
+            next(self._jobs[self._job_index])
+            self._job_index += 1
+        except StopIteration:
+            del self._jobs[self._job_index]
+
+    def run(self):
+        self._running = True
+        while self._running:
+            self.step()
+    def stop(self):
+        self._running = False
+
+    def report(self):
+        print("{:<10} {:>4} {:>8} {:>6} {:>6}".format("task", "prio", "runs", "late", "misses"))
+        for task in self._tasks:
+            print("{:<10} {:>4d} {:>8d} {:>6d} {:>6d}".format(task.name, task.priority, task.runs, task.max_lateness, task.misses))
@@ -0,0 +1,258 @@
+# pcolamakerfaire2023 - step_sequencer.py
+# 2023 Cooper Dalrymple - me@dcdalrymple.com
+# GPL v3 License
+
+import struct
+from pico_synth_sandbox import check_dir
+from pico_synth_sandbox.display import Display
+from menu import MenuGroup, NumberMenuItem
+from scheduler import StepClock, ticks_ms, ticks_diff, ticks_add
+from writer import FileWriter, write_file, find_file
+
+SEQ_OFF = 0
+SEQ_PLAY = 1
+SEQ_RECORD = 2
+
+MAX_TRACKS = 4
+MAX_STEPS = 32
+REST = 255
+
+# Step fields, each stored in its own bytearray of tracks * steps
+FIELD_NOTE = 0
+FIELD_VELOCITY = 1 # 1-127
+FIELD_GATE = 2 # Percent of the step length
+FIELD_FLAGS = 3
+STEP_ON = 0x01
+STEP_TIE = 0x02 # Hold the note into the next step, which continues it without retriggering if it has the same note
+
+# Binary pattern format: header followed by each field of every track
+PATTERN_MAGIC = b"PSQ1"
+PATTERN_HEADER = "<4sBBBBH" # magic, tracks, steps, length, reserved, bpm
+PATTERN_HEADER_SIZE = struct.calcsize(PATTERN_HEADER)
+
+NOTE_NAMES = ("C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B")
+
+class StepSequencer:
+    def __init__(self, press:function=None, release:function=None, tracks:int=MAX_TRACKS, steps:int=MAX_STEPS):
+        self._press = press
+        self._release = release
+
+        # Pattern storage
+        self._tracks = min(max(tracks, 1), MAX_TRACKS)
+        self._steps = min(max(steps, 1), MAX_STEPS)
+        size = self._tracks * self._steps
+        self._fields = (
+            bytearray(size), # FIELD_NOTE
+            bytearray(size), # FIELD_VELOCITY
+            bytearray(size), # FIELD_GATE
+            bytearray(size), # FIELD_FLAGS
+        )
+        self._length = min(16, self._steps)
+        self.clear()
+
+        # Playback
+        self._mode = SEQ_OFF
+        self._bpm = 120
+        self._timer = StepClock(self._bpm)
+        self._position = 0
+        self._playing = bytearray([REST] * self._tracks)
+        self._tied = bytearray(self._tracks)
+        self._gate_due = [0] * self._tracks
+
+        # Editing
+        self._track = 0
+        self._edit = 0
+
+    def set_press(self, callback:function):
+        self._press = callback
+    def set_release(self, callback:function):
+        self._release = callback
+
+    def get_tracks(self) -> int:
+        return self._tracks
+    def get_steps(self) -> int:
+        return self._steps
+    def get_length(self) -> int:
+        return self._length
+    def set_length(self, value:int):
+        self._length = min(max(int(value), 1), self._steps)
+        self._position %= self._length
+        self._edit %= self._length
+    def get_bpm(self) -> int:
+        return self._bpm
+    def set_bpm(self, value:int):
+        self._bpm = int(value)
+        self._timer.set_bpm(self._bpm)
+    def get_mode(self) -> int:
+        return self._mode
+    def set_mode(self, value:int):
+        value = int(value)
+        if value == self._mode:
+            return
+        if self._mode == SEQ_PLAY:
+            self.release_all()
+        self._mode = value
+        if value == SEQ_PLAY:
+            self._position = 0
+            self._timer.restart()
+    def is_playing(self) -> bool:
+        return self._mode == SEQ_PLAY
+
+    # Editing of the selected step
+    def get_track(self) -> int:
+        return self._track
+    def set_track(self, value:int):
+        self._track = min(max(int(value), 0), self._tracks - 1)
+    def get_edit_position(self) -> int:
+        return self._edit
+    def set_edit_position(self, value:int):
+        self._edit = min(max(int(value), 0), self._length - 1)
+    def get_field(self, field:int) -> int:
+        return self._fields[field][self._track * self._steps + self._edit]
+    def set_field(self, field:int, value:int):
+        self._fields[field][self._track * self._steps + self._edit] = int(value)
+    def get_flag(self, flag:int) -> bool:
+        return bool(self.get_field(FIELD_FLAGS) & flag)
+    def set_flag(self, flag:int, value:bool):
+        flags = self.get_field(FIELD_FLAGS)
+        self.set_field(FIELD_FLAGS, flags | flag if value else flags & ~flag)
+    def record(self, notenum:int, velocity:float=1.0) -> bool:
+        # Writes a played note to the selected step and selects the next step while recording
+        if self._mode != SEQ_RECORD:
+            return False
+        index = self._track * self._steps + self._edit
+        self._fields[FIELD_NOTE][index] = notenum
+        self._fields[FIELD_VELOCITY][index] = min(max(int(velocity * 127), 1), 127)
+        self._fields[FIELD_FLAGS][index] |= STEP_ON
+        self._edit = (self._edit + 1) % self._length
+        return True
+    def clear(self, track:int=None):
+        for i in range(self._tracks) if track is None else (track,):
+            for j in range(i * self._steps, (i + 1) * self._steps):
+                self._fields[FIELD_NOTE][j] = 60
+                self._fields[FIELD_VELOCITY][j] = 100
+                self._fields[FIELD_GATE][j] = 50
+                self._fields[FIELD_FLAGS][j] = 0
+
+    # Playback
+    def _release_track(self, track:int):
+        if self._playing[track] != REST:
+            if self._release: self._release(self._playing[track])
+            self._playing[track] = REST
+        self._tied[track] = 0
+    def release_all(self):
+        for track in range(self._tracks):
+            self._release_track(track)
+    def step(self, now:int, interval_ms:int):
+        # Play the current step of every track and move to the next
+        position = self._position
+        for track in range(self._tracks):
+            index = track * self._steps + position
+            flags = self._fields[FIELD_FLAGS][index]
+            if not flags & STEP_ON:
+                self._release_track(track)
+                continue
+            notenum = self._fields[FIELD_NOTE][index]
+            if not self._tied[track] or self._playing[track] != notenum:
+                self._release_track(track)
+                self._playing[track] = notenum
+                if self._press: self._press(notenum, self._fields[FIELD_VELOCITY][index] / 127)
+            if flags & STEP_TIE:
+                self._tied[track] = 1
+            else:
+                self._tied[track] = 0
+                self._gate_due[track] = ticks_add(now, max(interval_ms * self._fields[FIELD_GATE][index] // 100, 1))
+        self._position = (position + 1) % self._length
+    def update(self):
+        if self._mode != SEQ_PLAY:
+            return
+        now = ticks_ms()
+        for track in range(self._tracks):
+            if self._playing[track] != REST and not self._tied[track] and ticks_diff(now, self._gate_due[track]) >= 0:
+                self._release_track(track)
+        interval_ms = self._timer.tick(now)
+        if interval_ms:
+            self.step(now, interval_ms)
+
+    # Pattern files
+    def write(self, name:str, dir:str="/patterns", writer:FileWriter=None) -> bool:
+        # Queues a snapshot of the pattern on writer if given, otherwise writes it before returning
+        path = "{}/{}.seq".format(dir, name)
+        try:
+            check_dir(dir)
+        except:
+            print("Failed to write pattern file: {}".format(path))
+            return False
+        data = bytearray(struct.pack(PATTERN_HEADER, PATTERN_MAGIC, self._tracks, self._steps, self._length, 0, self._bpm))
+        for field in self._fields:
+            data.extend(field)
+        return write_file(path, data, "pattern", writer)
+    def read(self, name:str, dir:str="/patterns") -> bool:
+        # Patterns with a different number of tracks or steps are loaded as far as they overlap
+        path = "{}/{}.seq".format(dir, name)
+        try:
+            with open(find_file(path) or path, "rb") as file:
+                data = file.read()
+        except:
+            return False
+        if len(data) < PATTERN_HEADER_SIZE:
+            return False
+        magic, tracks, steps, length, reserved, bpm = struct.unpack_from(PATTERN_HEADER, data)
+        if magic != PATTERN_MAGIC or len(data) < PATTERN_HEADER_SIZE + tracks * steps * len(self._fields):
+            print("Failed to read pattern file: {}".format(path))
+            return False
+        self.release_all()
+        self.clear()
+        count = min(steps, self._steps)
+        for field in range(len(self._fields)):
+            offset = PATTERN_HEADER_SIZE + field * tracks * steps
+            for track in range(min(tracks, self._tracks)):
+                start = offset + track * steps
+                self._fields[field][track * self._steps:track * self._steps + count] = data[start:start + count]
+        self.set_length(length)
+        self.set_bpm(bpm)
+        print("Successfully read pattern file: {}".format(path))
+        return True
+
+class PatternMenuItem(NumberMenuItem):
+    # Edits sequencer state through callbacks rather than holding a patch parameter, so it isn't stored in patches
+    def __init__(self, title:str, get:function, set:function, step:int=1, minimum:int=0, maximum:int=127, labels:tuple=None, offset:int=0):
+        self._get = get
+        self._set = set
+        self._labels = labels
+        self._offset = offset
+        NumberMenuItem.__init__(self, title, step=step, initial=get(), minimum=minimum, maximum=maximum)
+    def get_parameters(self, parameters:list, paths:list=None, prefix:str="") -> list:
+        return parameters
+    def draw(self, display:Display):
+        value = int(self._get_value())
+        display.write(self._labels[value] if self._labels else str(value + self._offset), (0,1))
+    def _get_value(self) -> int:
+        return self._get()
+    def _set_value(self, value:float) -> bool:
+        value = int(value)
+        if value == self._get():
+            return False
+        self._set(value)
+        self._do_update()
+        return True
+
+class NoteMenuItem(PatternMenuItem):
+    def draw(self, display:Display):
+        value = int(self._get_value())
+        display.write("{}{:d}".format(NOTE_NAMES[value % 12], value // 12 - 1), (0,1))
+
+class StepSequencerMenuGroup(MenuGroup):
+    def __init__(self, sequencer:StepSequencer, group:str="Seq"):
+        MenuGroup.__init__(self, (
+            PatternMenuItem("Mode", sequencer.get_mode, sequencer.set_mode, maximum=2, labels=("Off", "Play", "Record")),
+            PatternMenuItem("BPM", sequencer.get_bpm, sequencer.set_bpm, minimum=40, maximum=240),
+            PatternMenuItem("Length", sequencer.get_length, sequencer.set_length, minimum=1, maximum=sequencer.get_steps()),
+            PatternMenuItem("Track", sequencer.get_track, sequencer.set_track, maximum=sequencer.get_tracks()-1, offset=1),
+            PatternMenuItem("Step", sequencer.get_edit_position, sequencer.set_edit_position, maximum=sequencer.get_steps()-1, offset=1),
+            PatternMenuItem("On", lambda : int(sequencer.get_flag(STEP_ON)), lambda value : sequencer.set_flag(STEP_ON, value), maximum=1, labels=("Off", "On")),
+            NoteMenuItem("Note", lambda : sequencer.get_field(FIELD_NOTE), lambda value : sequencer.set_field(FIELD_NOTE, value)),
+            PatternMenuItem("Velocity", lambda : sequencer.get_field(FIELD_VELOCITY), lambda value : sequencer.set_field(FIELD_VELOCITY, value), minimum=1),
+            PatternMenuItem("Gate", lambda : sequencer.get_field(FIELD_GATE), lambda value : sequencer.set_field(FIELD_GATE, value), step=5, minimum=5, maximum=100),
+            PatternMenuItem("Tie", lambda : int(sequencer.get_flag(STEP_TIE)), lambda value : sequencer.set_flag(STEP_TIE, value), maximum=1, labels=("Off", "On")),
+        ), group)
@@ -0,0 +1,75 @@
+# pcolamakerfaire2023 - tools/bench_boot.py
+# 2023 Cooper Dalrymple - me@dcdalrymple.com
+# GPL v3 License
+#
+# Device benchmark of boot cost, comparing imports of the library modules from source (parsed and compiled on the
+# device) with imports of the same modules precompiled by mpy-cross. Upload with `make benchmark` and read the
+# report over serial. Each row includes the cost of the module's own imports, which are cleared between runs.
+
+import gc, os, sys, time
+
+BENCHMARK_DIR = "/bench"
+RUNS = 3
+
+def get_modules(directory:str, extension:str) -> list:
+    try:
+        return sorted(name[:-len(extension)] for name in os.listdir(directory) if name.endswith(extension))
+    except OSError:
+        return []
+
+def unload(modules:list):
+    for name in modules:
+        if name in sys.modules:
+            del sys.modules[name]
+    gc.collect()
+
+def measure(directory:str, names:list, modules:list) -> tuple:
+    # Returns (microseconds, bytes allocated, bytes retained) of importing the named modules from the directory
+    sys.path.insert(0, directory)
+    try:
+        unload(modules)
+        free = gc.mem_free()
+        start = time.monotonic_ns()
+        for name in names:
+            __import__(name)
+        duration = (time.monotonic_ns() - start) // 1000
+        allocated = free - gc.mem_free()
+        gc.collect()
+        retained = free - gc.mem_free()
+    finally:
+        sys.path.pop(0)
+        unload(modules)
+    return (duration, allocated, retained)
+
+def best(directory:str, names:list, modules:list) -> tuple:
+    result = None
+    for i in range(RUNS):
+        value = measure(directory, names, modules)
+        if result is None or value[0] < result[0]:
+            result = value
+    return result
+
+def main():
+    modules = get_modules(BENCHMARK_DIR + "/py", ".py")
+    if not modules:
+        print("No benchmark modules found. Upload them with \"make benchmark\".")
+        return
+    print("{:<12} {:>9} {:>9} {:>8} {:>8} {:>8} {:>8}".format("module", "py us", "mpy us", "py alloc", "mpy", "py heap", "mpy"))
+    rows = [(name, (name,)) for name in modules] + [("(all)", tuple(modules))]
+    for title, names in rows:
+        source = best(BENCHMARK_DIR + "/py", names, modules)
+        compiled = best(BENCHMARK_DIR + "/mpy", names, modules)
+        print("{:<12} {:>9d} {:>9d} {:>8d} {:>8d} {:>8d} {:>8d}".format(
+            title,
+            source[0], compiled[0],
+            source[1], compiled[1],
+            source[2], compiled[2]
+        ))
+        if title == "(all)":
+            print("Boot time reduced by {:d}%, peak allocation by {:d}%".format(
+                100 - compiled[0] * 100 // max(source[0], 1),
+                100 - compiled[1] * 100 // max(source[1], 1)
+            ))
+    print("Free heap: {:d}".format(gc.mem_free()))
+
+main()
@@ -0,0 +1,43 @@
+# pcolamakerfaire2023 - tools/bench_drum_dispatch.py
+# 2023 Cooper Dalrymple - me@dcdalrymple.com
+# GPL v3 License
+#
+# Host benchmark of the cost of dispatching a sequencer step in the drum machine as the number of tracks grows. The
+# program is built on the simulator for each track count with every track playing on every other step, and the time
+# of each step includes the release of the previous notes, choke groups, the press of new notes and the step cursor.
+# Usage: python3 tools/bench_drum_dispatch.py [steps] [length]
+
+import sys, time
+import host
+import simulator
+
+TRACK_COUNTS = (4, 8, 12, 16)
+
+def measure(tracks:int, length:int, steps:int) -> tuple:
+    g = simulator.load_program("drum_machine", constants={"TRACKS": tracks, "LENGTH": length})
+    sequencer, synth, display = g["sequencer"], g["synth"], g["display"]
+    for track in range(tracks):
+        for position in range(track % 2, length, 2):
+            sequencer.set_note(position, track + 1, 1.0, track)
+    sequencer.toggle()
+    for i in range(length):
+        sequencer.advance()
+    synth.presses = synth.releases = display.writes = 0
+    start = time.perf_counter()
+    for i in range(steps):
+        sequencer.advance()
+    elapsed = time.perf_counter() - start
+    return (elapsed / steps, synth.presses / steps, synth.releases / steps, display.writes / steps)
+
+def main() -> int:
+    steps = int(sys.argv[1]) if len(sys.argv) > 1 else 4096
+    length = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+    print("{:d} steps of a {:d} step pattern".format(steps, length))
+    print("{:>6s} {:>10s} {:>10s} {:>9s} {:>9s} {:>9s}".format("tracks", "us/step", "us/track", "presses", "releases", "writes"))
+    for tracks in TRACK_COUNTS:
+        duration, presses, releases, writes = measure(tracks, length, steps)
+        print("{:6d} {:10.2f} {:10.2f} {:9.2f} {:9.2f} {:9.2f}".format(tracks, duration * 1e6, duration * 1e6 / tracks, presses, releases, writes))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
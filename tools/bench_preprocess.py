@@ -0,0 +1,129 @@
+# pcolamakerfaire2023 - tools/bench_preprocess.py
+# 2023 Cooper Dalrymple - me@dcdalrymple.com
+# GPL v3 License
+#
+# Host benchmark of the sample preprocessing stages of preprocess.py against equivalent pure Python loops, run on a
+# synthetic sample with leading and trailing silence at a different rate than the audio driver. Results of both are
+# compared so that the vectorized stages can be checked as well as timed.
+# Usage: python3 tools/bench_preprocess.py [repeats] [sample_rate]
+
+import sys, math, random, time
+import numpy
+import host
+import simulator
+simulator.install()
+from preprocess import trim, normalize, find_loop, resample, TRIM_THRESHOLD
+
+LOAD_SAMPLES = 8192
+MAX_SAMPLES = 4096
+
+def get_sample(sample_rate:int, length:int=LOAD_SAMPLES) -> numpy.ndarray:
+    rng = random.Random(0)
+    data = [0] * length
+    start, end = length // 8, length * 7 // 8
+    for i in range(start, end):
+        t = (i - start) / sample_rate
+        level = math.exp(-t * 4.0) * 8000
+        data[i] = int(level * math.sin(2 * math.pi * 220.0 * t) + rng.uniform(-20, 20))
+    return numpy.array(data, dtype=numpy.int16)
+
+# Pure Python equivalents, processing one sample at a time
+
+def trim_loop(data:list, threshold:float=TRIM_THRESHOLD) -> list:
+    peak = 0
+    for value in data:
+        peak = max(peak, abs(value))
+    if not peak:
+        return data
+    limit = peak * threshold
+    start = 0
+    while start < len(data) and abs(data[start]) <= limit:
+        start += 1
+    end = len(data)
+    while end > start and abs(data[end - 1]) <= limit:
+        end -= 1
+    return data[start:end]
+
+def normalize_loop(data:list, amplitude:int) -> list:
+    peak = 0
+    for value in data:
+        peak = max(peak, abs(value))
+    if not peak or peak == amplitude:
+        return data
+    scale = amplitude / peak
+    return [int(value * scale) for value in data]
+
+def find_loop_loop(data:list) -> tuple:
+    crossings = [i + 1 for i in range(len(data) - 1) if data[i] < 0 and data[i + 1] >= 0]
+    if len(crossings) < 2:
+        return (0, len(data))
+    return (crossings[0], crossings[-1])
+
+def resample_loop(data:list, sample_rate:int, target_rate:int, max_samples:int=None) -> list:
+    length = int(len(data) * target_rate / sample_rate)
+    if max_samples is not None:
+        length = min(length, max_samples)
+    if sample_rate == target_rate or length < 2:
+        return data[:length]
+    step = sample_rate / target_rate
+    result = [0] * length
+    last = len(data) - 1
+    for i in range(length):
+        position = i * step
+        index = min(int(position), last)
+        fraction = position - index
+        following = data[min(index + 1, last)]
+        result[i] = int(data[index] + (following - data[index]) * fraction)
+    return result
+
+def measure(function, repeats:int, *args) -> tuple:
+    best = None
+    for i in range(repeats):
+        start = time.perf_counter()
+        result = function(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return (result, best)
+
+def main() -> int:
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    sample_rate = int(sys.argv[2]) if len(sys.argv) > 2 else 44100
+    target_rate = simulator.SAMPLE_RATE
+    amplitude = simulator.SAMPLE_AMPLITUDE
+
+    data = get_sample(sample_rate)
+    values = [int(value) for value in data]
+    print("{:d} samples at {:d}Hz to {:d}Hz, best of {:d}".format(len(data), sample_rate, target_rate, repeats))
+    print("{:10s} {:>12s} {:>12s} {:>8s} {:>10s}".format("stage", "vectorized", "loop", "speedup", "max error"))
+
+    failed = False
+    def report(name:str, vectorized:tuple, loop:tuple, error:float):
+        nonlocal failed
+        print("{:10s} {:10.3f}ms {:10.3f}ms {:7.1f}x {:10.1f}".format(name, vectorized[1] * 1000, loop[1] * 1000, loop[1] / vectorized[1], error))
+        if error > 1:
+            failed = True
+
+    def difference(a, b) -> float:
+        if len(a) != len(b):
+            return math.inf
+        return float(numpy.max(numpy.abs(numpy.array(a, dtype=numpy.int32) - numpy.array(b, dtype=numpy.int32)))) if len(a) else 0.0
+
+    vectorized, loop = measure(trim, repeats, data), measure(trim_loop, repeats, values)
+    report("trim", vectorized, loop, difference(vectorized[0], loop[0]))
+    data, values = vectorized[0], loop[0]
+
+    vectorized, loop = measure(resample, repeats, data, sample_rate, target_rate, MAX_SAMPLES), measure(resample_loop, repeats, values, sample_rate, target_rate, MAX_SAMPLES)
+    report("resample", vectorized, loop, difference(vectorized[0], loop[0]))
+    data, values = vectorized[0], loop[0]
+
+    vectorized, loop = measure(normalize, repeats, data, amplitude), measure(normalize_loop, repeats, values, amplitude)
+    report("normalize", vectorized, loop, difference(vectorized[0], loop[0]))
+    data, values = vectorized[0], loop[0]
+
+    vectorized, loop = measure(find_loop, repeats, data), measure(find_loop_loop, repeats, values)
+    report("find_loop", vectorized, loop, 0.0 if vectorized[0] == loop[0] else math.inf)
+    print("loop points {:d}-{:d} of {:d} samples".format(vectorized[0][0], vectorized[0][1], len(data)))
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,98 @@
+# pcolamakerfaire2023 - tools/bench_scheduler.py
+# 2023 Cooper Dalrymple - me@dcdalrymple.com
+# GPL v3 License
+#
+# Host benchmark of note-on latency under UI load, comparing the cooperative round-robin task loop with
+# the priority scheduler. Usage: python3 tools/bench_scheduler.py [seconds] [seed]
+
+import sys, random, time
+import host
+from scheduler import Scheduler, PRIORITY_MIDI, PRIORITY_KEYBOARD, PRIORITY_DISPLAY, PRIORITY_BACKGROUND
+
+NOTE_INTERVAL = 0.007 # Mean time between incoming notes
+DISPLAY_INTERVAL = 0.033
+DISPLAY_COST = 0.012 # Full redraw of both display rows
+DISPLAY_SLICES = 16
+PATCH_INTERVAL = 1.0
+PATCH_COST = 0.040 # Loading and applying a full patch
+PATCH_SLICES = 20
+
+def busy(duration:float):
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        pass
+
+class Midi:
+    def __init__(self, duration:float, rng:random.Random):
+        self._events = []
+        t = time.perf_counter()
+        end = t + duration
+        while t < end:
+            t += rng.expovariate(1 / NOTE_INTERVAL)
+            self._events.append(t)
+        self._index = 0
+        self.latencies = []
+    def update(self):
+        now = time.perf_counter()
+        while self._index < len(self._events) and self._events[self._index] <= now:
+            self.latencies.append(now - self._events[self._index])
+            self._index += 1
+    def is_done(self) -> bool:
+        return self._index >= len(self._events)
+
+class Keyboard:
+    def update(self):
+        busy(0.0001)
+
+def run_cooperative(duration:float, rng:random.Random) -> list:
+    midi = Midi(duration, rng)
+    keyboard = Keyboard()
+    next_display = next_patch = time.perf_counter()
+    while not midi.is_done():
+        midi.update()
+        keyboard.update()
+        now = time.perf_counter()
+        if now >= next_display:
+            next_display += DISPLAY_INTERVAL
+            busy(DISPLAY_COST)
+        if now >= next_patch:
+            next_patch += PATCH_INTERVAL
+            busy(PATCH_COST)
+    return midi.latencies
+
+def sliced(cost:float, slices:int):
+    for i in range(slices):
+        busy(cost / slices)
+        yield
+
+def run_priority(duration:float, rng:random.Random) -> list:
+    midi = Midi(duration, rng)
+    scheduler = Scheduler()
+    scheduler.watch("midi", midi, PRIORITY_MIDI, deadline=2)
+    scheduler.watch("keyboard", Keyboard(), PRIORITY_KEYBOARD, deadline=5)
+    scheduler.add("display", lambda : scheduler.spawn(sliced(DISPLAY_COST, DISPLAY_SLICES)), PRIORITY_DISPLAY, interval=int(DISPLAY_INTERVAL*1000))
+    scheduler.add("patch", lambda : scheduler.spawn(sliced(PATCH_COST, PATCH_SLICES)), PRIORITY_BACKGROUND, interval=int(PATCH_INTERVAL*1000))
+    while not midi.is_done():
+        scheduler.step()
+    return midi.latencies
+
+def percentile(values:list, amount:float) -> float:
+    return values[min(int(len(values) * amount), len(values) - 1)]
+
+def report(name:str, latencies:list):
+    latencies = sorted(latencies)
+    print("{:<12} {:>6d} {:>8.3f} {:>8.3f} {:>8.3f} {:>8.3f}".format(
+        name, len(latencies),
+        percentile(latencies, 0.5) * 1000,
+        percentile(latencies, 0.95) * 1000,
+        percentile(latencies, 0.99) * 1000,
+        latencies[-1] * 1000
+    ))
+
+if __name__ == "__main__":
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 3.0
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    print("Note-on latency (ms) over {:.1f}s, seed {:d}".format(duration, seed))
+    print("{:<12} {:>6} {:>8} {:>8} {:>8} {:>8}".format("mode", "notes", "p50", "p95", "p99", "max"))
+    report("cooperative", run_cooperative(duration, random.Random(seed)))
+    report("priority", run_priority(duration, random.Random(seed)))
@@ -0,0 +1,239 @@
+# pcolamakerfaire2023 - tools/check_alloc.py
+# 2023 Cooper Dalrymple - me@dcdalrymple.com
+# GPL v3 License
+#
+# Host check that note events don't allocate within the programs' own code. Each program is set up with the
+# simulator stand-ins, warmed up, and then driven with note, key, pitch bend, sustain, sequencer and looper events.
+# Allocations traced by tracemalloc are attributed to the source line which made them, and bytecode which allocates
+# on MicroPython (building tuples, lists, dicts, strings, slices and closures) is detected even where CPython reuses
+# objects from its free lists. Allocations within the simulator are ignored. Exits with a non-zero status if any
+# event allocates.
+#
+#   python3 tools/check_alloc.py [program ...] [--events 5] [-v]
+
+import argparse, contextlib, dis, io, linecache, os, shutil, sys, tempfile, tracemalloc
+import host, simulator
+simulator.install()
+import looper as looper_module
+import step_sequencer
+
+PROGRAMS = ("monophonic", "polyphonic", "sampler", "drum_machine")
+WARMUP = 2 # Passes over all events before measuring
+ITERATOR_SIZE = 64 # Upper bound of the size of an iterator object and its garbage collector header
+CELL_SIZE = 40
+NUMBER_SIZE = 32 # Upper bound of the size of an int below 2**60 or a float, both are immediate objects on the device
+ALLOCATING_OPCODES = frozenset(dis.opmap[name] for name in (
+    "BUILD_TUPLE", "BUILD_LIST", "BUILD_SET", "BUILD_MAP", "BUILD_CONST_KEY_MAP", "BUILD_STRING", "BUILD_SLICE",
+    "FORMAT_VALUE", "MAKE_FUNCTION", "MAKE_CELL", "CALL_FUNCTION_EX", "RETURN_GENERATOR"
+) if name in dis.opmap)
+
+class AllocationTracer:
+    # Compares snapshots of traced allocations at every call and return to find the source lines which allocate,
+    # including temporary objects which are freed again before the event completes. Objects which CPython allocates
+    # but MicroPython doesn't are ignored: numbers, frame objects and the iterators of for loops, which are kept on the
+    # stack. Closure cells created on entry to a simulator function are ignored as well, as they are attributed to
+    # the line of the caller.
+    def __init__(self, paths:tuple):
+        self._paths = paths
+        self._snapshot = None
+        self.allocations = {}
+        self.operations = {}
+
+    def _is_ignored(self, frame, event:str, filename:str, lineno:int, size:int, count:int) -> bool:
+        if count > 0 and size <= NUMBER_SIZE * count:
+            return True
+        if event == "call" and filename == frame.f_code.co_filename and lineno == frame.f_code.co_firstlineno:
+            return True
+        if event == "call" and frame.f_code.co_cellvars and not frame.f_code.co_filename in self._paths and count <= len(frame.f_code.co_cellvars) and size <= CELL_SIZE * count:
+            return True
+        return size <= ITERATOR_SIZE * count and linecache.getline(filename, lineno).lstrip().startswith("for ")
+
+    def _hook(self, frame, event, arg):
+        # Events entirely within the simulator are skipped, their allocations are ignored either way
+        if frame is not None and not frame.f_code.co_filename in self._paths and (event.startswith("c_") or frame.f_back is None or not frame.f_back.f_code.co_filename in self._paths):
+            return
+        snapshot = tracemalloc.take_snapshot()
+        for statistic in snapshot.compare_to(self._snapshot, "lineno"):
+            if statistic.size_diff <= 0:
+                continue
+            filename, lineno = statistic.traceback[0].filename, statistic.traceback[0].lineno
+            if not filename in self._paths or self._is_ignored(frame, event, filename, lineno, statistic.size_diff, statistic.count_diff):
+                continue
+            key = (os.path.basename(filename), lineno)
+            self.allocations[key] = self.allocations.get(key, 0) + statistic.size_diff
+        self._snapshot = tracemalloc.take_snapshot() # Excludes allocations of this hook
+
+    def _trace(self, frame, event, arg):
+        if not frame.f_code.co_filename in self._paths:
+            return None
+        frame.f_trace_opcodes = True
+        return self._trace_opcode
+    def _trace_opcode(self, frame, event, arg):
+        if event == "opcode":
+            code = frame.f_code.co_code
+            opcode = code[frame.f_lasti]
+            if opcode in ALLOCATING_OPCODES and (opcode != dis.opmap["BUILD_TUPLE"] or code[frame.f_lasti + 1]):
+                key = (os.path.basename(frame.f_code.co_filename), frame.f_lineno)
+                self.operations[key] = self.operations.get(key, 0) + 1
+        return self._trace_opcode
+
+    def start(self):
+        self.allocations.clear()
+        self.operations.clear()
+        self._snapshot = tracemalloc.take_snapshot()
+        sys.setprofile(self._hook)
+        sys.settrace(self._trace)
+    def stop(self):
+        sys.settrace(None)
+        sys.setprofile(None)
+        self._hook(None, "stop", None)
+    def get_total(self) -> tuple:
+        # Returns (allocating operations, bytes)
+        return (sum(self.operations.values()), sum(self.allocations.values()))
+
+def drain_freelists() -> list:
+    # Holding enough objects empties CPython's list and dict free lists so that those created by builtins are traced.
+    # Floats are immediate objects on CircuitPython, so the float free list is filled instead.
+    tuple(float(i) for i in range(200))
+    held = []
+    held.extend([i] for i in range(200))
+    held.extend({i: i} for i in range(200))
+    return held
+
+def get_paths() -> tuple:
+    # Sources which run on the device
+    return tuple(os.path.join(host.ROOT, name) for name in os.listdir(host.ROOT) if name.endswith(".py"))
+
+def get_events(program:str, g:dict) -> list:
+    # (name, callback, args) of each note event
+    events = []
+    if program == "drum_machine":
+        keyboard, sequencer = g["keyboard"], g["sequencer"]
+        for keynum in (0, 3, 5, 3):
+            events.append(("key press", keyboard.press_key, (keynum,)))
+            events.append(("key release", keyboard.release_key, (keynum,)))
+        for i in range(4):
+            events.append(("sequencer step", sequencer.advance, ()))
+        return events
+    midi, keyboard = g["app"].midi, g["app"].keyboard
+    for notenum in (60, 64, 67):
+        events.append(("midi note on", lambda notenum=notenum : midi.receive("note_on", notenum, 1.0), ()))
+    events.append(("midi pitch bend", lambda : midi.receive("pitch_bend", 0.25), ()))
+    events.append(("midi sustain", lambda : midi.receive("control_change", 64, 1), ()))
+    events.append(("midi sustain", lambda : midi.receive("control_change", 64, 0), ()))
+    for notenum in (60, 64, 67):
+        events.append(("midi note off", lambda notenum=notenum : midi.receive("note_off", notenum), ()))
+    for keynum in (0, 4):
+        events.append(("key press", keyboard.press_key, (keynum,)))
+    for keynum in (0, 4):
+        events.append(("key release", keyboard.release_key, (keynum,)))
+    app = g["app"]
+    if app.wavetables:
+        # Oscillators play the wavetable while the modulation wheel sweeps its frames. Frames are read from flash by
+        # the display task rather than the MIDI callback, and file reads allocate within CPython's io module only.
+        with contextlib.redirect_stdout(io.StringIO()):
+            for i, path in enumerate(app.menu.get_paths()):
+                if path.endswith("/Waveform"):
+                    app.menu.get_parameter(i).set(6)
+        for value in (0, 64, 127):
+            events.append(("midi mod wheel", lambda value=value : midi.receive("control_change", 1, value), ()))
+    sequencer = g["app"].sequencer
+    if sequencer:
+        # Alternating notes, ties and rests on two tracks
+        for track in range(2):
+            sequencer.set_track(track)
+            for position in range(0, sequencer.get_length(), 3):
+                sequencer.set_edit_position(position)
+                sequencer.set_field(step_sequencer.FIELD_NOTE, 48 + position + track * 12)
+                sequencer.set_flag(step_sequencer.STEP_ON, True)
+                sequencer.set_flag(step_sequencer.STEP_TIE, position % 2 == 0)
+        sequencer.set_mode(step_sequencer.SEQ_PLAY)
+        for i in range(4):
+            events.append(("sequencer step", sequencer.step, (0, 125)))
+    looper = g["app"].looper
+    if looper:
+        # Note events are overdubbed onto a recorded phrase while it plays back
+        looper.set_mode(looper_module.LOOP_RECORD)
+        for notenum in (48, 52, 55):
+            midi.receive("note_on", notenum, 1.0)
+            midi.receive("note_off", notenum)
+        looper.set_mode(looper_module.LOOP_OVERDUB)
+        for elapsed in (0, looper.get_length() // 2, looper.get_length()):
+            events.append(("looper playback", looper.advance, (elapsed,)))
+    return events
+
+def check(program:str, count:int, verbose:bool=False) -> bool:
+    # Files are read from and written to a temporary device filesystem, with generated samples for the sampler
+    root = tempfile.mkdtemp(prefix="check-alloc-")
+    if not os.path.isdir(os.path.join(host.ROOT, "samples")):
+        simulator.write_samples(os.path.join(root, "samples"))
+    filesystem = simulator.DeviceFilesystem(root)
+    filesystem.install()
+    try:
+        return check_events(program, count, verbose)
+    finally:
+        filesystem.uninstall()
+        shutil.rmtree(root, ignore_errors=True)
+
+def check_events(program:str, count:int, verbose:bool=False) -> bool:
+    g = simulator.load_program(program)
+    events = get_events(program, g)
+    tracer = AllocationTracer(get_paths())
+    results = {}
+    for i in range(WARMUP):
+        for name, callback, args in events:
+            callback(*args)
+    # The first traced pass is discarded as well, tracing allocates once for some of the frames it inspects
+    for i in range(-1, count):
+        for name, callback, args in events:
+            held = drain_freelists()
+            tracemalloc.start()
+            try:
+                tracer.start()
+                callback(*args)
+                tracer.stop()
+            finally:
+                tracemalloc.stop()
+            del held
+            if i < 0:
+                continue
+            operations, size = tracer.get_total()
+            total_operations, total_size, calls, lines = results.get(name, (0, 0, 0, {}))
+            for key, value in tracer.operations.items():
+                line = lines.get(key, [0, 0])
+                line[0] += value
+                lines[key] = line
+            for key, value in tracer.allocations.items():
+                line = lines.get(key, [0, 0])
+                line[1] += value
+                lines[key] = line
+            results[name] = (total_operations + operations, total_size + size, calls + 1, lines)
+
+    passed = True
+    for name, (operations, size, calls, lines) in results.items():
+        if operations or size:
+            passed = False
+        if operations or size or verbose:
+            print("{:<14} {:<16} {:>6d} events {:>6.1f} allocs/event {:>8.1f} bytes/event".format(program, name, calls, operations / calls, size / calls))
+        for (filename, lineno), (count, size) in sorted(lines.items(), key=lambda item : (-item[1][0], -item[1][1])):
+            print("  {}:{:d} {:.1f} allocs/event {:.1f} bytes/event".format(filename, lineno, count / calls, size / calls))
+    print("{}: {}".format(program, "ok" if passed else "FAIL"))
+    return passed
+
+def main(argv:list=None) -> int:
+    parser = argparse.ArgumentParser(description="Check that note events don't allocate in the host simulation.")
+    parser.add_argument("programs", nargs="*", help="any of {}, defaults to all".format(", ".join(PROGRAMS)))
+    parser.add_argument("--events", type=int, default=5, help="passes over the events of each program")
+    parser.add_argument("-v", "--verbose", action="store_true", help="list every event")
+    args = parser.parse_args(argv)
+    for program in args.programs:
+        if not program in PROGRAMS:
+            parser.error("unknown program: {}".format(program))
+    failed = 0
+    for program in args.programs or PROGRAMS:
+        if not check(program, args.events, args.verbose):
+            failed += 1
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
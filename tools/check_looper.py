@@ -0,0 +1,119 @@
+# pcolamakerfaire2023 - tools/check_looper.py
+# 2023 Cooper Dalrymple - me@dcdalrymple.com
+# GPL v3 License
+#
+# Host check that the looper reads back the phrases it writes and that truncated or malformed phrase files are
+# rejected without changing the current loop. Time is virtual: ticks_ms of looper.py is replaced by a counter. Exits
+# with a non-zero status if any check fails.
+#
+#   python3 tools/check_looper.py
+
+import contextlib, io, os, sys, tempfile
+import simulator
+simulator.install()
+import looper
+from looper import Looper, LOOP_RECORD, LOOP_PLAY
+
+class Clock:
+    def __init__(self):
+        self.now = 0
+    def __call__(self) -> int:
+        return self.now
+
+def record(clock:Clock, notes:tuple) -> Looper:
+    # Records each note for 100ms followed by a 50ms rest and starts playback
+    target = Looper()
+    target.set_mode(LOOP_RECORD)
+    for notenum in notes:
+        target.note_on(notenum)
+        clock.now += 100
+        target.note_off(notenum)
+        clock.now += 50
+    target.set_mode(LOOP_PLAY)
+    return target
+
+def state(target:Looper) -> tuple:
+    return (target.get_mode(), target.get_count(), target.get_length(), tuple(target._data1[:target.get_count()]))
+
+def check_roundtrip(clock:Clock, dir:str) -> bool:
+    # A written phrase is read back with the same notes and length
+    source = record(clock, (60, 64, 67))
+    if not source.write("roundtrip", dir):
+        return False
+    target = Looper()
+    return target.read("roundtrip", dir) and state(target)[1:] == state(source)[1:]
+
+def check_truncated(clock:Clock, dir:str) -> bool:
+    # Every truncation of a phrase either reads or leaves the playing loop and its events untouched
+    source = record(clock, (48, 50, 52, 53, 55))
+    if not source.write("source", dir):
+        return False
+    with open(os.path.join(dir, "source.mid"), "rb") as file:
+        data = file.read()
+    target = record(clock, (72, 76))
+    previous = state(target)
+    rejected = 0
+    for size in range(len(data)):
+        with open(os.path.join(dir, "truncated.mid"), "wb") as file:
+            file.write(data[:size])
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = target.read("truncated", dir)
+        if result:
+            target = record(clock, (72, 76))
+        elif state(target) != previous:
+            return False
+        else:
+            rejected += 1
+    return rejected > 0 and target.get_mode() == LOOP_PLAY
+
+def play(target:Looper) -> list:
+    # (ms, press or release, notenum) of one pass over the loop
+    events = []
+    target.set_press(lambda notenum, velocity : events.append((elapsed, "press", notenum)))
+    target.set_release(lambda notenum : events.append((elapsed, "release", notenum)))
+    for elapsed in range(target.get_length()):
+        target.advance(elapsed)
+    return events
+
+def check_quantized_short_note(clock:Clock, dir:str) -> bool:
+    # A note shorter than half a 1/16 step at 120 BPM keeps its length when its note on moves to the grid, in playback
+    # and in the written phrase
+    source = Looper()
+    source.set_quantize(2)
+    clock.now = 0
+    source.set_mode(LOOP_RECORD)
+    clock.now = 70
+    source.note_on(60)
+    clock.now = 100
+    source.note_off(60)
+    clock.now = 1000
+    source.set_mode(LOOP_PLAY)
+    expected = [(125, "press", 60), (155, "release", 60)]
+    if play(source) != expected or not source.write("quantized", dir):
+        return False
+    target = Looper()
+    if not target.read("quantized", dir):
+        return False
+    target.set_mode(LOOP_PLAY)
+    return play(target) == expected
+
+CHECKS = (
+    ("roundtrip", check_roundtrip),
+    ("truncated file", check_truncated),
+    ("quantized short note", check_quantized_short_note),
+)
+
+def main() -> int:
+    clock = Clock()
+    looper.ticks_ms = clock
+    failed = 0
+    with tempfile.TemporaryDirectory() as dir:
+        for name, check in CHECKS:
+            passed = check(clock, dir)
+            print("{}: {}".format(name, "ok" if passed else "FAIL"))
+            if not passed:
+                failed += 1
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,93 @@
+# pcolamakerfaire2023 - tools/check_presets.py
+# 2023 Cooper Dalrymple - me@dcdalrymple.com
+# GPL v3 License
+#
+# Host check that presets load into the right parameters of the synth programs: presets of the original programs,
+# which are nested lists without a schema fingerprint, presets of the current layout, and presets of an unknown
+# layout, which must be rejected rather than applied by position. Exits with a non-zero status if any check fails.
+#
+#   python3 tools/check_presets.py
+
+import contextlib, io, json, os, sys, tempfile
+import simulator
+simulator.install()
+from menu import pack_patch
+
+# Values of an oscillator group as saved by the original programs: mix, tune, waveform, filter, amplitude and filter
+# envelopes, then tremolo, vibrato, pan and filter LFOs
+ORIGINAL_OSCILLATOR = [[0.5, 0.0], [0.0, 0.0, 0.0, 0.0], 3, [1, 0.3, 0.6], [0.0, 1.0, 0.0, 0.75, 0.0], [0.0, 0.0, 1.0], [0.0, 0.0], [0.0, 0.0], [0.0, 0.0], [0.0, 0.9]]
+ORIGINAL_EXPECTED = (
+    ("/Level", 0.5),
+    ("/Waveform", 3),
+    ("/Position", 0.0), # Not in the original layout, keeps its initial value
+    ("/Filter/Type", 1),
+    ("/Filter/Freq", 0.3),
+    ("/Filter/Reso", 0.6),
+    ("AEnv/Stn Lvl", 0.75),
+    ("FltrLFO/Rate", 0.9),
+)
+ORIGINAL_PRESETS = (
+    ("monophonic", [[0.0, 0.0], 0, [1.0], [0], ORIGINAL_OSCILLATOR, ORIGINAL_OSCILLATOR], ("Osc1/", "Osc2/")),
+    ("polyphonic", [0, [0.0, 0.0], ORIGINAL_OSCILLATOR], ("Osc/",)),
+)
+
+def load(menu, dir:str, name:str, data) -> list:
+    with open(os.path.join(dir, name + ".json"), "w") as file:
+        json.dump(data, file)
+    with contextlib.redirect_stdout(io.StringIO()):
+        return menu._load(name, dir)
+
+def check_original(dir:str) -> bool:
+    # Presets of the original programs are moved past the parameters added since by path
+    for program, data, groups in ORIGINAL_PRESETS:
+        menu = simulator.load_program(program)["app"].menu
+        values = load(menu, dir, program + "-original", data)
+        if values is None or len(values) != len(menu.get_paths()):
+            return False
+        paths = menu.get_paths()
+        for group in groups:
+            for suffix, expected in ORIGINAL_EXPECTED:
+                index = next(i for i in range(len(paths)) if paths[i].startswith(group) and paths[i].endswith(suffix))
+                if abs(values[index] - expected) > 1e-6:
+                    return False
+    return True
+
+def check_current(dir:str) -> bool:
+    # Presets of the current layout load unchanged
+    for program, data, groups in ORIGINAL_PRESETS:
+        menu = simulator.load_program(program)["app"].menu
+        current = list(menu.get())
+        values = load(menu, dir, program + "-current", pack_patch(current, menu.get_fingerprint()))
+        if values is None or list(values) != current:
+            return False
+    return True
+
+def check_unknown(dir:str) -> bool:
+    # Presets of an unknown layout, with or without a fingerprint, are rejected
+    for program, data, groups in ORIGINAL_PRESETS:
+        menu = simulator.load_program(program)["app"].menu
+        count = len(menu.get_paths())
+        if not load(menu, dir, program + "-short", [0.0] * (count - 3)) is None:
+            return False
+        if not load(menu, dir, program + "-stale", pack_patch([0.0] * count, menu.get_fingerprint() ^ 1)) is None:
+            return False
+    return True
+
+CHECKS = (
+    ("original preset", check_original),
+    ("current preset", check_current),
+    ("unknown layout", check_unknown),
+)
+
+def main() -> int:
+    failed = 0
+    with tempfile.TemporaryDirectory() as dir:
+        for name, check in CHECKS:
+            passed = check(dir)
+            print("{}: {}".format(name, "ok" if passed else "FAIL"))
+            if not passed:
+                failed += 1
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
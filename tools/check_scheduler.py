@@ -0,0 +1,102 @@
+# pcolamakerfaire2023 - tools/check_scheduler.py
+# 2023 Cooper Dalrymple - me@dcdalrymple.com
+# GPL v3 License
+#
+# Host check that no task or job of the priority scheduler is starved. Time is virtual: ticks_ms of scheduler.py is
+# replaced by a counter which advances by one millisecond per pass. Exits with a non-zero status if any check fails.
+#
+#   python3 tools/check_scheduler.py
+
+import contextlib, io, sys
+import simulator
+simulator.install()
+import scheduler
+from scheduler import Scheduler, PRIORITY_MIDI, PRIORITY_ENCODER, PRIORITY_DISPLAY, PRIORITY_BACKGROUND
+
+PASSES = 1000
+
+class Clock:
+    def __init__(self):
+        self.now = 0
+    def __call__(self) -> int:
+        return self.now
+
+def run(target:Scheduler, clock:Clock, passes:int=PASSES):
+    for i in range(passes):
+        target.step()
+        clock.now += 1
+
+def counter(counts:dict, name:str):
+    counts[name] = 0
+    def update():
+        counts[name] += 1
+    return update
+
+def job(counts:dict, name:str, slices:int):
+    counts[name] = 0
+    def steps():
+        for i in range(slices):
+            counts[name] += 1
+            yield
+    return steps()
+
+def check_always_due(clock:Clock) -> bool:
+    # A lower priority task without an interval alongside an interval task and a spawned job
+    target = Scheduler()
+    counts = {}
+    target.add("midi", counter(counts, "midi"), PRIORITY_MIDI)
+    target.add("busy", counter(counts, "busy"), PRIORITY_ENCODER)
+    target.add("display", counter(counts, "display"), PRIORITY_DISPLAY, interval=33)
+    target.add("background", counter(counts, "background"), PRIORITY_BACKGROUND)
+    target.spawn(job(counts, "job", 20))
+    run(target, clock)
+    return counts["midi"] == PASSES and counts["job"] == 20 and not target.has_jobs() and counts["display"] >= PASSES // 33 and counts["busy"] > 0 and counts["background"] > 0
+
+def check_cancel(clock:Clock) -> bool:
+    # A cancelled job doesn't run again while the job which replaced it completes
+    target = Scheduler()
+    counts = {}
+    first = job(counts, "first", 20)
+    target.spawn(first)
+    run(target, clock, 5)
+    target.cancel(first)
+    target.spawn(job(counts, "second", 20))
+    run(target, clock, 50)
+    return counts["first"] < 20 and counts["second"] == 20 and not target.has_jobs()
+
+def check_remote_job(clock:Clock) -> bool:
+    # The remote of a program keeps its turns alongside the display while a job completes
+    run_scheduler = Scheduler.run
+    Scheduler.run = lambda self : None # Driven one pass at a time below
+    try:
+        app = simulator.load_program("monophonic", constants={"SCHEDULER": True, "REMOTE": True})["app"]
+    finally:
+        Scheduler.run = run_scheduler
+    counts = {}
+    app.scheduler.spawn(job(counts, "job", 200))
+    with contextlib.redirect_stdout(io.StringIO()):
+        run(app.scheduler, clock)
+    runs = {}
+    for task in app.scheduler.get_tasks():
+        runs[task.name] = runs.get(task.name, 0) + task.runs
+    return counts["job"] == 200 and runs.get("remote", 0) > 0 and runs["display"] >= PASSES // 33 - 1 and runs["encoder"] > 0
+
+CHECKS = (
+    ("always due task", check_always_due),
+    ("cancelled job", check_cancel),
+    ("remote and job", check_remote_job),
+)
+
+def main() -> int:
+    clock = Clock()
+    scheduler.ticks_ms = clock
+    failed = 0
+    for name, check in CHECKS:
+        passed = check(clock)
+        print("{}: {}".format(name, "ok" if passed else "FAIL"))
+        if not passed:
+            failed += 1
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,188 @@
+# pcolamakerfaire2023 - tools/deploy.py
+# 2023 Cooper Dalrymple - me@dcdalrymple.com
+# GPL v3 License
+#
+# Incremental upload to a CircuitPython device. Library and program sources listed in LIB_SRCS and PROGRAM_SRCS of the
+# Makefile are only recompiled with mpy-cross when their source changes, and files are only copied to the device when
+# their content differs from the manifest of content hashes stored on the device. Presets, samples, wavetables and drum
+# kits in the local presets, samples, wavetables and kits directories are deployed the same way. The selected program is
+# started by a short code.py which imports its precompiled module through launcher.py, so no source is parsed and
+# compiled on the device at boot. With --program select, the program is chosen from a menu at boot instead. With --remote, a
+# generated boot.py enables the USB serial data channel used by the remote control protocol of remote.py, unless the
+# device already has a boot.py which wasn't deployed by this tool.
+#
+#   python3 tools/deploy.py --device /media/$USER/CIRCUITPY/ [--program monophonic] [--remote] [--dry-run]
+#   python3 tools/deploy.py --device /media/$USER/CIRCUITPY/ --benchmark
+
+import argparse, hashlib, json, os, re, shutil, subprocess, sys, time
+import host
+
+MANIFEST = ".deploy.json" # Stored in the root of the device
+CACHE = ".deploy-cache.json" # Stored in the root of the repository
+DATA_DIRS = ("presets", "samples", "wavetables", "kits")
+LAUNCHER = "import launcher\nlauncher.main({})\n"
+BOOT = "import usb_cdc\nusb_cdc.enable(console=True, data=True)\n" # Serial data channel of the remote control protocol
+BENCHMARK_DIR = "bench"
+
+def get_hash(path) -> str:
+    # Accepts a local path or the generated content of a file
+    digest = hashlib.sha1()
+    if isinstance(path, bytes):
+        digest.update(path)
+        return digest.hexdigest()
+    with open(path, "rb") as file:
+        for block in iter(lambda : file.read(65536), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def get_size(path) -> int:
+    return len(path) if isinstance(path, bytes) else os.path.getsize(path)
+
+def get_srcs(makefile:str, variable:str="LIB_SRCS") -> list:
+    with open(makefile, "r") as file:
+        text = file.read()
+    match = re.search(r"^" + variable + r"\s*:=\s*((?:.*\\\n)*.*)$", text, re.MULTILINE)
+    if not match:
+        return []
+    return match.group(1).replace("\\", " ").split()
+
+def read_json(path:str) -> dict:
+    try:
+        with open(path, "r") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+def write_json(path:str, data:dict):
+    temp = path + ".tmp"
+    with open(temp, "w") as file:
+        json.dump(data, file, indent=1, sort_keys=True)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp, path)
+
+def compile_sources(sources:list, mpy_cross:str, cache:dict, force:bool=False) -> list:
+    # Returns the list of compiled files, only running mpy-cross on sources which changed since the last build
+    compiled = []
+    version = cache.get("mpy-cross")
+    current = get_hash(mpy_cross) if os.path.exists(mpy_cross) else None
+    if version != current:
+        force = True
+        cache.clear()
+        cache["mpy-cross"] = current
+    for source in sources:
+        path = os.path.join(host.ROOT, source + ".py")
+        target = os.path.join(host.ROOT, source + ".mpy")
+        digest = get_hash(path)
+        if force or cache.get(source) != digest or not os.path.exists(target):
+            print("compile {} => {}".format(source + ".py", source + ".mpy"))
+            subprocess.run([mpy_cross, "-o", target, path], check=True)
+            cache[source] = digest
+        compiled.append(source + ".mpy")
+    return compiled
+
+def get_files(sources:list, program:str=None, remote:bool=False) -> dict:
+    # Local path or generated content for each destination path on the device
+    files = {}
+    for source in sources:
+        files[source] = os.path.join(host.ROOT, source)
+    if program:
+        files["code.py"] = LAUNCHER.format("" if program == "select" else "\"{}\"".format(program)).encode()
+    if remote:
+        files["boot.py"] = BOOT.encode()
+    for directory in DATA_DIRS:
+        root = os.path.join(host.ROOT, directory)
+        if not os.path.isdir(root):
+            continue
+        for name in sorted(os.listdir(root)):
+            path = os.path.join(root, name)
+            if os.path.isfile(path):
+                files[directory + "/" + name] = path
+    return files
+
+def get_benchmark_files(sources:list) -> dict:
+    # Source and compiled copies of each module in separate directories, with the boot benchmark as code.py
+    files = {"code.py": os.path.join(host.ROOT, "tools", "bench_boot.py")}
+    for source in sources:
+        name = os.path.splitext(source)[0]
+        files["{}/py/{}.py".format(BENCHMARK_DIR, name)] = os.path.join(host.ROOT, name + ".py")
+        files["{}/mpy/{}.mpy".format(BENCHMARK_DIR, name)] = os.path.join(host.ROOT, source)
+    return files
+
+def deploy(device:str, files:dict, dry_run:bool=False, prune:bool=False) -> tuple:
+    manifest = read_json(os.path.join(device, MANIFEST))
+    copied, skipped, transferred = 0, 0, 0
+    for destination, path in files.items():
+        digest = get_hash(path)
+        target = os.path.join(device, destination)
+        if manifest.get(destination) == digest and os.path.exists(target) and os.path.getsize(target) == get_size(path):
+            skipped += 1
+            continue
+        print("{} => {}".format("(generated)" if isinstance(path, bytes) else os.path.relpath(path, host.ROOT), target))
+        if not dry_run:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            if isinstance(path, bytes):
+                with open(target, "wb") as file:
+                    file.write(path)
+            else:
+                shutil.copyfile(path, target)
+            manifest[destination] = digest
+        copied += 1
+        transferred += get_size(path)
+    if prune:
+        for destination in sorted(set(manifest) - set(files)):
+            if destination in ("code.py", "boot.py"):
+                continue
+            print("remove {}".format(destination))
+            if not dry_run:
+                try:
+                    os.remove(os.path.join(device, destination))
+                except OSError:
+                    pass
+                del manifest[destination]
+    if not dry_run and copied:
+        write_json(os.path.join(device, MANIFEST), manifest)
+    return (copied, skipped, transferred)
+
+def main(argv:list=None) -> int:
+    parser = argparse.ArgumentParser(description="Compile and upload only the files which changed since the last deployment.")
+    parser.add_argument("--device", required=True, help="mount point of the CIRCUITPY drive")
+    parser.add_argument("--program", help="program to start from code.py, ie: monophonic, or select to choose at boot")
+    parser.add_argument("--remote", action="store_true", help="upload a boot.py which enables the USB serial data channel of the remote control")
+    parser.add_argument("--benchmark", action="store_true", help="upload the boot benchmark as code.py")
+    parser.add_argument("--mpy-cross", default=os.path.join(host.ROOT, "bin", "mpy-cross"))
+    parser.add_argument("--force", action="store_true", help="recompile all sources")
+    parser.add_argument("--prune", action="store_true", help="remove files which were previously deployed but no longer exist locally")
+    parser.add_argument("-n", "--dry-run", action="store_true", help="list the files which would be copied")
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.device):
+        print("Device not found: {}".format(args.device))
+        return 1
+    if args.program and args.program != "select" and not os.path.exists(os.path.join(host.ROOT, args.program + ".py")):
+        print("Program not found: {}".format(args.program))
+        return 1
+
+    start = time.monotonic()
+    cache_path = os.path.join(host.ROOT, CACHE)
+    cache = read_json(cache_path)
+    makefile = os.path.join(host.ROOT, "Makefile")
+    libraries = compile_sources(get_srcs(makefile, "LIB_SRCS"), args.mpy_cross, cache, args.force)
+    programs = compile_sources(get_srcs(makefile, "PROGRAM_SRCS"), args.mpy_cross, cache, args.force)
+    write_json(cache_path, cache)
+
+    files = get_files(libraries + programs, None if args.benchmark else args.program, args.remote)
+    if args.remote and os.path.exists(os.path.join(args.device, "boot.py")) and not "boot.py" in read_json(os.path.join(args.device, MANIFEST)):
+        print("Keeping the existing boot.py of the device, enable usb_cdc data in it to use the remote control")
+        del files["boot.py"]
+    if args.benchmark:
+        files.update(get_benchmark_files(libraries))
+    copied, skipped, transferred = deploy(args.device, files, args.dry_run, args.prune)
+    print("{} {:d} files ({:d} bytes), {:d} unchanged in {:.2f}s".format(
+        "Would copy" if args.dry_run else "Copied",
+        copied, transferred, skipped, time.monotonic() - start
+    ))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
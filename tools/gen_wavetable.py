@@ -0,0 +1,112 @@
+# pcolamakerfaire2023 - tools/gen_wavetable.py
+# 2023 Cooper Dalrymple - me@dcdalrymple.com
+# GPL v3 License
+#
+# Wavetable generator. Morphs between basic shapes over a number of frames and renders every frame once per octave
+# with only the harmonics below the Nyquist frequency at the highest note of that octave, so that the device only has
+# to select a table when a note is pressed instead of filtering aliasing at run time. The result is written in the
+# binary format read by wavetable.py.
+#
+#   python3 tools/gen_wavetable.py
+#   python3 tools/gen_wavetable.py --shapes sine saw square --frames 32 --output wavetables/default.wt
+#   python3 tools/gen_wavetable.py --info wavetables/default.wt
+
+import argparse, math, os, struct, sys
+import numpy
+import host
+import simulator
+simulator.install()
+from wavetable import WAVETABLE_MAGIC, WAVETABLE_HEADER, WAVETABLE_HEADER_SIZE
+
+SHAPES = ("sine", "triangle", "saw", "square")
+
+def get_harmonics(shape:str, count:int) -> numpy.ndarray:
+    # Sine amplitudes of harmonics 1 to count
+    n = numpy.arange(1, count + 1, dtype=numpy.float64)
+    if shape == "sine":
+        return (n == 1).astype(numpy.float64)
+    elif shape == "triangle":
+        return numpy.where(n % 2 == 1, 8 / (math.pi ** 2) * (-1.0) ** ((n - 1) // 2) / (n ** 2), 0.0)
+    elif shape == "saw":
+        return 2 / math.pi * (-1.0) ** (n + 1) / n
+    elif shape == "square":
+        return numpy.where(n % 2 == 1, 4 / math.pi / n, 0.0)
+    raise ValueError("unknown shape: {}".format(shape))
+
+def get_frames(shapes:list, frames:int, count:int) -> numpy.ndarray:
+    # Harmonic amplitudes of each frame, crossfaded linearly between neighbouring shapes
+    harmonics = numpy.array([get_harmonics(shape, count) for shape in shapes])
+    if len(shapes) == 1:
+        return numpy.repeat(harmonics, frames, axis=0)
+    result = numpy.zeros((frames, count))
+    for frame in range(frames):
+        position = frame / max(frames - 1, 1) * (len(shapes) - 1)
+        index = min(int(position), len(shapes) - 2)
+        mix = position - index
+        result[frame] = harmonics[index] * (1.0 - mix) + harmonics[index + 1] * mix
+    return result
+
+def render(harmonics:numpy.ndarray, size:int, limit:int) -> numpy.ndarray:
+    # One period of the harmonics up to limit
+    spectrum = numpy.zeros(size // 2 + 1, dtype=numpy.complex128)
+    count = min(limit, len(harmonics))
+    # A sine of amplitude a is -j*a/2 in the spectrum of numpy.fft.irfft scaled by size
+    spectrum[1:count + 1] = -0.5j * harmonics[:count] * size
+    return numpy.fft.irfft(spectrum, size)
+
+def generate(shapes:list, frames:int, size:int, octaves:int, base:int, sample_rate:int, amplitude:int) -> numpy.ndarray:
+    count = size // 2 - 1
+    data = numpy.zeros((frames, octaves, size))
+    for frame, harmonics in enumerate(get_frames(shapes, frames, count)):
+        for octave in range(octaves):
+            top = 440.0 * 2 ** ((base + (octave + 1) * 12 - 1 - 69) / 12)
+            limit = max(int(sample_rate / 2 / top), 1)
+            data[frame, octave] = render(harmonics, size, limit)
+    # All tables share one scale so that levels don't jump between positions or octaves. Removing harmonics can raise
+    # the peak above that of the full band table, as with the fundamental of a square wave.
+    peak = numpy.max(numpy.abs(data))
+    data *= amplitude / peak if peak else 0.0
+    return numpy.clip(numpy.round(data), -32768, 32767).astype("<i2")
+
+def write(path:str, data:numpy.ndarray, base:int):
+    frames, octaves, size = data.shape
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "wb") as file:
+        file.write(struct.pack(WAVETABLE_HEADER, WAVETABLE_MAGIC, size, frames, octaves, base))
+        file.write(data.tobytes())
+
+def info(path:str) -> int:
+    with open(path, "rb") as file:
+        data = file.read()
+    magic, size, frames, octaves, base = struct.unpack_from(WAVETABLE_HEADER, data)
+    if magic != WAVETABLE_MAGIC or len(data) != WAVETABLE_HEADER_SIZE + size * frames * octaves * 2:
+        print("{}: invalid wavetable".format(path))
+        return 1
+    print("{}: {:d} frames, {:d} octaves from note {:d}, {:d} samples, {:d} bytes".format(path, frames, octaves, base, size, len(data)))
+    return 0
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Generate band-limited wavetables")
+    parser.add_argument("--shapes", nargs="+", choices=SHAPES, default=list(SHAPES), help="shapes to morph between")
+    parser.add_argument("--frames", type=int, default=16, help="number of positions in the table")
+    parser.add_argument("--size", type=int, default=simulator.WAVEFORM_SIZE, help="samples per table")
+    parser.add_argument("--octaves", type=int, default=8, help="number of band-limited copies of each frame")
+    parser.add_argument("--base", type=int, default=24, help="lowest note of the first octave")
+    parser.add_argument("--sample-rate", type=int, default=simulator.SAMPLE_RATE, help="sample rate of the device")
+    parser.add_argument("--amplitude", type=int, default=simulator.SAMPLE_AMPLITUDE, help="peak sample value")
+    parser.add_argument("--output", default=os.path.join(host.ROOT, "wavetables", "default.wt"), help="wavetable file")
+    parser.add_argument("--info", metavar="PATH", help="print the header of an existing wavetable file")
+    args = parser.parse_args()
+
+    if args.info:
+        return info(args.info)
+    if args.frames < 1 or args.octaves < 1 or args.size < 8 or args.size % 2:
+        parser.error("invalid table dimensions")
+    data = generate(args.shapes, args.frames, args.size, args.octaves, args.base, args.sample_rate, args.amplitude)
+    write(args.output, data, args.base)
+    return info(args.output)
+
+if __name__ == "__main__":
+    sys.exit(main())
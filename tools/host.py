@@ -0,0 +1,15 @@
+# pcolamakerfaire2023 - tools/host.py
+# 2023 Cooper Dalrymple - me@dcdalrymple.com
+# GPL v3 License
+#
+# Prepares CPython to import the device modules of this repository from host tools.
+
+import os, sys, builtins, types
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+if not ROOT in sys.path:
+    sys.path.insert(0, ROOT)
+
+# CircuitPython ignores annotations, but CPython evaluates them when a function is defined
+if not hasattr(builtins, "function"):
+    builtins.function = types.FunctionType
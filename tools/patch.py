@@ -0,0 +1,257 @@
+# pcolamakerfaire2023 - tools/patch.py
+# 2023 Cooper Dalrymple - me@dcdalrymple.com
+# GPL v3 License
+#
+# Headless preset tool. Builds a program's menu schema on the host and validates, converts, diffs and renders
+# preset files without a device.
+#
+#   python3 tools/patch.py schema monophonic
+#   python3 tools/patch.py validate monophonic presets/*.json
+#   python3 tools/patch.py convert monophonic --to bin --output build/presets presets/*.json
+#   python3 tools/patch.py diff monophonic presets/monophonic-0.json presets/monophonic-1.bin
+#   python3 tools/patch.py render monophonic --csv presets/*.json
+#   python3 tools/patch.py random monophonic --count 8 --amount 0.3 --base presets/monophonic-0.json --output build/presets
+
+import argparse, json, math, os, sys
+import simulator
+simulator.install()
+from menu import encode_patch, decode_patch, pack_patch, unpack_patch, remap_patch
+
+PROGRAMS = ("monophonic", "polyphonic")
+
+class Schema:
+    def __init__(self, program:str):
+        app = simulator.load_program(program)["app"]
+        menu = app.menu
+        self.program = program
+        self.menu = menu
+        self.randomizer = app.randomizer
+        self.parameters = menu.get_schema()
+        self.paths = menu.get_paths()
+        self.fingerprint = menu.get_fingerprint()
+        self.default = list(menu.get())
+    def __len__(self) -> int:
+        return len(self.parameters)
+
+def read_patch(path:str) -> tuple:
+    # Returns (values, fingerprint) or raises ValueError
+    if path.endswith(".bin"):
+        with open(path, "rb") as file:
+            values, fingerprint = decode_patch(file.read())
+        if values is None:
+            raise ValueError("invalid binary patch")
+        return (list(values), fingerprint)
+    with open(path, "r") as file:
+        try:
+            data = json.load(file)
+        except json.JSONDecodeError as error:
+            raise ValueError("invalid JSON: {}".format(error))
+    values, fingerprint = unpack_patch(data)
+    if values is None:
+        raise ValueError("unrecognized JSON patch structure")
+    return (list(values), fingerprint)
+
+def remap_values(schema:Schema, values:list, fingerprint:int) -> list:
+    # Values moved to the current layout if the patch was written for an earlier one, otherwise None
+    if (fingerprint is None and len(values) == len(schema)) or fingerprint == schema.fingerprint:
+        return None
+    values = remap_patch(schema.parameters, values, fingerprint)
+    return None if values is None else list(values)
+
+def validate_patch(schema:Schema, values:list, fingerprint:int) -> tuple:
+    # Returns lists of errors and warnings
+    errors, warnings = [], []
+    remapped = remap_values(schema, values, fingerprint)
+    if not remapped is None:
+        warnings.append("written for an earlier layout, remapped by parameter path")
+        values = remapped
+    elif fingerprint is None:
+        warnings.append("no schema fingerprint, written by an earlier version")
+    elif fingerprint != schema.fingerprint:
+        errors.append("stale schema fingerprint {:08x}, expected {:08x}".format(fingerprint, schema.fingerprint))
+    if len(values) != len(schema):
+        errors.append("{:d} parameters, expected {:d}".format(len(values), len(schema)))
+    for i in range(min(len(values), len(schema))):
+        value = values[i]
+        path, kind, minimum, maximum, step, initial = schema.parameters[i]
+        if not type(value) in (int, float) or math.isnan(value):
+            errors.append("{}: invalid value {!r}".format(path, value))
+        elif value < minimum - 1e-6 or value > maximum + 1e-6:
+            errors.append("{}: {:g} outside of range {:g} to {:g}".format(path, value, minimum, maximum))
+    return (errors, warnings)
+
+def format_value(value:float) -> str:
+    return "{:g}".format(value)
+
+def command_schema(schema:Schema, args) -> int:
+    print("{} {:d} parameters, fingerprint {:08x}".format(schema.program, len(schema), schema.fingerprint))
+    if args.fingerprint:
+        return 0
+    for i, parameter in enumerate(schema.parameters):
+        print("{:>3d} {:<28} {:<20} {:>8g} {:>8g} {:>8.4g} {:>8g}".format(i, *parameter))
+    return 0
+
+def command_validate(schema:Schema, args) -> int:
+    failed = 0
+    for path in args.files:
+        try:
+            values, fingerprint = read_patch(path)
+            errors, warnings = validate_patch(schema, values, fingerprint)
+        except (OSError, ValueError) as error:
+            errors, warnings = [str(error)], []
+        if errors:
+            failed += 1
+        if errors or warnings or args.verbose:
+            print("{}: {}".format(path, "FAIL" if errors else "ok"))
+            for message in errors:
+                print("  error: {}".format(message))
+            for message in warnings:
+                print("  warning: {}".format(message))
+    print("{:d} of {:d} presets valid for {} schema {:08x}".format(len(args.files) - failed, len(args.files), schema.program, schema.fingerprint))
+    return 1 if failed else 0
+
+def command_convert(schema:Schema, args) -> int:
+    if args.output:
+        os.makedirs(args.output, exist_ok=True)
+    failed = 0
+    total = 0
+    for path in args.files:
+        try:
+            values, fingerprint = read_patch(path)
+            errors, warnings = validate_patch(schema, values, fingerprint)
+        except (OSError, ValueError) as error:
+            errors = [str(error)]
+        if errors and not args.force:
+            print("{}: skipped, {}".format(path, "; ".join(errors)))
+            failed += 1
+            continue
+        remapped = remap_values(schema, values, fingerprint)
+        if not remapped is None:
+            values = remapped
+        # Pad or truncate to the current layout
+        values = [float(value) for value in values[:len(schema)]] + schema.default[len(values):]
+        name = os.path.splitext(os.path.basename(path))[0] + "." + args.to
+        target = os.path.join(args.output or os.path.dirname(path), name)
+        if args.to == "bin":
+            from array import array
+            data = encode_patch(array("f", values), schema.fingerprint)
+            with open(target, "wb") as file:
+                file.write(data)
+            total += len(data)
+        else:
+            with open(target, "w") as file:
+                json.dump(pack_patch(values, schema.fingerprint), file)
+            total += os.path.getsize(target)
+    print("Converted {:d} presets to {} ({:d} bytes), {:d} skipped".format(len(args.files) - failed, args.to, total, failed))
+    return 1 if failed else 0
+
+def command_diff(schema:Schema, args) -> int:
+    a, _ = read_patch(args.files[0])
+    b, _ = read_patch(args.files[1])
+    different = 0
+    for i in range(max(len(a), len(b))):
+        path = schema.paths[i] if i < len(schema) else "#{:d}".format(i)
+        value_a = a[i] if i < len(a) else None
+        value_b = b[i] if i < len(b) else None
+        if value_a is None or value_b is None or abs(value_a - value_b) > 1e-6:
+            different += 1
+            print("{:<28} {:>10} {:>10}".format(
+                path,
+                "-" if value_a is None else format_value(value_a),
+                "-" if value_b is None else format_value(value_b)
+            ))
+    print("{:d} of {:d} parameters differ".format(different, len(schema)))
+    return 1 if different else 0
+
+def command_render(schema:Schema, args) -> int:
+    patches = []
+    for path in args.files:
+        try:
+            patches.append((path, read_patch(path)[0]))
+        except (OSError, ValueError) as error:
+            print("{}: {}".format(path, error), file=sys.stderr)
+    if args.csv:
+        print(",".join(["parameter"] + [os.path.basename(patch[0]) for patch in patches]))
+        for i in range(len(schema)):
+            print(",".join([schema.paths[i]] + [format_value(patch[1][i]) if i < len(patch[1]) else "" for patch in patches]))
+        return 0
+    for path, values in patches:
+        print(path)
+        for i in range(min(len(values), len(schema))):
+            print("  {:<28} {}".format(schema.paths[i], format_value(values[i])))
+    return 0
+
+def command_random(schema:Schema, args) -> int:
+    from randomizer import Randomizer
+    randomizer = Randomizer(schema.menu, locked=args.lock, seed=args.seed)
+    base = schema.default
+    if args.base:
+        base, _ = read_patch(args.base)
+    if args.output:
+        os.makedirs(args.output, exist_ok=True)
+    name = os.path.splitext(os.path.basename(args.base))[0] if args.base else schema.program
+    for i in range(args.count):
+        # Each patch is generated from the base rather than from the previous one
+        schema.menu.set(base)
+        changed = randomizer.randomize(args.amount)
+        values = list(schema.menu.get())
+        target = os.path.join(args.output or ".", "{}-random-{:d}.{}".format(name, i, args.to))
+        if args.to == "bin":
+            with open(target, "wb") as file:
+                file.write(encode_patch(schema.menu.get(), schema.fingerprint))
+        else:
+            with open(target, "w") as file:
+                json.dump(pack_patch(values, schema.fingerprint), file)
+        print("{}: {:d} parameters changed".format(target, changed))
+    return 0
+
+def main(argv:list=None) -> int:
+    parser = argparse.ArgumentParser(description="Validate, convert, diff and render presets without a device.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("schema", help="list the parameters of a program's patch layout")
+    command.add_argument("program", choices=PROGRAMS)
+    command.add_argument("--fingerprint", action="store_true", help="only print the schema fingerprint")
+    command.set_defaults(function=command_schema)
+
+    command = commands.add_parser("validate", help="check presets against the current schema")
+    command.add_argument("program", choices=PROGRAMS)
+    command.add_argument("files", nargs="+")
+    command.add_argument("-v", "--verbose", action="store_true", help="list valid presets as well")
+    command.set_defaults(function=command_validate)
+
+    command = commands.add_parser("convert", help="convert presets between JSON and binary")
+    command.add_argument("program", choices=PROGRAMS)
+    command.add_argument("files", nargs="+")
+    command.add_argument("--to", choices=("json", "bin"), required=True)
+    command.add_argument("-o", "--output", help="output directory, defaults to the directory of each preset")
+    command.add_argument("-f", "--force", action="store_true", help="convert presets which fail validation")
+    command.set_defaults(function=command_convert)
+
+    command = commands.add_parser("diff", help="list parameters which differ between two presets")
+    command.add_argument("program", choices=PROGRAMS)
+    command.add_argument("files", nargs=2)
+    command.set_defaults(function=command_diff)
+
+    command = commands.add_parser("render", help="print the parameter values of presets")
+    command.add_argument("program", choices=PROGRAMS)
+    command.add_argument("files", nargs="+")
+    command.add_argument("--csv", action="store_true", help="print one column per preset")
+    command.set_defaults(function=command_render)
+
+    command = commands.add_parser("random", help="generate random or mutated presets within the schema")
+    command.add_argument("program", choices=PROGRAMS)
+    command.add_argument("--base", help="preset to mutate, defaults to the initial values")
+    command.add_argument("--amount", type=float, default=1.0, help="fraction of each range to move by, 1.0 for any value")
+    command.add_argument("--count", type=int, default=1)
+    command.add_argument("--seed", type=int, help="seed for reproducible presets")
+    command.add_argument("--lock", nargs="*", default=["MIDI", "Patch", "Snd", "Arp"], help="menu groups to keep, ie: Osc1/Filter")
+    command.add_argument("--to", choices=("json", "bin"), default="json")
+    command.add_argument("-o", "--output", help="output directory, defaults to the current directory")
+    command.set_defaults(function=command_random)
+
+    args = parser.parse_args(argv)
+    return args.function(Schema(args.program), args)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,272 @@
+# pcolamakerfaire2023 - tools/remote_client.py
+# 2023 Cooper Dalrymple - me@dcdalrymple.com
+# GPL v3 License
+#
+# Host client of the remote control protocol of remote.py. Parameters are addressed by index or by menu path, such as
+# "Osc/Filter/Freq", and changes can be streamed in batches with several requests awaiting acknowledgement at
+# once. The device is reached over its USB serial data channel with pyserial, or --loopback runs a program on the
+# simulator in this process instead.
+#
+#   python3 tools/remote_client.py --port /dev/ttyACM1 info
+#   python3 tools/remote_client.py --loopback monophonic get Osc1/Filter/Freq
+#   python3 tools/remote_client.py --port /dev/ttyACM1 set Osc1/Filter/Freq=0.5 Osc1/Filter/Reso=0.25
+#   python3 tools/remote_client.py --port /dev/ttyACM1 dump --output patch.bin
+#   python3 tools/remote_client.py --port /dev/ttyACM1 load patch.bin
+#   python3 tools/remote_client.py --loopback polyphonic sweep Osc/Filter/Freq --count 2000
+
+import argparse, collections, math, struct, sys, time
+import host
+import simulator
+simulator.install()
+from remote import *
+from menu import encode_patch, decode_patch
+
+ERRORS = {
+    ERROR_CHECKSUM: "checksum",
+    ERROR_LENGTH: "length",
+    ERROR_COMMAND: "unknown command",
+    ERROR_INDEX: "index out of range",
+    ERROR_PATH: "unknown path",
+    ERROR_SCHEMA: "different parameter layout",
+}
+
+class RemoteError(Exception):
+    pass
+
+class SerialTransport:
+    def __init__(self, port:str, baudrate:int=115200, timeout:float=1.0):
+        try:
+            import serial
+        except ImportError:
+            raise RemoteError("pyserial is required to connect to a device: pip install pyserial")
+        self._serial = serial.Serial(port, baudrate, timeout=timeout)
+    def write(self, data:bytes):
+        self._serial.write(data)
+    def read(self) -> bytes:
+        return self._serial.read(max(self._serial.in_waiting, 1))
+    def close(self):
+        self._serial.close()
+
+class LoopbackSerial:
+    # Device side of the loopback, in place of usb_cdc.data
+    def __init__(self):
+        self.rx = bytearray()
+        self.tx = bytearray()
+        self.timeout = None
+    @property
+    def in_waiting(self) -> int:
+        return len(self.rx)
+    def readinto(self, buffer) -> int:
+        count = min(len(buffer), len(self.rx))
+        buffer[:count] = self.rx[:count]
+        del self.rx[:count]
+        return count
+    def write(self, data) -> int:
+        self.tx.extend(data)
+        return len(data)
+
+class LoopbackTransport:
+    # Runs a program with the remote enabled on the simulator and passes bytes to it directly
+    def __init__(self, program:str="monophonic"):
+        self.globals = simulator.load_program(program, constants={"REMOTE": True})
+        self.app = self.globals["app"]
+        self.serial = LoopbackSerial()
+        self.app.remote.set_serial(self.serial)
+    def write(self, data:bytes):
+        self.serial.rx.extend(data)
+    def read(self) -> bytes:
+        self.app.remote.update()
+        data = bytes(self.serial.tx)
+        self.serial.tx.clear()
+        return data
+    def close(self):
+        pass
+
+class RemoteClient:
+    def __init__(self, transport, timeout:float=1.0):
+        self._transport = transport
+        self._timeout = timeout
+        self._sequence = 0
+        self._buffer = bytearray()
+        self._replies = {}
+        self._pending = collections.OrderedDict() # Sequence numbers awaiting a reply, with their command
+        self._indexes = {}
+        self.info = None
+
+    # Framing
+    def send(self, command:int, payload:bytes=b"") -> int:
+        sequence = self._sequence
+        self._sequence = (self._sequence + 1) & 0xFF
+        self._pending[sequence] = command
+        self._transport.write(encode_frame(command, sequence, payload))
+        return sequence
+    def _receive(self):
+        self._buffer.extend(self._transport.read())
+        while True:
+            start = self._buffer.find(bytes((REMOTE_SYNC,)))
+            if start < 0:
+                self._buffer.clear()
+                return
+            del self._buffer[:start]
+            if len(self._buffer) < REMOTE_HEADER_SIZE:
+                return
+            sync, command, sequence, length = struct.unpack_from(REMOTE_HEADER, self._buffer)
+            end = REMOTE_HEADER_SIZE + length
+            if len(self._buffer) < end + 1:
+                return
+            if get_checksum(self._buffer[1:end]) != self._buffer[end]:
+                del self._buffer[:1]
+                continue
+            self._replies[sequence] = (command, bytes(self._buffer[REMOTE_HEADER_SIZE:end]))
+            del self._buffer[:end + 1]
+    def wait(self, sequence:int) -> bytes:
+        # Returns the payload of the reply to a request or raises RemoteError
+        deadline = time.monotonic() + self._timeout
+        while not sequence in self._replies:
+            if time.monotonic() > deadline:
+                self._pending.pop(sequence, None)
+                raise RemoteError("no reply to request {:d}".format(sequence))
+            self._receive()
+        command, payload = self._replies.pop(sequence)
+        request = self._pending.pop(sequence, None)
+        if command == CMD_ERROR:
+            raise RemoteError("request {:d} failed: {}".format(sequence, ERRORS.get(payload[1], payload[1])))
+        if request is not None and command != request | REPLY:
+            raise RemoteError("unexpected reply to request {:d}".format(sequence))
+        return payload
+    def request(self, command:int, payload:bytes=b"") -> bytes:
+        return self.wait(self.send(command, payload))
+
+    # Commands
+    def ping(self) -> tuple:
+        # Returns (version, fingerprint, parameter count)
+        self.info = struct.unpack("<HIH", self.request(CMD_PING))
+        return self.info
+    def find(self, path:str) -> int:
+        if not path in self._indexes:
+            self._indexes[path] = struct.unpack("<H", self.request(CMD_FIND, path.encode()))[0]
+        return self._indexes[path]
+    def get_index(self, key) -> int:
+        return key if type(key) is int else self.find(key)
+    def schema(self, key) -> tuple:
+        # Returns (path, minimum, maximum, step, initial)
+        payload = self.request(CMD_SCHEMA, struct.pack("<H", self.get_index(key)))
+        index, minimum, maximum, step, initial = struct.unpack_from("<Hffff", payload)
+        return (str(payload[18:], "utf-8"), minimum, maximum, step, initial)
+    def get(self, key) -> float:
+        return struct.unpack("<Hf", self.request(CMD_GET, struct.pack("<H", self.get_index(key))))[1]
+    def set(self, key, value:float) -> int:
+        return self.set_many({key: value})
+    def set_many(self, values:dict) -> int:
+        # Applies all values at once, returning the number of changed parameters
+        payload = b"".join(struct.pack(SET_ENTRY, self.get_index(key), value) for key, value in values.items())
+        return struct.unpack("<H", self.request(CMD_SET, payload))[0]
+    def dump(self) -> tuple:
+        # Returns the values and fingerprint of the current patch
+        return decode_patch(self.request(CMD_DUMP))
+    def load(self, values, fingerprint:int=None) -> int:
+        if fingerprint is None:
+            fingerprint = (self.info or self.ping())[1]
+        return struct.unpack("<H", self.request(CMD_LOAD, encode_patch(values, fingerprint)))[0]
+
+    def stream(self, changes, batch:int=16, window:int=4) -> dict:
+        # Sends an iterable of (key, value) changes, up to batch per request with up to window requests awaiting
+        # acknowledgement. Only the latest value of a parameter within a batch is sent. Returns statistics.
+        stats = {"changes": 0, "requests": 0, "applied": 0}
+        batch = min(batch, REMOTE_MAX_PAYLOAD // SET_ENTRY_SIZE)
+        inflight = collections.deque()
+        values = {}
+        def flush():
+            if not values:
+                return
+            payload = b"".join(struct.pack(SET_ENTRY, index, value) for index, value in values.items())
+            inflight.append(self.send(CMD_SET, payload))
+            stats["requests"] += 1
+            values.clear()
+            while len(inflight) >= window:
+                stats["applied"] += struct.unpack("<H", self.wait(inflight.popleft()))[0]
+        for key, value in changes:
+            values[self.get_index(key)] = value
+            stats["changes"] += 1
+            if not stats["changes"] % batch:
+                flush()
+        flush()
+        while inflight:
+            stats["applied"] += struct.unpack("<H", self.wait(inflight.popleft()))[0]
+        return stats
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Get and set parameters of a running program")
+    connection = parser.add_mutually_exclusive_group(required=True)
+    connection.add_argument("--port", help="USB serial data port of the device, ie: /dev/ttyACM1")
+    connection.add_argument("--loopback", metavar="PROGRAM", help="run a program on the simulator instead of a device")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("info", help="print the protocol version and parameter layout")
+    commands.add_parser("schema", help="list every parameter with its range")
+    command = commands.add_parser("get", help="print parameter values")
+    command.add_argument("keys", nargs="+", help="parameter paths or indexes")
+    command = commands.add_parser("set", help="set parameter values together")
+    command.add_argument("values", nargs="+", help="path=value or index=value")
+    command = commands.add_parser("dump", help="print or save the current patch")
+    command.add_argument("--output", help="binary preset file")
+    command = commands.add_parser("load", help="apply a binary preset file")
+    command.add_argument("path")
+    command = commands.add_parser("sweep", help="stream a sweep of one parameter and report the rate")
+    command.add_argument("key")
+    command.add_argument("--count", type=int, default=1000, help="number of changes")
+    command.add_argument("--batch", type=int, default=16)
+    command.add_argument("--window", type=int, default=4)
+    args = parser.parse_args()
+
+    def parse_key(key:str):
+        return int(key) if key.isdigit() else key
+
+    try:
+        transport = SerialTransport(args.port) if args.port else LoopbackTransport(args.loopback)
+        client = RemoteClient(transport)
+        version, fingerprint, count = client.ping()
+        if args.command == "info":
+            print("protocol {:d}, {:d} parameters, fingerprint {:08x}".format(version, count, fingerprint))
+        elif args.command == "schema":
+            for index in range(count):
+                path, minimum, maximum, step, initial = client.schema(index)
+                print("{:3d} {:40s} {:8.3f} {:8.3f} {:8.4f} {:8.3f}".format(index, path, minimum, maximum, step, initial))
+        elif args.command == "get":
+            for key in args.keys:
+                print("{} = {:g}".format(key, client.get(parse_key(key))))
+        elif args.command == "set":
+            values = {}
+            for item in args.values:
+                key, value = item.rsplit("=", 1)
+                values[parse_key(key)] = float(value)
+            print("{:d} parameters changed".format(client.set_many(values)))
+        elif args.command == "dump":
+            values, fingerprint = client.dump()
+            if args.output:
+                with open(args.output, "wb") as file:
+                    file.write(encode_patch(values, fingerprint))
+            else:
+                for index, value in enumerate(values):
+                    print("{:3d} {:g}".format(index, value))
+        elif args.command == "load":
+            with open(args.path, "rb") as file:
+                values, fingerprint = decode_patch(file.read())
+            if values is None:
+                print("Invalid binary preset: {}".format(args.path))
+                return 1
+            print("{:d} parameters changed".format(client.load(values, fingerprint)))
+        elif args.command == "sweep":
+            path, minimum, maximum, step, initial = client.schema(parse_key(args.key))
+            changes = ((parse_key(args.key), minimum + (maximum - minimum) * (0.5 - 0.5 * math.cos(i / 50))) for i in range(args.count))
+            start = time.perf_counter()
+            stats = client.stream(changes, args.batch, args.window)
+            elapsed = time.perf_counter() - start
+            print("{:d} changes of {} in {:d} requests, {:.0f} changes/s".format(stats["changes"], path, stats["requests"], stats["changes"] / elapsed))
+        transport.close()
+    except RemoteError as error:
+        print(error)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
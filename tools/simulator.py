@@ -0,0 +1,631 @@
+# pcolamakerfaire2023 - tools/simulator.py
+# 2023 Cooper Dalrymple - me@dcdalrymple.com
+# GPL v3 License
+#
+# Host stand-ins for the pico_synth_sandbox hardware library and ulab so that the programs and device modules of
+# this repository can be built and driven on a host computer without a CircuitPython device. Only the interface
+# used by this repository is provided. Call install() before importing any device module.
+
+import os, sys, types, math, runpy, io, contextlib, wave, ast, builtins
+import numpy
+import host
+
+_installed = False
+_tasks = []
+_paused = False
+
+def _module(name:str, **attributes) -> types.ModuleType:
+    module = types.ModuleType(name)
+    module.__dict__.update(attributes)
+    sys.modules[name] = module
+    parent, _, child = name.rpartition(".")
+    if parent and parent in sys.modules:
+        setattr(sys.modules[parent], child, module)
+    return module
+
+def _register(task):
+    _tasks.append(task)
+    return task
+
+def get_tasks() -> list:
+    return _tasks
+
+def reset():
+    # Discard all task objects created by a previous program
+    global _paused
+    _tasks.clear()
+    _paused = False
+
+def step():
+    # Run a single pass of the cooperative task loop
+    if _paused:
+        return
+    for task in tuple(_tasks):
+        task.update()
+
+# pico_synth_sandbox
+
+def clamp(value:float, minimum:float=0.0, maximum:float=1.0) -> float:
+    return min(max(value, minimum), maximum)
+
+def map_value(value:float, minimum:float, maximum:float) -> float:
+    return clamp(value) * (maximum - minimum) + minimum
+
+def unmap_value(value:float, minimum:float, maximum:float) -> float:
+    return (clamp(value, minimum, maximum) - minimum) / (maximum - minimum)
+
+def check_dir(path:str):
+    os.makedirs(path, exist_ok=True)
+
+def get_filter_frequency_range() -> tuple:
+    return (60.0, 20000.0)
+
+def fftfreq(data, sample_rate:int) -> float:
+    spectrum = numpy.abs(numpy.fft.rfft(numpy.asarray(data, dtype=float)))
+    spectrum[0] = 0.0
+    return float(numpy.argmax(spectrum)) * sample_rate / len(data)
+
+# tasks
+
+def run():
+    # The host has no endless task loop, programs return after setup and are driven with step()
+    pass
+
+def pause():
+    global _paused
+    _paused = True
+
+def resume():
+    global _paused
+    _paused = False
+
+# board
+
+class Board:
+    encoders = 1
+    def num_encoders(self) -> int:
+        return Board.encoders
+
+def get_board() -> Board:
+    return Board()
+
+# audio
+
+SAMPLE_RATE = 22050
+SAMPLE_AMPLITUDE = 32767
+
+class Audio:
+    def __init__(self, board:Board=None):
+        self.level = 1.0
+        self.muted = False
+    def mute(self):
+        self.muted = True
+    def unmute(self):
+        self.muted = False
+    def set_level(self, value:float):
+        self.level = value
+    def get_level(self) -> float:
+        return self.level
+    def get_sample_rate(self) -> int:
+        return SAMPLE_RATE
+
+def get_audio_driver(board:Board) -> Audio:
+    return Audio(board)
+
+# waveform
+
+WAVEFORM_SIZE = 256
+
+def get_amplitude() -> int:
+    return SAMPLE_AMPLITUDE
+
+def _waveform(values) -> numpy.ndarray:
+    return numpy.array(values * SAMPLE_AMPLITUDE, dtype=numpy.int16)
+
+def get_square() -> numpy.ndarray:
+    return _waveform(numpy.where(numpy.arange(WAVEFORM_SIZE) < WAVEFORM_SIZE // 2, 1.0, -1.0))
+
+def get_saw() -> numpy.ndarray:
+    return _waveform(numpy.linspace(-1.0, 1.0, WAVEFORM_SIZE))
+
+def get_triangle() -> numpy.ndarray:
+    return _waveform(1.0 - 2.0 * numpy.abs(numpy.linspace(-1.0, 1.0, WAVEFORM_SIZE)))
+
+def get_sine() -> numpy.ndarray:
+    return _waveform(numpy.sin(numpy.linspace(0.0, 2.0 * math.pi, WAVEFORM_SIZE, endpoint=False)))
+
+def get_noise() -> numpy.ndarray:
+    return _waveform(numpy.random.default_rng(0).uniform(-1.0, 1.0, WAVEFORM_SIZE))
+
+def get_sine_noise() -> numpy.ndarray:
+    return _waveform(numpy.clip(get_sine() / SAMPLE_AMPLITUDE + get_noise() / SAMPLE_AMPLITUDE / 8, -1.0, 1.0))
+
+def load_from_file(path:str, max_samples:int=4096) -> tuple:
+    with wave.open(path, "rb") as file:
+        frames = file.readframes(min(file.getnframes(), max_samples))
+        channels = file.getnchannels()
+        sample_rate = file.getframerate()
+    data = numpy.frombuffer(frames, dtype=numpy.int16)
+    if channels > 1:
+        data = data[::channels]
+    return (numpy.array(data[:max_samples], dtype=numpy.int16), sample_rate)
+
+# voice
+
+class AREnvelope:
+    def __init__(self, attack:float=0.0, release:float=0.0, amount:float=1.0):
+        self._attack = attack
+        self._release = release
+        self._amount = amount
+    def get_attack(self) -> float:
+        return self._attack
+    def set_attack(self, value:float):
+        self._attack = value
+    def get_release(self) -> float:
+        return self._release
+    def set_release(self, value:float):
+        self._release = value
+    def get_amount(self) -> float:
+        return self._amount
+    def set_amount(self, value:float):
+        self._amount = value
+
+class Voice:
+    def __init__(self):
+        self._level = 1.0
+        self._velocity_amount = 0.0
+        self._filter_type = 0
+        self._filter_frequency = 1.0
+        self._filter_resonance = 0.0
+        self._pitch_bend = 0.0
+        self._filter_envelope = AREnvelope()
+        self.notenum = None
+        self.velocity = 0.0
+        self.pressed = False
+    def set_level(self, value:float):
+        self._level = value
+    def get_level(self) -> float:
+        return self._level
+    def set_velocity_amount(self, value:float):
+        self._velocity_amount = value
+    def set_filter_type(self, value:int):
+        self._filter_type = int(value)
+    def set_filter_frequency(self, value:float):
+        self._filter_frequency = value
+    def set_filter_resonance(self, value:float):
+        self._filter_resonance = value
+    def set_pitch_bend(self, value:float):
+        self._pitch_bend = value
+    def press(self, notenum:int, velocity:float=1.0) -> bool:
+        self.notenum = notenum
+        self.velocity = velocity
+        self.pressed = True
+        return True
+    def release(self, force:bool=False) -> bool:
+        self.pressed = False
+        return True
+
+class Oscillator(Voice):
+    def __init__(self):
+        Voice.__init__(self)
+        self._attack_time = 0.0
+        self._attack_level = 1.0
+        self._decay_time = 0.0
+        self._sustain_level = 0.75
+        self._release_time = 0.0
+        self._waveform = get_square()
+        self._parameters = {}
+    def _set(self, name:str, value:float):
+        self._parameters[name] = value
+    def get_waveform(self):
+        return self._waveform
+    def set_waveform(self, value):
+        self._waveform = value
+    def set_envelope_attack_time(self, value:float):
+        self._attack_time = value
+    def set_envelope_attack_level(self, value:float):
+        self._attack_level = value
+    def set_envelope_decay_time(self, value:float):
+        self._decay_time = value
+    def set_envelope_sustain_level(self, value:float):
+        self._sustain_level = value
+    def set_envelope_release_time(self, value:float):
+        self._release_time = value
+for _name in ("pan", "coarse_tune", "fine_tune", "glide", "pitch_bend_amount", "tremolo_depth", "tremolo_rate", "vibrato_depth", "vibrato_rate", "pan_depth", "pan_rate", "filter_lfo_depth", "filter_lfo_rate"):
+    setattr(Oscillator, "set_" + _name, (lambda name : lambda self, value : self._set(name, value))(_name))
+
+class Sample(Oscillator):
+    def __init__(self, loop:bool=True):
+        Oscillator.__init__(self)
+        self._loop = loop
+        self._sample = None
+        self._sample_rate = SAMPLE_RATE
+        self._root = 440.0
+    def load(self, data, sample_rate:int, root:float=440.0):
+        self._sample = data
+        self._sample_rate = sample_rate
+        self._root = root
+    def unload(self):
+        self._sample = None
+
+class Drum(Voice):
+    pass
+class Kick(Drum):
+    pass
+class Snare(Drum):
+    pass
+class ClosedHat(Drum):
+    pass
+class OpenHat(Drum):
+    pass
+
+# synth
+
+class Synth:
+    def __init__(self, audio:Audio):
+        self._audio = audio
+        self.voices = []
+        self.presses = 0
+        self.releases = 0
+        _register(self)
+    def add_voice(self, voice:Voice):
+        self.voices.append(voice)
+    def add_voices(self, voices):
+        for voice in voices:
+            self.add_voice(voice)
+    def _get_voice(self, voice) -> Voice:
+        return self.voices[voice] if type(voice) is int else voice
+    def press(self, voice=0, notenum:int=1, velocity:float=1.0) -> bool:
+        self.presses += 1
+        return self._get_voice(voice).press(notenum, velocity)
+    def release(self, voice=None, force:bool=False) -> bool:
+        self.releases += 1
+        if voice is None:
+            for item in self.voices:
+                item.release(force)
+            return True
+        return self._get_voice(voice).release(force)
+    def get_active(self) -> int:
+        return sum(1 for voice in self.voices if voice.pressed)
+    def update(self):
+        pass
+
+# display
+
+class Display:
+    def __init__(self, board:Board=None, width:int=16, height:int=2):
+        self._width = width
+        self._height = height
+        self._buffer = [[" "] * width for i in range(height)]
+        self._cursor = (0, 0)
+        self._cursor_visible = False
+        self._cursor_blink = False
+        self._graph = None
+        self.writes = 0
+        self.flushes = 0
+        _register(self)
+    def clear(self):
+        for row in self._buffer:
+            for i in range(len(row)):
+                row[i] = " "
+    def write(self, value, position:tuple=(0,0), length:int=None, right_aligned:bool=False):
+        self.writes += 1
+        value = str(value)
+        if length is None:
+            length = self._width - position[0]
+        value = value[:length]
+        value = value.rjust(length) if right_aligned else value.ljust(length)
+        row = self._buffer[position[1] % self._height]
+        for i in range(len(value)):
+            if position[0] + i < self._width:
+                row[position[0] + i] = value[i]
+    def enable_horizontal_graph(self):
+        self._graph = "horizontal"
+    def enable_vertical_graph(self):
+        self._graph = "vertical"
+    def write_horizontal_graph(self, value:float, minimum:float=0.0, maximum:float=1.0, position:tuple=(0,0), length:int=16, centered:bool=False):
+        count = round(unmap_value(value, minimum, maximum) * length)
+        self.write("=" * count, position, length)
+    def write_vertical_graph(self, value:float, minimum:float=0.0, maximum:float=1.0, position:tuple=(0,0)):
+        self.write(" _.-=+*#"[round(unmap_value(value, minimum, maximum) * 7)], position, 1)
+    def show_cursor(self, x=0, y=0):
+        self._cursor_visible = True
+        self.set_cursor_position(x, y)
+    def hide_cursor(self):
+        self._cursor_visible = False
+    def set_cursor_blink(self, value:bool):
+        self._cursor_blink = value
+    def set_cursor_position(self, x=0, y=0):
+        self._cursor = x if type(x) is tuple else (x, y)
+    def get_text(self) -> str:
+        return "\n".join("".join(row) for row in self._buffer)
+    def update(self):
+        self.flushes += 1
+
+# encoder
+
+class Encoder:
+    def __init__(self, board:Board=None, index:int=0):
+        self._index = index
+        self._callbacks = {}
+        _register(self)
+    def _set(self, name:str, callback):
+        self._callbacks[name] = callback
+    def set_click(self, callback):
+        self._set("click", callback)
+    def set_double_click(self, callback):
+        self._set("double_click", callback)
+    def set_long_press(self, callback):
+        self._set("long_press", callback)
+    def set_increment(self, callback):
+        self._set("increment", callback)
+    def set_decrement(self, callback):
+        self._set("decrement", callback)
+    def trigger(self, name:str):
+        callback = self._callbacks.get(name)
+        if callback: callback()
+    def update(self):
+        pass
+
+# keyboard
+
+KEYBOARD_HIGH = 0
+KEYBOARD_LOW = 1
+KEYBOARD_LAST = 2
+
+class Keyboard:
+    def __init__(self, board:Board=None, root:int=48, max_voices:int=1):
+        self.keys = [None] * 12
+        self._root = root
+        self._max_voices = max_voices
+        self._mode = KEYBOARD_HIGH
+        self._sustain = False
+        self._notes = [] # (notenum, velocity) in order of press
+        self._voices = [None] * max_voices
+        self._voice_press = None
+        self._voice_release = None
+        self._key_press = None
+        self._key_release = None
+        _register(self)
+    def set_voice_press(self, callback):
+        self._voice_press = callback
+    def set_voice_release(self, callback):
+        self._voice_release = callback
+    def set_key_press(self, callback):
+        self._key_press = callback
+    def set_key_release(self, callback):
+        self._key_release = callback
+    def set_mode(self, value:int):
+        self._mode = int(value)
+    def set_sustain(self, value):
+        self._sustain = bool(value)
+    def _allocate(self):
+        if not self._max_voices:
+            return
+        notes = self._notes
+        if self._mode == KEYBOARD_HIGH:
+            notes = sorted(notes, reverse=True)
+        elif self._mode == KEYBOARD_LOW:
+            notes = sorted(notes)
+        else:
+            notes = list(reversed(notes))
+        notes = notes[:self._max_voices]
+        active = [note[0] for note in notes]
+        for i in range(len(self._voices)):
+            if self._voices[i] is not None and not self._voices[i] in active:
+                notenum = self._voices[i]
+                self._voices[i] = None
+                if self._voice_release: self._voice_release(i, notenum)
+        for note in notes:
+            if note[0] in self._voices:
+                continue
+            if None in self._voices:
+                i = self._voices.index(None)
+                self._voices[i] = note[0]
+                if self._voice_press: self._voice_press(i, note[0], note[1])
+    def append(self, notenum:int, velocity:float=1.0, keynum:int=None):
+        self.remove(notenum, update=False)
+        self._notes.append((notenum, velocity))
+        self._allocate()
+    def remove(self, notenum:int, keynum:int=None, update:bool=True):
+        self._notes = [note for note in self._notes if note[0] != notenum]
+        if update: self._allocate()
+    def press_key(self, keynum:int, velocity:float=1.0):
+        notenum = self._root + keynum
+        if self._key_press: self._key_press(keynum, notenum, velocity)
+        self.append(notenum, velocity, keynum)
+    def release_key(self, keynum:int):
+        notenum = self._root + keynum
+        if self._key_release: self._key_release(keynum, notenum)
+        self.remove(notenum, keynum)
+    def update(self):
+        pass
+
+def get_keyboard_driver(board:Board=None, root:int=48, max_voices:int=1) -> Keyboard:
+    return Keyboard(board, root, max_voices)
+
+# midi
+
+class Midi:
+    def __init__(self, board:Board=None):
+        self._channel = 0
+        self._thru = False
+        self._callbacks = {}
+        self.sent = 0
+        _register(self)
+    def set_channel(self, value:int):
+        self._channel = int(value)
+    def set_thru(self, value:bool):
+        self._thru = bool(value)
+    def _set(self, name:str, callback):
+        self._callbacks[name] = callback
+    def set_note_on(self, callback):
+        self._set("note_on", callback)
+    def set_note_off(self, callback):
+        self._set("note_off", callback)
+    def set_control_change(self, callback):
+        self._set("control_change", callback)
+    def set_pitch_bend(self, callback):
+        self._set("pitch_bend", callback)
+    def set_program_change(self, callback):
+        self._set("program_change", callback)
+    def receive(self, name:str, *args):
+        callback = self._callbacks.get(name)
+        if callback: callback(*args)
+    def send_note_on(self, notenum:int, velocity:float=1.0):
+        self.sent += 1
+    def send_note_off(self, notenum:int):
+        self.sent += 1
+    def update(self):
+        pass
+
+# sequencer
+
+class Sequencer:
+    def __init__(self, length:int=16, tracks:int=1, bpm:int=120):
+        self._length = length
+        self._tracks = tracks
+        self._bpm = bpm
+        self._notes = [[None] * length for i in range(tracks)]
+        self._position = 0
+        self._active = False
+        self._step = None
+        self._press = None
+        self._release = None
+        _register(self)
+    def get_length(self) -> int:
+        return self._length
+    def get_tracks(self) -> int:
+        return self._tracks
+    def set_bpm(self, value:int):
+        self._bpm = value
+    def get_bpm(self) -> int:
+        return self._bpm
+    def set_step(self, callback):
+        self._step = callback
+    def set_press(self, callback):
+        self._press = callback
+    def set_release(self, callback):
+        self._release = callback
+    def set_note(self, position:int, notenum:int, velocity:float=1.0, track:int=0):
+        self._notes[track][position % self._length] = (notenum, velocity)
+    def has_note(self, position:int, track:int=0) -> bool:
+        return not self._notes[track][position % self._length] is None
+    def remove_note(self, position:int, track:int=0):
+        self._notes[track][position % self._length] = None
+    def toggle(self):
+        self._active = not self._active
+    def is_active(self) -> bool:
+        return self._active
+    def advance(self):
+        # Trigger a single step, in place of the sequencer's internal timing
+        previous = (self._position - 1) % self._length
+        for track in range(self._tracks):
+            note = self._notes[track][previous]
+            if note and self._release: self._release(note[0])
+        if self._step: self._step(self._position)
+        for track in range(self._tracks):
+            note = self._notes[track][self._position]
+            if note and self._press: self._press(note[0], note[1])
+        self._position = (self._position + 1) % self._length
+    def update(self):
+        pass
+
+# Device filesystem
+
+DEVICE_DIRS = ("presets", "patterns", "phrases") # Written by programs, kept in the root of the filesystem
+DATA_DIRS = ("wavetables", "samples", "kits") # Read from the repository when present, otherwise from the root
+
+class DeviceFilesystem:
+    # Maps absolute paths of the device's flash onto the host while installed, so that saves land in a temporary
+    # directory and patches, patterns and phrases saved by a program are read back by program changes
+    def __init__(self, root:str):
+        self._root = root
+        self._saved = None
+    def map(self, path):
+        if not isinstance(path, str) or not path.startswith("/"):
+            return path
+        name = path[1:].split("/", 1)[0]
+        if name in DEVICE_DIRS:
+            return os.path.join(self._root, path[1:])
+        if name in DATA_DIRS:
+            if os.path.isdir(os.path.join(host.ROOT, name)):
+                return os.path.join(host.ROOT, path[1:])
+            return os.path.join(self._root, path[1:])
+        return path
+    def install(self):
+        self._saved = (builtins.open, os.stat, os.remove, os.rename, os.listdir, os.makedirs)
+        open, stat, remove, rename, listdir, makedirs = self._saved
+        builtins.open = lambda file, *args, **kwargs : open(self.map(file), *args, **kwargs)
+        os.stat = lambda path, *args, **kwargs : stat(self.map(path), *args, **kwargs)
+        os.remove = lambda path, *args, **kwargs : remove(self.map(path), *args, **kwargs)
+        os.rename = lambda source, path, *args, **kwargs : rename(self.map(source), self.map(path), *args, **kwargs)
+        os.listdir = lambda path=".", *args, **kwargs : listdir(self.map(path), *args, **kwargs)
+        os.makedirs = lambda path, *args, **kwargs : makedirs(self.map(path), *args, **kwargs)
+    def uninstall(self):
+        builtins.open, os.stat, os.remove, os.rename, os.listdir, os.makedirs = self._saved
+
+def write_samples(path:str, count:int=2, length:float=0.25):
+    # Generated sine samples for the sampler when the repository has none, see "make samples" of the library
+    os.makedirs(path, exist_ok=True)
+    frames = numpy.arange(int(SAMPLE_RATE * length))
+    for i in range(count):
+        data = numpy.sin(frames * 2 * math.pi * 220 * (i + 1) / SAMPLE_RATE) * SAMPLE_AMPLITUDE / 2
+        with wave.open(os.path.join(path, "sine-{:d}.wav".format(i)), "wb") as file:
+            file.setnchannels(1)
+            file.setsampwidth(2)
+            file.setframerate(SAMPLE_RATE)
+            file.writeframes(data.astype(numpy.int16).tobytes())
+
+def install():
+    global _installed
+    if _installed:
+        return
+    _installed = True
+
+    # NumPy with the names ulab adds, where the float type is single precision as built for CircuitPython
+    ulab_numpy = types.ModuleType("ulab.numpy")
+    ulab_numpy.__getattr__ = lambda name : getattr(numpy, name)
+    ulab_numpy.float = numpy.float32
+    _module("ulab", numpy=ulab_numpy)
+    sys.modules["ulab.numpy"] = ulab_numpy
+
+    this = sys.modules[__name__]
+    _module("pico_synth_sandbox", clamp=clamp, map_value=map_value, unmap_value=unmap_value, check_dir=check_dir, get_filter_frequency_range=get_filter_frequency_range, fftfreq=fftfreq)
+    _module("pico_synth_sandbox.tasks", run=run, pause=pause, resume=resume)
+    _module("pico_synth_sandbox.board", get_board=get_board, Board=Board)
+    _module("pico_synth_sandbox.audio", Audio=Audio, get_audio_driver=get_audio_driver)
+    _module("pico_synth_sandbox.waveform", get_amplitude=get_amplitude, get_square=get_square, get_saw=get_saw, get_triangle=get_triangle, get_sine=get_sine, get_noise=get_noise, get_sine_noise=get_sine_noise, load_from_file=load_from_file)
+    _module("pico_synth_sandbox.voice", Voice=Voice, AREnvelope=AREnvelope)
+    _module("pico_synth_sandbox.voice.oscillator", Oscillator=Oscillator)
+    _module("pico_synth_sandbox.voice.sample", Sample=Sample)
+    _module("pico_synth_sandbox.voice.drum", Kick=Kick, Snare=Snare, ClosedHat=ClosedHat, OpenHat=OpenHat)
+    _module("pico_synth_sandbox.synth", Synth=Synth)
+    _module("pico_synth_sandbox.display", Display=Display)
+    _module("pico_synth_sandbox.encoder", Encoder=Encoder)
+    _module("pico_synth_sandbox.keyboard", get_keyboard_driver=get_keyboard_driver, Keyboard=Keyboard)
+    _module("pico_synth_sandbox.midi", Midi=Midi)
+    _module("pico_synth_sandbox.sequencer", Sequencer=Sequencer)
+
+def _run(path:str, constants:dict=None) -> dict:
+    if not constants:
+        return runpy.run_path(path, run_name="__main__")
+    # Replace the values of top level assignments, such as a program's configuration constants
+    with open(path, "r") as file:
+        tree = ast.parse(file.read(), path)
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name) and node.targets[0].id in constants:
+            node.value = ast.copy_location(ast.Constant(constants[node.targets[0].id]), node.value)
+    g = {"__name__": "__main__", "__file__": path}
+    exec(compile(tree, path, "exec"), g)
+    return g
+
+def load_program(name:str, quiet:bool=True, constants:dict=None) -> dict:
+    # Run a program's setup on the host and return its globals
+    install()
+    reset()
+    path = os.path.join(host.ROOT, name if name.endswith(".py") else name + ".py")
+    if quiet:
+        with contextlib.redirect_stdout(io.StringIO()):
+            return _run(path, constants)
+    return _run(path, constants)
@@ -0,0 +1,452 @@
+# pcolamakerfaire2023 - tools/soak.py
+# 2023 Cooper Dalrymple - me@dcdalrymple.com
+# GPL v3 License
+#
+# Host soak test which drives each program on the simulator stand-ins with a long stream of randomized events:
+# encoder spins, clicks and saves, floods of MIDI notes, sustain, pitch bend and program changes in the middle of
+# held notes, remote parameter changes, sequencer and looper transport and tempo changes, and task loop passes with
+# occasional stalls. Time is virtual and advances with each event, so hours of playing run in minutes. Heap growth of
+# the programs' own code is sampled with tracemalloc, host latency is recorded per kind of event, and at regular
+# intervals all input is released and every voice is expected to be released as well. The stream is reproducible from
+# its seed, and failures print the command which replays them. Exits with a non-zero status on exceptions, stuck notes
+# or heap growth above the limit.
+#
+#   python3 tools/soak.py [program ...] [--events 1000000] [--seed 1] [--quiesce 10000] [--encoders 2] [--no-heap] [-v]
+
+import argparse, array, collections, contextlib, gc, math, os, random, shutil, sys, tempfile, time, traceback, tracemalloc
+import host, simulator
+simulator.install()
+import step_sequencer, looper as looper_module
+
+PROGRAMS = ("monophonic", "polyphonic", "sampler", "drum_machine")
+WARMUP = 0.5 # Fraction of events before the heap baseline is taken, once bounded caches such as menu labels have filled
+HEAP_LIMIT = 16384 # Bytes of growth after warmup which fail a program
+SETTLE_TIME = 2.0 # Seconds of virtual time for voices to be released after all input is
+HISTORY = 16 # Recent events printed with a failure
+LATENCY_BINS_PER_OCTAVE = 8
+LATENCY_BINS = 36 * LATENCY_BINS_PER_OCTAVE # Up to about a minute in nanoseconds
+PERCENTILES = (50.0, 99.0, 99.9)
+
+class VirtualClock:
+    # Replaces time.monotonic and time.monotonic_ns while installed, which the menu, meter and ticks_ms read
+    def __init__(self):
+        self.ns = 0
+        self._saved = None
+    def advance(self, seconds:float):
+        self.ns += int(seconds * 1000000000)
+    def install(self):
+        self._saved = (time.monotonic, time.monotonic_ns)
+        time.monotonic = lambda : self.ns / 1000000000
+        time.monotonic_ns = lambda : self.ns
+    def uninstall(self):
+        time.monotonic, time.monotonic_ns = self._saved
+
+class LatencyHistogram:
+    # Logarithmic bins of host time per event, in constant memory however many events are recorded
+    def __init__(self):
+        self.counts = array.array("Q", [0] * LATENCY_BINS)
+        self.count = 0
+        self.maximum = 0
+    def add(self, ns:int):
+        self.counts[min(int(math.log2(max(ns, 1)) * LATENCY_BINS_PER_OCTAVE), LATENCY_BINS - 1)] += 1
+        self.count += 1
+        if ns > self.maximum:
+            self.maximum = ns
+    def percentile(self, value:float) -> float:
+        # Upper bound of the bin containing the percentile, in nanoseconds
+        target = self.count * value / 100
+        total = 0
+        for i in range(LATENCY_BINS):
+            total += self.counts[i]
+            if total >= target and total:
+                return min(2 ** ((i + 1) / LATENCY_BINS_PER_OCTAVE), self.maximum)
+        return self.maximum
+
+def format_time(ns:float) -> str:
+    if ns >= 1000000:
+        return "{:.1f}ms".format(ns / 1000000)
+    return "{:.1f}us".format(ns / 1000)
+
+def get_paths() -> tuple:
+    # Sources which run on the device
+    return tuple(os.path.join(host.ROOT, name) for name in os.listdir(host.ROOT) if name.endswith(".py"))
+
+class Target:
+    # Events of a program, each (name, weight, callback) where the callback draws its arguments from the random stream
+    # and returns them for the failure report
+    def __init__(self, g:dict, rng:random.Random, clock:VirtualClock):
+        self.g = g
+        self.rng = rng
+        self.clock = clock
+        self.keys = [] # Held keys
+    def get_events(self) -> tuple:
+        return ()
+    def get_voices(self) -> list:
+        return []
+    def quiesce(self):
+        # Releases all input and stops playback
+        pass
+    def get_stuck(self) -> list:
+        # Descriptions of notes still held after quiesce
+        return ["voice {:d} note {}".format(i, voice.notenum) for i, voice in enumerate(self.get_voices()) if voice.pressed]
+    def reset_voices(self):
+        for voice in self.get_voices():
+            voice.release(True)
+
+    def tick(self):
+        self.clock.advance(self.rng.uniform(0.0, 0.02))
+        simulator.step()
+        return ()
+    def stall(self):
+        # Tasks held up by a slow event, such as a file read
+        self.clock.advance(self.rng.uniform(0.05, 2.0))
+        simulator.step()
+        return ()
+    def key(self):
+        keyboard = self.g["keyboard"]
+        if self.keys and self.rng.random() < 0.5:
+            keynum = self.keys.pop(self.rng.randrange(len(self.keys)))
+            keyboard.release_key(keynum)
+            return ("release", keynum)
+        keynum = self.rng.randrange(len(keyboard.keys))
+        if not keynum in self.keys:
+            self.keys.append(keynum)
+        keyboard.press_key(keynum, self.rng.uniform(0.1, 1.0))
+        return ("press", keynum)
+    def encoder(self):
+        encoders = self.g["encoders"]
+        index = self.rng.randrange(len(encoders))
+        name = self.rng.choices(("increment", "decrement", "click", "double_click", "long_press"), (40, 40, 8, 6, 1))[0]
+        encoders[index].trigger(name)
+        return (index, name)
+    def settle(self):
+        for i in range(int(SETTLE_TIME / 0.01)):
+            self.clock.advance(0.01)
+            simulator.step()
+
+class AppTarget(Target):
+    # Programs built on App: monophonic and polyphonic
+    def __init__(self, g:dict, rng:random.Random, clock:VirtualClock):
+        Target.__init__(self, g, rng, clock)
+        self.app = g["app"]
+        self.g = dict(g, keyboard=self.app.keyboard, encoders=self.app.menu.get_encoders())
+        self.notes = [] # Held MIDI notes
+        self.sustain = False
+        self.schemas = tuple(self.app.menu.get_parameter(i).get_schema() for i in range(len(self.app.menu.get_paths())))
+    def get_voices(self) -> list:
+        return self.app.synth.voices
+    def get_events(self) -> tuple:
+        events = [
+            ("tick", 30, self.tick),
+            ("stall", 1, self.stall),
+            ("midi note on", 12, self.note_on),
+            ("midi note off", 12, self.note_off),
+            ("midi flood", 1, self.flood),
+            ("midi sustain", 2, self.sustain_pedal),
+            ("midi control", 3, self.control_change),
+            ("midi pitch bend", 3, self.pitch_bend),
+            ("midi program", 1, self.program_change),
+            ("key", 8, self.key),
+            ("encoder", 15, self.encoder),
+            ("remote", 3, self.remote),
+        ]
+        if self.app.sequencer:
+            events += [("sequencer", 2, self.sequencer), ("tempo", 1, self.tempo)]
+        if self.app.looper:
+            events.append(("looper", 1, self.looper))
+        if self.app.wavetables:
+            events.append(("midi mod wheel", 3, self.mod_wheel))
+        return tuple(events)
+
+    def note_on(self):
+        notenum = self.rng.randint(24, 96)
+        if not notenum in self.notes:
+            self.notes.append(notenum)
+        velocity = self.rng.uniform(0.05, 1.0)
+        self.app.midi.receive("note_on", notenum, velocity)
+        return (notenum, velocity)
+    def note_off(self):
+        # Note offs of notes which aren't held are sent as well, as after a dropped message
+        if self.notes and self.rng.random() < 0.9:
+            notenum = self.notes.pop(self.rng.randrange(len(self.notes)))
+        else:
+            notenum = self.rng.randint(24, 96)
+            if notenum in self.notes:
+                self.notes.remove(notenum)
+        self.app.midi.receive("note_off", notenum)
+        return (notenum,)
+    def flood(self):
+        count = self.rng.randint(16, 128)
+        for i in range(count):
+            if self.rng.random() < 0.5:
+                self.note_on()
+            else:
+                self.note_off()
+        return (count,)
+    def sustain_pedal(self):
+        self.sustain = not self.sustain
+        self.app.midi.receive("control_change", 64, 127 if self.sustain else 0)
+        return (self.sustain,)
+    def control_change(self):
+        control = 1 if self.rng.random() < 0.5 else self.rng.randrange(128)
+        if control == 64:
+            return self.sustain_pedal()
+        value = self.rng.randrange(128)
+        self.app.midi.receive("control_change", control, value)
+        return (control, value)
+    def mod_wheel(self):
+        # Sweeps the wavetable position, whose frames are loaded by the display task
+        value = self.rng.randrange(128)
+        self.app.midi.receive("control_change", 1, value)
+        return (value,)
+    def pitch_bend(self):
+        value = self.rng.uniform(-1.0, 1.0)
+        self.app.midi.receive("pitch_bend", value)
+        return (value,)
+    def program_change(self):
+        patch = self.rng.randrange(4)
+        self.app.midi.receive("program_change", patch)
+        return (patch,)
+    def remote(self):
+        # Several parameters applied in one commit, as by the remote control protocol
+        menu = self.app.menu
+        indexes = tuple(self.rng.randrange(len(self.schemas)) for i in range(self.rng.randint(1, 8)))
+        for index in indexes:
+            path, minimum, maximum, step, initial = self.schemas[index]
+            if path == "Patch":
+                continue
+            count = int((maximum - minimum) / step + 0.5) if step else 0
+            menu.stage_value(index, min(minimum + self.rng.randint(0, count) * step, maximum) if count else self.rng.uniform(minimum, maximum))
+        if menu.commit():
+            menu.redraw()
+        return indexes
+    def sequencer(self):
+        sequencer = self.app.sequencer
+        if self.rng.random() < 0.7:
+            # Edit a step
+            sequencer.set_track(self.rng.randrange(sequencer.get_tracks()))
+            sequencer.set_edit_position(self.rng.randrange(sequencer.get_length()))
+            sequencer.set_field(step_sequencer.FIELD_NOTE, self.rng.randint(24, 96))
+            sequencer.set_field(step_sequencer.FIELD_GATE, self.rng.randint(1, 100))
+            sequencer.set_flag(step_sequencer.STEP_ON, self.rng.random() < 0.7)
+            sequencer.set_flag(step_sequencer.STEP_TIE, self.rng.random() < 0.3)
+            return ("edit",)
+        mode = self.rng.choice((step_sequencer.SEQ_OFF, step_sequencer.SEQ_PLAY, step_sequencer.SEQ_RECORD))
+        sequencer.set_mode(mode)
+        return ("mode", mode)
+    def tempo(self):
+        bpm = self.rng.randint(30, 300)
+        self.app.sequencer.set_bpm(bpm)
+        if self.app.looper:
+            self.app.looper.set_bpm(bpm)
+        return (bpm,)
+    def looper(self):
+        mode = self.rng.choice((looper_module.LOOP_STOP, looper_module.LOOP_RECORD, looper_module.LOOP_PLAY, looper_module.LOOP_OVERDUB))
+        self.app.looper.set_mode(mode)
+        return (mode,)
+
+    def quiesce(self):
+        midi = self.app.midi
+        if self.sustain:
+            self.sustain_pedal()
+        while self.notes:
+            midi.receive("note_off", self.notes.pop())
+        while self.keys:
+            self.app.keyboard.release_key(self.keys.pop())
+        if self.app.sequencer:
+            self.app.sequencer.set_mode(step_sequencer.SEQ_OFF)
+        if self.app.looper:
+            self.app.looper.set_mode(looper_module.LOOP_STOP)
+        self.settle()
+    def get_stuck(self) -> list:
+        stuck = Target.get_stuck(self)
+        if self.app.keyboard._notes:
+            stuck.append("keyboard notes {}".format([note[0] for note in self.app.keyboard._notes]))
+        return stuck
+    def reset_voices(self):
+        Target.reset_voices(self)
+        self.app.keyboard._notes.clear()
+        self.app.keyboard._voices[:] = [None] * len(self.app.keyboard._voices)
+
+class DrumTarget(Target):
+    def get_voices(self) -> list:
+        return self.g["synth"].voices
+    def get_events(self) -> tuple:
+        return (
+            ("tick", 30, self.tick),
+            ("stall", 1, self.stall),
+            ("key", 20, self.key),
+            ("encoder", 20, self.encoder),
+            ("sequencer step", 25, self.advance),
+            ("midi program", 1, self.program_change),
+        )
+    def advance(self):
+        self.g["sequencer"].advance()
+        return ()
+    def program_change(self):
+        kit = self.rng.randrange(8)
+        self.g["midi"].receive("program_change", kit)
+        return (kit,)
+    def quiesce(self):
+        while self.keys:
+            self.g["keyboard"].release_key(self.keys.pop())
+        self.settle()
+    def get_stuck(self) -> list:
+        # Drums and kit samples are one-shots, so voices may be left pressed, but only one track of each choke group
+        g = self.g
+        voices, choke_next, track_voices = self.get_voices(), g["choke_next"], g["track_voices"]
+        stuck = []
+        for track in range(g["tracks"]):
+            other = choke_next[track]
+            while other != track:
+                if other > track and voices[track_voices[track]].pressed and voices[track_voices[other]].pressed:
+                    stuck.append("tracks {:d} and {:d} of a choke group".format(track, other))
+                other = choke_next[other]
+        return stuck
+
+class Soak:
+    # Heap samples are taken after all input was released, where the state of every program is comparable
+    def __init__(self, program:str, seed:int, events:int, quiesce:int, heap:bool=True, verbose:bool=False):
+        self.program = program
+        self.seed = seed
+        self.events = events
+        self.quiesce = quiesce
+        self.trace = heap
+        self.verbose = verbose
+        self.latency = {}
+        self.recent = collections.deque(maxlen=HISTORY)
+        self.failures = []
+        self.heap = [] # (events, bytes)
+        self.baseline = None
+        self.growth = ()
+        self.count = 0
+        self.elapsed = 0.0
+        self.virtual = 0.0
+
+    def _take_snapshot(self, paths:tuple):
+        gc.collect()
+        return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(True, path) for path in paths])
+    def _sample(self, index:int, paths:tuple, out):
+        if not self.trace:
+            return
+        snapshot = self._take_snapshot(paths)
+        size = sum(statistic.size for statistic in snapshot.statistics("filename"))
+        if self.baseline is None and index + 1 >= self.events * WARMUP:
+            self.baseline = (size, snapshot)
+        elif self.baseline:
+            self.growth = snapshot.compare_to(self.baseline[1], "lineno")
+        self.heap.append((index + 1, size))
+        if self.verbose:
+            print("{} {:d} events {:d} bytes".format(self.program, index + 1, size), file=out)
+
+    def _report_failure(self, index:int, text:str, out):
+        self.failures.append(text)
+        print("{} event {:d}: {}".format(self.program, index, text), file=out)
+        for event in self.recent:
+            print("  {:d} {} {}".format(*event), file=out)
+        print("  replay with: python3 tools/soak.py {} --seed {:d} --events {:d} --quiesce {:d} --encoders {:d}".format(self.program, self.seed, index + 1, self.quiesce, simulator.Board.encoders), file=out)
+
+    def _check(self, target:Target, index:int, out):
+        target.quiesce()
+        stuck = target.get_stuck()
+        if stuck:
+            self._report_failure(index, "stuck notes after release: {}".format(", ".join(stuck)), out)
+            target.reset_voices()
+
+    def run(self, out) -> bool:
+        rng = random.Random(self.seed)
+        clock = VirtualClock()
+        root = tempfile.mkdtemp(prefix="soak-")
+        if not os.path.isdir(os.path.join(host.ROOT, "samples")):
+            simulator.write_samples(os.path.join(root, "samples"))
+        filesystem = simulator.DeviceFilesystem(root)
+        paths = get_paths()
+        clock.install()
+        filesystem.install()
+        try:
+            with open(os.devnull, "w") as null, contextlib.redirect_stdout(null):
+                if self.trace:
+                    tracemalloc.start()
+                g = simulator.load_program(self.program, quiet=False)
+                target = AppTarget(g, rng, clock) if "app" in g else DrumTarget(g, rng, clock)
+                names, weights, callbacks = zip(*target.get_events())
+                table = tuple(i for i in range(len(names)) for j in range(weights[i]))
+                histograms = tuple(LatencyHistogram() for name in names)
+                self.latency = dict(zip(names, histograms))
+
+                start = time.perf_counter()
+                for index in range(self.events):
+                    event = table[rng.randrange(len(table))]
+                    clock.advance(rng.uniform(0.0, 0.001))
+                    begin = time.perf_counter_ns()
+                    try:
+                        args = callbacks[event]()
+                    except Exception:
+                        self._report_failure(index, traceback.format_exc().rstrip(), out)
+                        break
+                    histograms[event].add(time.perf_counter_ns() - begin)
+                    self.recent.append((index, names[event], args))
+                    self.count = index + 1
+                    if self.quiesce and self.count % self.quiesce == 0 and self.count < self.events:
+                        self._check(target, index, out)
+                        self._sample(index, paths, out)
+                else:
+                    self._check(target, self.events - 1, out)
+                    self._sample(self.events - 1, paths, out)
+                self.elapsed = time.perf_counter() - start
+                self.virtual = clock.ns / 1000000000
+        finally:
+            tracemalloc.stop()
+            filesystem.uninstall()
+            clock.uninstall()
+            shutil.rmtree(root, ignore_errors=True)
+        return not self.failures
+
+    def report(self, out, limit:int) -> bool:
+        passed = not self.failures
+        print("{}: {:d} events in {:.1f}s, {:.0f}s of virtual time, seed {:d}".format(self.program, self.count, self.elapsed, self.virtual, self.seed), file=out)
+        if self.baseline and self.heap:
+            final = self.heap[-1][1]
+            growth = final - self.baseline[0]
+            print("  heap {:d} bytes after warmup, {:d} final, {:d} peak, {:+d} growth".format(self.baseline[0], final, max(size for count, size in self.heap), growth), file=out)
+            if growth > limit:
+                passed = False
+                print("  heap grew by {:d} bytes, more than {:d}".format(growth, limit), file=out)
+            if growth > limit or self.verbose:
+                for statistic in self.growth[:5]:
+                    if statistic.size_diff > 0:
+                        frame = statistic.traceback[0]
+                        print("  {}:{:d} {:+d} bytes {:+d} blocks".format(os.path.basename(frame.filename), frame.lineno, statistic.size_diff, statistic.count_diff), file=out)
+        print("  {:<16} {:>9} {:>9} {:>9} {:>9} {:>9}".format("event", "count", "p50", "p99", "p99.9", "max"), file=out)
+        for name, histogram in self.latency.items():
+            if histogram.count:
+                print("  {:<16} {:>9d} {:>9} {:>9} {:>9} {:>9}".format(name, histogram.count, *(format_time(histogram.percentile(value)) for value in PERCENTILES), format_time(histogram.maximum)), file=out)
+        print("{}: {}".format(self.program, "ok" if passed else "FAIL"), file=out)
+        return passed
+
+def main(argv:list=None) -> int:
+    parser = argparse.ArgumentParser(description="Drive programs with randomized events on the host simulation.")
+    parser.add_argument("programs", nargs="*", help="any of {}, defaults to all".format(", ".join(PROGRAMS)))
+    parser.add_argument("--events", type=int, default=1000000, help="events per program")
+    parser.add_argument("--seed", type=int, default=None, help="seed of the event stream, random by default")
+    parser.add_argument("--quiesce", type=int, default=10000, help="events between releasing all input to check for stuck notes and sample the heap")
+    parser.add_argument("--heap-limit", type=int, default=HEAP_LIMIT, help="bytes of heap growth over the second half of the run which fail")
+    parser.add_argument("--no-heap", action="store_true", help="don't trace allocations, about twice as fast")
+    parser.add_argument("--encoders", type=int, choices=(1, 2), default=2, help="encoders of the simulated board")
+    parser.add_argument("-v", "--verbose", action="store_true", help="print each heap sample and the lines which grew")
+    args = parser.parse_args(argv)
+    for program in args.programs:
+        if not program in PROGRAMS:
+            parser.error("unknown program: {}".format(program))
+    seed = args.seed if args.seed is not None else random.randrange(1 << 31)
+    simulator.Board.encoders = args.encoders
+    failed = 0
+    for program in args.programs or PROGRAMS:
+        soak = Soak(program, seed, args.events, args.quiesce, not args.no_heap, args.verbose)
+        soak.run(sys.stdout)
+        if not soak.report(sys.stdout, args.heap_limit):
+            failed += 1
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
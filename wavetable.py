@@ -0,0 +1,102 @@
+# pcolamakerfaire2023 - wavetable.py
+# 2023 Cooper Dalrymple - me@dcdalrymple.com
+# GPL v3 License
+
+import struct
+import ulab.numpy as numpy
+import pico_synth_sandbox.waveform as waveform
+
+# Binary wavetable format, generated by tools/gen_wavetable.py: header followed by little-endian int16 tables ordered by
+# frame, then octave. Each octave holds a copy of every frame band-limited to the highest note of that octave.
+WAVETABLE_MAGIC = b"PSW1"
+WAVETABLE_HEADER = "<4sHHHH" # magic, samples per table, frames, octaves, lowest note of the first octave
+WAVETABLE_HEADER_SIZE = struct.calcsize(WAVETABLE_HEADER)
+
+class Wavetable:
+    # Tables of the selected frame are loaded into preallocated buffers on first use, so that voices using the
+    # wavetable follow changes of position in place and notes select the table of their octave without allocating
+    def __init__(self, path:str="/wavetables/default.wt"):
+        self._path = path
+        self._file = None
+        self._failed = False
+        self._size = 0
+        self._frames = 0
+        self._octaves = 0
+        self._base = 0
+        self._buffers = None
+        self._tables = None
+        self._voices = []
+        self._position = 0.0
+        self._modulation = 0.0
+        self._frame = -1
+
+    def _open(self) -> bool:
+        if self._file:
+            return True
+        if self._failed:
+            return False
+        try:
+            self._file = open(self._path, "rb")
+            magic, self._size, self._frames, self._octaves, self._base = struct.unpack(WAVETABLE_HEADER, self._file.read(WAVETABLE_HEADER_SIZE))
+            if magic != WAVETABLE_MAGIC or not self._size or not self._frames or not self._octaves:
+                raise ValueError()
+        except:
+            print("Failed to read wavetable file: {}".format(self._path))
+            if self._file:
+                self._file.close()
+                self._file = None
+            self._failed = True
+            return False
+        self._buffers = tuple(bytearray(self._size * 2) for i in range(self._octaves))
+        self._tables = tuple(numpy.frombuffer(buffer, dtype=numpy.int16) for buffer in self._buffers)
+        print("Successfully read wavetable file: {}".format(self._path))
+        return True
+    def _load(self):
+        # Reads every octave of the selected frame into the existing buffers
+        frame = round(min(max(self._position + self._modulation, 0.0), 1.0) * (self._frames - 1))
+        if frame == self._frame:
+            return
+        self._frame = frame
+        for octave in range(self._octaves):
+            self._file.seek(WAVETABLE_HEADER_SIZE + (frame * self._octaves + octave) * self._size * 2)
+            self._file.readinto(self._buffers[octave])
+
+    def get_waveform(self):
+        # Table of the middle octave, or a sine if the file isn't available
+        if not self._open():
+            return waveform.get_sine()
+        self._load()
+        return self._tables[self._octaves // 2]
+    def set_waveform(self, voice, value):
+        # Assigns a waveform to a voice and tracks whether it uses this wavetable
+        voice.set_waveform(value)
+        uses = False
+        if self._tables:
+            for table in self._tables:
+                if value is table:
+                    uses = True
+                    break
+        if uses and not voice in self._voices:
+            self._voices.append(voice)
+        elif not uses and voice in self._voices:
+            self._voices.remove(voice)
+
+    def get_position(self) -> float:
+        return self._position
+    def set_position(self, value:float):
+        self._position = value # Loaded by update
+    def set_modulation(self, value:float):
+        # Offset of the position, such as from the modulation wheel. Only recorded, so that control changes don't wait
+        # on reads from flash.
+        self._modulation = value
+    def update(self):
+        # Loads the frame selected by position and modulation if it has changed, called from the display task
+        if self._voices:
+            self._load()
+
+    def press(self, voice, notenum:int):
+        # Selects the table band-limited for the note's octave if the voice uses this wavetable
+        if not self._voices or not voice in self._voices:
+            return
+        octave = min(max((notenum - self._base) // 12, 0), self._octaves - 1)
+        voice.set_waveform(self._tables[octave])
@@ -0,0 +1,117 @@
+# pcolamakerfaire2023 - writer.py
+# 2023 Cooper Dalrymple - me@dcdalrymple.com
+# GPL v3 License
+
+import os
+
+WRITE_CHUNK_SIZE = 256 # Bytes written per update, keeping each stall of code running from flash short
+TEMP_SUFFIX = ".tmp"
+
+def is_writable(path:str="/") -> bool:
+    # The CircuitPython filesystem is read-only to programs unless boot.py remounts it
+    try:
+        import storage
+    except ImportError:
+        return True
+    try:
+        return not storage.getmount(path).readonly
+    except:
+        return False
+
+def find_file(path:str) -> str:
+    # Returns the path to read, falling back to the temporary file when a save was interrupted after the previous
+    # version was removed but before the temporary file replaced it, or None if neither exists
+    for candidate in (path, path + TEMP_SUFFIX):
+        try:
+            os.stat(candidate)
+            return candidate
+        except OSError:
+            pass
+    return None
+
+def replace_file(source:str, path:str):
+    # FAT doesn't rename over an existing file
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+    os.rename(source, path)
+
+class FileWriter:
+    # Writes files in the background, one chunk per update, so that saving doesn't hold up other tasks. Data is
+    # snapshotted when queued and written to a temporary file which only replaces the previous version once complete,
+    # so an interrupted save never leaves a truncated file in its place.
+    def __init__(self, chunk_size:int=WRITE_CHUNK_SIZE):
+        self._chunk_size = chunk_size
+        self._queue = []
+        self._job = None
+        self._failures = 0
+        self._result = 0 # Failures of the last completed queue
+        self._completed = None
+
+    def set_completed(self, callback:function):
+        # Called with the number of files which failed once all queued files are written
+        self._completed = callback
+    def is_busy(self) -> bool:
+        return not self._job is None or len(self._queue) > 0
+
+    def write(self, path:str, data:bytes, kind:str=""):
+        self._queue.append((path, data, kind))
+    def update(self):
+        if not self._job:
+            if not self._queue:
+                return
+            path, data, kind = self._queue.pop(0)
+            self._job = self._write_steps(path, data, kind)
+        try:
+            next(self._job)
+        except StopIteration:
+            self._job = None
+            if not self._queue:
+                self._result = self._failures
+                self._failures = 0
+                if self._completed: self._completed(self._result)
+    def flush(self) -> int:
+        # Writes all queued files immediately, returning the number which failed
+        self._result = 0
+        while self.is_busy():
+            self.update()
+        return self._result
+
+    def _write_steps(self, path:str, data:bytes, kind:str):
+        name = kind + " file" if kind else "file"
+        temp = path + TEMP_SUFFIX
+        failed = False
+        try:
+            file = open(temp, "wb")
+        except:
+            failed = True
+        if not failed:
+            try:
+                view = memoryview(data)
+                for offset in range(0, len(data), self._chunk_size):
+                    file.write(view[offset:offset + self._chunk_size])
+                    yield
+            except Exception: # Not GeneratorExit
+                failed = True
+            finally:
+                file.close()
+        if not failed:
+            try:
+                replace_file(temp, path)
+            except OSError:
+                failed = True
+        if failed:
+            self._failures += 1
+            print("Failed to write {}: {}".format(name, path))
+        else:
+            print("Successfully written {}: {}".format(name, path))
+
+def write_file(path:str, data:bytes, kind:str="", writer:FileWriter=None) -> bool:
+    # Queues data on a writer, or writes it immediately without one
+    if writer:
+        writer.write(path, data, kind)
+        return True
+    writer = FileWriter()
+    writer.write(path, data, kind)
+    return not writer.flush()